@@ -48,7 +48,7 @@ from breezy.plugins.qbrz.lib.widgets.texteditaccessory import (
 from breezy.plugins.qbrz.lib.uifactory import ui_current_widget
 from breezy.plugins.qbrz.lib.trace import reports_exception
 from breezy.plugins.qbrz.lib.logwidget import LogList
-from breezy.plugins.qbrz.lib.lazycachedrevloader import (load_revisions,
+from breezy.plugins.qbrz.lib.lazycachedrevloader import (get_revision_loader,
                                                          cached_revisions)
 from breezy.plugins.qbrz.lib.texteditannotate import (AnnotateBarBase,
                                                       AnnotateEditerFrameBase)
@@ -527,7 +527,8 @@ class AnnotateWindow(QBzrWindow):
         self.processEvents()
         highlight_document(self.text_edit, path)
         self.processEvents()
-        load_revisions(ordered_revids, self.branch.repository, revisions_loaded = self.revisions_loaded, pass_prev_loaded_rev = True)
+        cached_revisions.pin(self, ordered_revids)
+        get_revision_loader().submit(ordered_revids, self.branch.repository, revisions_loaded = self.revisions_loaded, pass_prev_loaded_rev = True)
         self.processEvents()
 
         if just_loaded_log:
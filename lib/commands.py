@@ -26,6 +26,7 @@ from breezy.option import Option
 import breezy.builtins
 
 import sys
+import time
 
 from PyQt5 import QtCore, QtWidgets
 
@@ -97,6 +98,25 @@ def check_encoding(encoding):
     raise InvalidEncodingOption(encoding)
 
 
+class InvalidDateOption(errors.BzrError):
+
+    _fmt = 'Invalid date: %(date)s. Use YYYY-MM-DD or YYYY-MM-DD HH:MM.'
+
+    def __init__(self, date):
+        errors.BzrError.__init__(self)
+        self.date = date
+
+
+def parse_date(date):
+    """Parse a date in local time, and return it as a timestamp."""
+    for format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(date, format))
+        except ValueError:
+            pass
+    raise InvalidDateOption(date)
+
+
 class PyQt4NotInstalled(errors.BzrError):
 
     _fmt = 'QBrz requires at least PyQt 4.4 and Qt 4.4 to run. Please check your install'
@@ -447,10 +467,20 @@ class cmd_qlog(QBzrCommand):
         ui_mode_option,
         Option('no-graph', help="Shows the log with no graph."),
         Option('show-trees', help="Show working trees that have changes as nodes in the graph"),
+        Option('limit', short_name='l', type=int, argname='N',
+               help="Only load the last N mainline revisions, and the revisions they merge. "
+                    "More are loaded when scrolling to the end of the log."),
+        Option('since', type=parse_date, argname='DATE',
+               help="Only load the mainline revisions committed after DATE (YYYY-MM-DD), "
+                    "and the revisions they merge."),
         ]
 
-    def _qbrz_run(self, locations_list=None, ui_mode=False, no_graph=False, show_trees=False):
-        window = LogWindow(locations_list, None, None, ui_mode=ui_mode, no_graph=no_graph, show_trees=show_trees)
+    def _qbrz_run(self, locations_list=None, ui_mode=False, no_graph=False, show_trees=False,
+                  limit=None, since=None):
+        if limit is not None and limit < 1:
+            raise errors.BzrCommandError('brz qlog --limit must be at least 1')
+        window = LogWindow(locations_list, None, None, ui_mode=ui_mode, no_graph=no_graph, show_trees=show_trees,
+                           limit=limit, since=since)
         window.show()
         self._application.exec_()
 
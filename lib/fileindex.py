@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+#
+# QBzr - Qt frontend to Bazaar commands
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""Persistent index of the revisions that change each file in a repository,
+so that qlog FILE does not have to check every revision each time."""
+
+import hashlib
+import os
+import sqlite3
+
+from breezy import bedding, errors, osutils, trace
+
+from breezy.plugins.qbrz.lib.util import get_qbrz_config
+
+
+class FileChangesIndex(object):
+    """Index of file id to the revisions that change the file, for one
+    repository, kept in a sqlite database.
+
+    A revision changes a file if it has a text key (file_id, revid), i.e.
+    the revision of the file's entry in the inventory is that revision.
+
+    For directories, the changes to the files in them are rolled up, so
+    that a directory is answered the same way as a file. Rolling up needs
+    the inventory of each revision, so it is only done for the revisions of
+    a log of a directory.
+
+    If the database can't be used, the index disables itself.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.disabled = False
+        self._conn = None
+        self._indexed = None
+        self._rolled_up = None
+
+    def _connect(self):
+        if self._conn is None and not self.disabled:
+            try:
+                dirname = os.path.dirname(self.filename)
+                if dirname and not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                conn = sqlite3.connect(self.filename, timeout=1)
+                conn.executescript("""
+                    CREATE TABLE IF NOT EXISTS revisions
+                        (revid BLOB PRIMARY KEY,
+                         rolled_up INTEGER NOT NULL DEFAULT 0);
+                    CREATE TABLE IF NOT EXISTS changes
+                        (file_id BLOB, revid BLOB, PRIMARY KEY (file_id, revid))
+                        WITHOUT ROWID;
+                    CREATE INDEX IF NOT EXISTS changes_revid ON changes (revid);
+                    CREATE TABLE IF NOT EXISTS rollups
+                        (dir_id BLOB, file_id BLOB, revid BLOB,
+                         PRIMARY KEY (dir_id, file_id, revid))
+                        WITHOUT ROWID;
+                    """)
+                self._conn = conn
+            except (sqlite3.Error, OSError) as e:
+                self._error(e)
+        return self._conn
+
+    def _error(self, e):
+        trace.mutter("qbrz: disabling file changes index %s: %s",
+                     self.filename, e)
+        self.disabled = True
+        self.close()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        self._indexed = self._rolled_up = None
+
+    def _load_revisions(self):
+        if self._indexed is None:
+            conn = self._connect()
+            if conn is None:
+                return False
+            try:
+                rows = conn.execute("SELECT revid, rolled_up FROM revisions")
+                self._indexed = set()
+                self._rolled_up = set()
+                for revid, rolled_up in rows:
+                    revid = bytes(revid)
+                    self._indexed.add(revid)
+                    if rolled_up:
+                        self._rolled_up.add(revid)
+            except sqlite3.Error as e:
+                self._error(e)
+                return False
+        return True
+
+    @property
+    def indexed(self):
+        """Set of the revids whose changes are in the index."""
+        if not self._load_revisions():
+            return frozenset()
+        return self._indexed
+
+    @property
+    def rolled_up(self):
+        """Set of the revids whose changes are rolled up to directories."""
+        if not self._load_revisions():
+            return frozenset()
+        return self._rolled_up
+
+    def add_revisions(self, repo, revids):
+        """Add the changes of the revisions that are not in the index yet.
+        repo must be locked. Return False if the index can't be used."""
+        if not self._load_revisions():
+            return False
+        revids = [revid for revid in revids if revid not in self._indexed]
+        if not revids:
+            return True
+        try:
+            altered = repo.fileids_altered_by_revision_ids(revids)
+        except (AttributeError, NotImplementedError, errors.BzrError) as e:
+            # Not a repository with file ids, e.g. git.
+            self._error(e)
+            return False
+        try:
+            with self._conn as conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO changes (file_id, revid) "
+                    "VALUES (?, ?)",
+                    ((file_id, revid) for file_id, file_revids in altered.items()
+                     for revid in file_revids))
+                conn.executemany(
+                    "INSERT OR IGNORE INTO revisions (revid) VALUES (?)",
+                    ((revid,) for revid in revids))
+        except sqlite3.Error as e:
+            self._error(e)
+            return False
+        self._indexed.update(revids)
+        return True
+
+    def add_rollups(self, repo, revids):
+        """Roll up the changes of revisions to the directories that the
+        changed files are in. The revisions must already be indexed, and repo
+        must be locked. Return False if the index can't be used."""
+        changed = self.get_changed_file_ids(revids)
+        if changed is None:
+            return False
+        revids = list(changed)
+        if not revids:
+            return True
+        return self.add_rollup_rows(
+            revids, get_rollup_rows(repo, revids, changed))
+
+    def get_changed_file_ids(self, revids):
+        """Return a dict of each of revids that has not been rolled up yet
+        to the file ids that it changes, or None if the index can't be
+        used. The revisions must already be indexed."""
+        if not self._load_revisions():
+            return None
+        revids = [revid for revid in revids if revid not in self._rolled_up]
+        changed = dict((revid, []) for revid in revids)
+        try:
+            for offset in range(0, len(revids), 500):
+                batch = revids[offset:offset + 500]
+                for file_id, revid in self._conn.execute(
+                        "SELECT file_id, revid FROM changes WHERE revid IN (%s)"
+                        % ",".join("?" * len(batch)), batch):
+                    changed[bytes(revid)].append(bytes(file_id))
+        except sqlite3.Error as e:
+            self._error(e)
+            return None
+        return changed
+
+    def get_rollup_call(self, url, revids):
+        """Return (function, args) to roll up the changes of revids in
+        another process, for the repository at url, or None if the index
+        can't be used. The function returns the rows to pass to
+        add_rollup_rows with revids."""
+        changed = self.get_changed_file_ids(revids)
+        if changed is None:
+            return None
+        return load_rollup_rows, (url, list(changed), changed)
+
+    def add_rollup_rows(self, revids, rows):
+        """Add rows of (dir_id, file_id, revid) that roll up the changes of
+        revids. Return False if the index can't be used."""
+        if not self._load_revisions():
+            return False
+        conn = self._conn
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO rollups (dir_id, file_id, revid) "
+                    "VALUES (?, ?, ?)", rows)
+                conn.executemany(
+                    "UPDATE revisions SET rolled_up = 1 WHERE revid = ?",
+                    ((revid,) for revid in revids))
+        except sqlite3.Error as e:
+            self._error(e)
+            return False
+        self._rolled_up.update(revids)
+        return True
+
+    def get_text_keys(self, file_ids, rolled_up=False):
+        """Return the set of the text keys (file_id, revid) of the changes to
+        file_ids, including the changes to the files in them if rolled_up.
+        Return None if the index can't be used."""
+        if self._connect() is None:
+            return None
+        file_ids = list(file_ids)
+        queries = ["SELECT file_id, revid FROM changes WHERE file_id IN (%s)"]
+        if rolled_up:
+            queries.append(
+                "SELECT file_id, revid FROM rollups WHERE dir_id IN (%s)")
+        text_keys = set()
+        try:
+            for query in queries:
+                for offset in range(0, len(file_ids), 500):
+                    batch = file_ids[offset:offset + 500]
+                    text_keys.update(
+                        (bytes(file_id), bytes(revid)) for file_id, revid in
+                        self._conn.execute(
+                            query % ",".join("?" * len(batch)), batch))
+        except sqlite3.Error as e:
+            self._error(e)
+            return None
+        return text_keys
+
+
+def get_rollup_rows(repo, revids, changed):
+    """Return the rows of (dir_id, file_id, revid) that roll up the changes
+    of revids to the directories that the changed files are in.
+
+    :param changed: dict of revid to the file ids that it changes.
+    repo must be locked."""
+    rows = []
+    for inv, revid in zip(repo.iter_inventories(revids), revids):
+        parent_ids = {}
+        for file_id in changed.get(revid, ()):
+            dir_id = file_id
+            while True:
+                if dir_id not in parent_ids:
+                    try:
+                        parent_ids[dir_id] = inv.get_entry(dir_id).parent_id
+                    except errors.NoSuchId:
+                        parent_ids[dir_id] = None
+                dir_id = parent_ids[dir_id]
+                if dir_id is None:
+                    break
+                rows.append((dir_id, file_id, revid))
+    return rows
+
+
+def load_rollup_rows(url, revids, changed):
+    """Return the rollup rows of revids, for the repository at url.
+
+    This runs in the processes of the pool of qlog, so it opens the
+    repository itself."""
+    from breezy.repository import Repository
+    repo = Repository.open(url)
+    with repo.lock_read():
+        return get_rollup_rows(repo, revids, changed)
+
+
+_file_changes_indexes = {}
+
+def get_file_changes_index(repo):
+    """Get the FileChangesIndex of a repository, or None if indexing is
+    disabled by the file_changes_index option of qbrz.conf."""
+    if get_qbrz_config().get_option_as_bool('file_changes_index') is False:
+        return None
+    base = repo.base
+    index = _file_changes_indexes.get(base)
+    if index is None:
+        name = hashlib.sha1(base.encode("utf-8")).hexdigest()
+        index = _file_changes_indexes[base] = FileChangesIndex(osutils.pathjoin(
+            bedding.cache_dir(), 'qbrz', 'filechanges', name + '.sqlite'))
+    if index.disabled:
+        return None
+    return index
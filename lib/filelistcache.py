@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+#
+# QBzr - Qt frontend to Bazaar commands
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""Caches of the revision trees and deltas that the file list of qlog
+shows, bounded in number and estimated size, and shared by the logs of a
+repository."""
+
+from collections import OrderedDict
+
+from breezy.revision import CURRENT_REVISION, NULL_REVISION
+
+from breezy.plugins.qbrz.lib.lazycachedrevloader import get_revision_cache_size
+
+DEFAULT_TREE_CACHE_SIZE = 100
+"""Default memory budget of the cache of trees, in megabytes."""
+
+DEFAULT_DELTA_CACHE_SIZE = 20
+"""Default memory budget of the cache of deltas, in megabytes."""
+
+MAX_CACHED_TREES = 20
+MAX_CACHED_DELTAS = 1000
+
+_delta_change_lists = ('added', 'removed', 'renamed', 'copied', 'modified',
+                       'kind_changed', 'unchanged', 'unversioned', 'missing')
+
+
+def estimate_delta_size(delta):
+    """Estimate the memory used by a TreeDelta, in bytes."""
+    size = 500
+    if delta is None:
+        return size
+    for name in _delta_change_lists:
+        for change in getattr(delta, name, None) or ():
+            size += 400
+            for path in getattr(change, 'path', None) or ():
+                if path:
+                    size += len(path)
+    return size
+
+
+def estimate_tree_size(tree):
+    """Estimate the memory used by a revision tree, in bytes.
+
+    Inventories are deserialized as they are used, so this is only the
+    size of the entries that have been loaded so far."""
+    size = 10000
+    inv = getattr(tree, 'root_inventory', None)
+    if inv is not None:
+        for name in ('_fileid_to_entry_cache', '_path_to_fileid_cache',
+                     '_byid'):
+            size += 500 * len(getattr(inv, name, None) or ())
+    return size
+
+
+def revision_delta_key(rev):
+    """Return the delta cache key of the delta of a revision compared to
+    its left hand parent."""
+    if rev.parent_ids:
+        return (rev.revision_id, rev.parent_ids[0])
+    return (rev.revision_id, NULL_REVISION)
+
+
+def iter_revision_deltas(repo, revisions):
+    """Yield the delta cache key and the delta of each of revisions,
+    compared to its left hand parent.
+
+    This uses the revision delta API of the repository, which loads the
+    trees of all the revisions together, and does not keep them. repo must
+    be locked."""
+    get_deltas = getattr(repo, 'get_revision_deltas', None)
+    if get_deltas is None:
+        # Older versions of breezy.
+        get_deltas = repo.get_deltas_for_revisions
+    for rev, delta in zip(revisions, get_deltas(revisions)):
+        yield revision_delta_key(rev), delta
+
+
+class LRUCache(object):
+    """Cache that evicts the least recently used items when there are more
+    than max_count of them, or their estimated size is more than max_size.
+
+    This acts like a dict.
+    """
+
+    def __init__(self, max_count, max_size=None, estimate_size=None,
+                 size_option=None, default_size=None):
+        self.max_count = max_count
+        self.max_size = max_size
+        """Memory budget in bytes. If None, this is read from the qbrz
+        config when it is first needed."""
+        self.estimate_size = estimate_size
+        self.size_option = size_option
+        self.default_size = default_size
+        self._items = OrderedDict()
+        """OrderedDict of key to (value, size), least recently used first."""
+        self._size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __getitem__(self, key):
+        value, size = self._items[key]
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+    def __setitem__(self, key, value):
+        if key in self._items:
+            self._size -= self._items.pop(key)[1]
+        size = self.estimate_size(value)
+        self._items[key] = (value, size)
+        self._size += size
+        self.evict()
+
+    def __delitem__(self, key):
+        self._size -= self._items.pop(key)[1]
+
+    def __len__(self):
+        return len(self._items)
+
+    def keys(self):
+        return list(self._items.keys())
+
+    def clear(self):
+        self._items.clear()
+        self._size = 0
+
+    def resize(self, key):
+        """Estimate the size of an item again, after it has grown."""
+        if key in self._items:
+            value, size = self._items[key]
+            new_size = self.estimate_size(value)
+            self._items[key] = (value, new_size)
+            self._size += new_size - size
+            self.evict()
+
+    def invalidate(self, predicate):
+        """Remove the items whose keys predicate returns True for. Return
+        the number of items removed."""
+        keys = [key for key in self._items if predicate(key)]
+        for key in keys:
+            del self[key]
+        return len(keys)
+
+    def evict(self):
+        """Evict the least recently used items, until the items fit in
+        max_count and max_size. The most recently used item is kept, even
+        if it does not fit on its own."""
+        if self.max_size is None:
+            self.max_size = get_revision_cache_size(self.size_option,
+                                                    self.default_size)
+        items = self._items
+        while len(items) > 1 and (len(items) > self.max_count or
+                                  self._size > self.max_size):
+            key, (value, size) = items.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+
+    def stats(self):
+        """Return a dict of statistics about the cache."""
+        return {
+            "items": len(self._items),
+            "size": self._size,
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class FileListCaches(object):
+    """The caches of the file list of the logs of a repository.
+
+    trees is a cache of revid to revision tree. Working trees belong to the
+    log that shows them, so they are not put in it.
+
+    deltas is a cache of (revid, compared to revid) to TreeDelta.
+    """
+
+    def __init__(self, max_trees=MAX_CACHED_TREES,
+                 max_deltas=MAX_CACHED_DELTAS, tree_size=None,
+                 delta_size=None):
+        self.trees = LRUCache(max_trees, tree_size, estimate_tree_size,
+                              'file_list_tree_cache_size',
+                              DEFAULT_TREE_CACHE_SIZE)
+        self.deltas = LRUCache(max_deltas, delta_size, estimate_delta_size,
+                               'file_list_delta_cache_size',
+                               DEFAULT_DELTA_CACHE_SIZE)
+
+    def invalidate_revids(self, revids):
+        """Remove the trees of revids, and the deltas to or from them."""
+        revids = frozenset(revids)
+        self.trees.invalidate(lambda revid: revid in revids)
+        self.deltas.invalidate(
+            lambda key: key[0] in revids or key[1] in revids)
+
+    def invalidate_working_trees(self):
+        """Remove the deltas of working trees, which change."""
+        self.deltas.invalidate(
+            lambda key: any(revid is not None and
+                            revid.startswith(CURRENT_REVISION)
+                            for revid in key))
+
+    def clear(self):
+        self.trees.clear()
+        self.deltas.clear()
+
+
+_file_list_caches = {}
+
+def get_file_list_caches(repo):
+    """Get the FileListCaches that the logs of a repository share."""
+    caches = _file_list_caches.get(repo.base)
+    if caches is None:
+        caches = _file_list_caches[repo.base] = FileListCaches()
+    return caches
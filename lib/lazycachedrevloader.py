@@ -17,23 +17,435 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
-#import weakref
+from collections import OrderedDict, deque
+import itertools
+import json
+import os
+import queue
+import sqlite3
+import threading
+import weakref
 import time
+from time import localtime, strftime
 
 from PyQt5 import QtCore
 
+from breezy import bedding, osutils, trace
+from breezy.revision import Revision
 from breezy.transport.local import LocalTransport
 from breezy.repository import Repository
+from breezy import repository as _mod_repository
 from breezy.bzr.remote import RemoteRepository
+from breezy.plugins.qbrz.lib.bugs import get_bug_id
 from breezy.plugins.qbrz.lib.uifactory import current_throbber
+from breezy.plugins.qbrz.lib.util import (
+    get_apparent_author,
+    get_apparent_author_name,
+    get_qbrz_config,
+    )
 
-cached_revisions = {} #weakref.WeakValueDictionary()
+DEFAULT_REVISION_CACHE_SIZE = 100
+"""Default memory budget of cached_revisions, in megabytes."""
+
+DEFAULT_SUMMARY_CACHE_SIZE = 50
+"""Default memory budget of cached_summaries, in megabytes."""
+
+
+def get_revision_cache_size(option='revision_cache_size',
+                            default=DEFAULT_REVISION_CACHE_SIZE):
+    """Get the memory budget of a cache in bytes, from an option (in
+    megabytes) of qbrz.conf."""
+    size = get_qbrz_config().get_option(option)
+    try:
+        size = float(size)
+    except (TypeError, ValueError):
+        size = default
+    return int(size * 1024 * 1024)
+
+
+def estimate_revision_size(rev):
+    """Estimate the memory used by a revision, in bytes."""
+    # The Revision object, its __dict__, and the fixed size attributes.
+    size = 600
+    size += len(rev.revision_id or b"") + len(rev.committer or "")
+    size += len(rev.message or "")
+    size += 80 * len(rev.parent_ids or ())
+    for name, value in (rev.properties or {}).items():
+        size += 100 + len(name) + len(value)
+    return size
+
+
+class RevisionSummary(object):
+    """What is displayed in a list of revisions, worked out once when the
+    revision is loaded.
+
+    This is much smaller than a Revision, which has the whole message and
+    all the properties.
+    """
+
+    __slots__ = ("revid", "summary", "author", "author_name", "timestamp",
+                 "date", "bug_ids")
+
+    def __init__(self, rev):
+        self.revid = rev.revision_id
+        self.summary = rev.get_summary() or ""
+        self.author = get_apparent_author(rev)
+        self.author_name = get_apparent_author_name(rev)
+        self.timestamp = rev.timestamp
+        self.date = strftime("%Y-%m-%d %H:%M", localtime(rev.timestamp))
+        bug_ids = []
+        for bug in rev.properties.get('bugs', '').split('\n'):
+            if bug:
+                bug_id = get_bug_id(bug.split(' ', 1)[0])
+                if bug_id:
+                    bug_ids.append(bug_id)
+        self.bug_ids = tuple(bug_ids)
+
+
+def estimate_summary_size(summary):
+    """Estimate the memory used by a RevisionSummary, in bytes."""
+    return (300 + len(summary.revid) + len(summary.summary) +
+            len(summary.author) + len(summary.author_name) +
+            50 * len(summary.bug_ids))
+
+
+class RevisionCache(object):
+    """Cache of revisions, that evicts the least recently used revisions
+    when their estimated size is more than max_size.
+
+    Revisions can be pinned by the objects that are displaying them, so that
+    they are not evicted. Pins go away when the object that pinned them is
+    garbage collected.
+
+    This acts like a dict of revid to Revision (or RevisionSummary, for
+    cached_summaries).
+    """
+
+    def __init__(self, max_size=None, estimate_size=estimate_revision_size,
+                 size_option='revision_cache_size',
+                 default_size=DEFAULT_REVISION_CACHE_SIZE):
+        self.max_size = max_size
+        """Memory budget in bytes. If None, this is read from the qbrz
+        config when it is first needed."""
+        self.estimate_size = estimate_size
+        self.size_option = size_option
+        self.default_size = default_size
+        self._revisions = OrderedDict()
+        """OrderedDict of revid to (Revision, size), least recently used
+        first."""
+        self._size = 0
+        self._pins = weakref.WeakKeyDictionary()
+        """Dict of object to the set of revids that it pinned."""
+
+        self.hits = 0
+        """Number of revisions that load_revisions found in the cache."""
+        self.misses = 0
+        """Number of revisions that load_revisions had to load."""
+        self.evictions = 0
+
+    def __contains__(self, revid):
+        return revid in self._revisions
+
+    def __getitem__(self, revid):
+        rev, size = self._revisions[revid]
+        self._revisions.move_to_end(revid)
+        return rev
+
+    def get(self, revid, default=None):
+        try:
+            return self[revid]
+        except KeyError:
+            return default
+
+    def __setitem__(self, revid, rev):
+        if revid in self._revisions:
+            self._size -= self._revisions.pop(revid)[1]
+        size = self.estimate_size(rev)
+        self._revisions[revid] = (rev, size)
+        self._size += size
+        self.evict()
+
+    def __delitem__(self, revid):
+        self._size -= self._revisions.pop(revid)[1]
+
+    def __len__(self):
+        return len(self._revisions)
+
+    def clear(self):
+        self._revisions.clear()
+        self._size = 0
+
+    def pin(self, owner, revids):
+        """Stop revids being evicted while owner is displaying them.
+
+        This replaces the revids previously pinned by owner.
+        """
+        self._pins[owner] = frozenset(revids)
+
+    def unpin(self, owner):
+        self._pins.pop(owner, None)
+
+    def evict(self):
+        """Evict the least recently used revisions that are not pinned,
+        until the revisions fit in max_size."""
+        if self.max_size is None:
+            self.max_size = get_revision_cache_size(self.size_option,
+                                                    self.default_size)
+        if self._size <= self.max_size:
+            return
+        pinned = set()
+        for revids in list(self._pins.values()):
+            pinned.update(revids)
+        revisions = self._revisions
+        # Pinned revisions are moved to the end, so that we don't look at
+        # them again, so only go round once.
+        for i in range(len(revisions)):
+            if self._size <= self.max_size:
+                break
+            revid, (rev, size) = revisions.popitem(last=False)
+            if revid in pinned:
+                revisions[revid] = (rev, size)
+            else:
+                self._size -= size
+                self.evictions += 1
+
+    def stats(self):
+        """Return a dict of statistics about the cache."""
+        return {
+            "revisions": len(self._revisions),
+            "size": self._size,
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+cached_revisions = RevisionCache()
 """Global cache of revisions."""
 
+cached_summaries = RevisionCache(
+    estimate_size=estimate_summary_size,
+    size_option='revision_summary_cache_size',
+    default_size=DEFAULT_SUMMARY_CACHE_SIZE)
+"""Global cache of RevisionSummary, for revisions that are only displayed
+in lists."""
+
+
+def get_revision_summary(revid):
+    """Get the RevisionSummary of a revision, or None if it is not loaded."""
+    summary = cached_summaries.get(revid)
+    if summary is None:
+        rev = cached_revisions.get(revid)
+        if rev is not None:
+            summary = cached_summaries[revid] = RevisionSummary(rev)
+    return summary
+
+
+class RevisionStore(object):
+    """Persistent on disk store of revisions, shared between processes.
+
+    Revisions never change once they are committed, so revisions that were
+    loaded from a remote repository are kept in a sqlite database, keyed by
+    revid, and don't need to be fetched again the next time.
+
+    If the database can't be used, the store disables itself, and
+    load_revisions goes to the repository as before.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._conn = None
+        self.disabled = False
+
+    def _connect(self):
+        if self._conn is None and not self.disabled:
+            try:
+                dirname = os.path.dirname(self.filename)
+                if not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                conn = sqlite3.connect(self.filename, timeout=1)
+                conn.execute("CREATE TABLE IF NOT EXISTS revisions "
+                             "(revid BLOB PRIMARY KEY, data TEXT NOT NULL)")
+                self._conn = conn
+            except (sqlite3.Error, OSError) as e:
+                self._error(e)
+        return self._conn
+
+    def _error(self, e):
+        trace.mutter("qbrz: disabling revision store %s: %s",
+                     self.filename, e)
+        self.disabled = True
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def get_revisions(self, revids):
+        """Get the stored revisions for revids.
+
+        :return: dict of revid to Revision, for the revids that are stored.
+        """
+        conn = self._connect()
+        revisions = {}
+        if conn is None:
+            return revisions
+        revids = [revid for revid in revids if isinstance(revid, bytes)]
+        try:
+            # Stay under SQLITE_MAX_VARIABLE_NUMBER.
+            for offset in range(0, len(revids), 500):
+                batch = revids[offset:offset + 500]
+                cursor = conn.execute(
+                    "SELECT revid, data FROM revisions WHERE revid IN (%s)"
+                    % ",".join("?" * len(batch)), batch)
+                for revid, data in cursor:
+                    revisions[bytes(revid)] = self._deserialize(
+                        bytes(revid), data)
+        except (sqlite3.Error, ValueError, KeyError, TypeError) as e:
+            self._error(e)
+            return {}
+        return revisions
+
+    def add_revisions(self, revisions):
+        conn = self._connect()
+        if conn is None:
+            return
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO revisions (revid, data) "
+                    "VALUES (?, ?)",
+                    [(rev.revision_id, self._serialize(rev))
+                     for rev in revisions
+                     if isinstance(rev.revision_id, bytes)])
+        except (sqlite3.Error, UnicodeDecodeError) as e:
+            self._error(e)
+
+    @staticmethod
+    def _serialize(rev):
+        return json.dumps({
+            "parent_ids": [parent.decode("utf-8")
+                           for parent in rev.parent_ids],
+            "committer": rev.committer,
+            "message": rev.message,
+            "timestamp": rev.timestamp,
+            "timezone": rev.timezone,
+            "properties": rev.properties,
+            "inventory_sha1": (rev.inventory_sha1.decode("ascii")
+                               if rev.inventory_sha1 else None),
+            })
+
+    @staticmethod
+    def _deserialize(revid, data):
+        data = json.loads(data)
+        inventory_sha1 = data["inventory_sha1"]
+        return Revision(
+            revid,
+            properties=data["properties"],
+            parent_ids=[parent.encode("utf-8")
+                        for parent in data["parent_ids"]],
+            committer=data["committer"],
+            message=data["message"],
+            timestamp=data["timestamp"],
+            timezone=data["timezone"],
+            inventory_sha1=(inventory_sha1.encode("ascii")
+                            if inventory_sha1 else None))
+
+
+_revision_store = None
+
+def get_revision_store():
+    """Get the global RevisionStore, or None if it is disabled by the
+    revision_store option of qbrz.conf."""
+    global _revision_store
+    if get_qbrz_config().get_option_as_bool('revision_store') is False:
+        return None
+    if _revision_store is None:
+        _revision_store = RevisionStore(osutils.pathjoin(
+            bedding.cache_dir(), 'qbrz', 'revisions.sqlite'))
+    if _revision_store.disabled:
+        return None
+    return _revision_store
+
+
+class BatchSizer(object):
+    """Chooses how many revisions to load from a repository at a time.
+
+    The time a batch takes is modelled as a fixed round trip plus a cost per
+    revision, fitted to the last few batches, and the size is chosen so that
+    a batch takes about target_time. A high latency link ends up with big
+    batches, because the round trip, not the number of revisions, is what
+    takes the time. The size at most doubles from one batch to the next, and
+    shrinks straight away if a batch is too slow.
+    """
+
+    target_time = 0.25
+    """Seconds that a batch should take."""
+    min_size = 1
+    max_size = 1000
+
+    def __init__(self, size):
+        self.size = size
+        self.samples = deque(maxlen=8)
+        """(revision count, seconds) of the last few batches."""
+
+    def record(self, count, seconds):
+        """Record that loading count revisions took seconds."""
+        if count <= 0:
+            return
+        self.samples.append((count, seconds))
+        if seconds > self.target_time:
+            size = count * self.target_time / seconds
+        else:
+            per_revision, round_trip = self.fit()
+            if per_revision <= 0 or round_trip >= self.target_time:
+                size = self.max_size
+            else:
+                size = (self.target_time - round_trip) / per_revision
+            if size > self.size:
+                if count < self.size:
+                    # A partial batch says nothing about whether a bigger
+                    # batch would be quick enough.
+                    return
+                size = min(size, self.size * 2)
+        self.size = max(self.min_size, min(self.max_size, int(round(size))))
+
+    def fit(self):
+        """Least squares fit of the samples.
+
+        :return: (seconds per revision, seconds per round trip)
+        """
+        n = len(self.samples)
+        mean_count = sum(count for count, seconds in self.samples) / n
+        mean_seconds = sum(seconds for count, seconds in self.samples) / n
+        variance = sum((count - mean_count) ** 2
+                       for count, seconds in self.samples)
+        if variance == 0:
+            return mean_seconds / mean_count, 0
+        per_revision = sum((count - mean_count) * (seconds - mean_seconds)
+                           for count, seconds in self.samples) / variance
+        return per_revision, max(0, mean_seconds - per_revision * mean_count)
+
+
+batch_sizers = {}
+"""Dict of repository url to BatchSizer, kept for the life of the process."""
+
+def get_batch_sizer(repo, repo_is_local):
+    url = getattr(repo, "user_url", None) or repo.base
+    sizer = batch_sizers.get(url)
+    if sizer is None:
+        sizer = batch_sizers[url] = BatchSizer(30 if repo_is_local else 5)
+    return sizer
+
+
 def load_revisions(revids, repo,
                    time_before_first_ui_update = 0.5,
-                   local_batch_size = 30,
-                   remote_batch_size = 5,
+                   local_batch_size = None,
+                   remote_batch_size = None,
                    before_batch_load = None,
                    revisions_loaded = None,
                    pass_prev_loaded_rev = False):
@@ -48,31 +460,47 @@ def load_revisions(revids, repo,
         for revid in [revid for revid in revids
                       if revid in cached_revisions]:
             return_revisions[revid] = cached_revisions[revid]
+        cached_revisions.hits += len(return_revisions)
         if pass_prev_loaded_rev:
             if revisions_loaded is not None:
                 revisions_loaded(return_revisions, False)
 
         revs_loaded = {}
         revids = [revid for revid in revids if revid not in cached_revisions]
+        cached_revisions.misses += len(revids)
         if revids:
             if isinstance(repo, Repository) or isinstance(repo, RemoteRepository):
                 repo_revids=((repo, revids),)
             else:
                 repo_revids = repo(revids)
 
+            store = get_revision_store()
             for repo, revids in repo_revids:
                 repo_is_local = isinstance(repo.controldir.transport, LocalTransport)
                 if repo_is_local:
                     batch_size = local_batch_size
                 else:
                     batch_size = remote_batch_size
+                sizer = None
+                if batch_size is None:
+                    sizer = get_batch_sizer(repo, repo_is_local)
+
+                if store is not None and not repo_is_local and revids:
+                    stored = store.get_revisions(revids)
+                    for revid, rev in stored.items():
+                        rev.repository = repo
+                        cached_revisions[revid] = rev
+                        return_revisions[revid] = rev
+                        revs_loaded[revid] = rev
+                    revids = [revid for revid in revids if revid not in stored]
 
                 if revids:
                     with repo.lock_read():
                         if not repo_is_local:
                             update_ui()
 
-                        for offset in range(0, len(revids), batch_size):
+                        offset = 0
+                        while offset < len(revids):
 
                             running_time = time.process_time() - start_time
 
@@ -86,18 +514,28 @@ def load_revisions(revids, repo,
                                         showed_throbber = True
                                 update_ui()
 
+                            if sizer is not None:
+                                batch_size = sizer.size
                             batch_revids = revids[offset:offset+batch_size]
+                            offset += batch_size
 
                             if before_batch_load is not None:
                                 stop = before_batch_load(repo, batch_revids)
                                 if stop:
                                     break
 
-                            for rev in repo.get_revisions(batch_revids):
+                            batch_start = time.perf_counter()
+                            batch_revs = repo.get_revisions(batch_revids)
+                            if sizer is not None:
+                                sizer.record(len(batch_revids),
+                                             time.perf_counter() - batch_start)
+                            for rev in batch_revs:
                                 cached_revisions[rev.revision_id] = rev
                                 return_revisions[rev.revision_id] = rev
                                 revs_loaded[rev.revision_id] = rev
                                 rev.repository = repo
+                            if store is not None and not repo_is_local:
+                                store.add_revisions(batch_revs)
 
             if revisions_loaded is not None:
                 revisions_loaded(revs_loaded, True)
@@ -110,3 +548,304 @@ def load_revisions(revids, repo,
 def update_ui():
     QtCore.QCoreApplication.processEvents()
 
+
+class RevisionLoadRequest(object):
+    """A request to RevisionLoader to load some revisions.
+
+    The request can be cancelled, after which revisions_loaded is not called
+    again.
+    """
+
+    def __init__(self, revids, revisions_loaded, priority, summaries=False):
+        self.revids = revids
+        self.revisions_loaded = revisions_loaded
+        self.priority = priority
+        self.summaries = summaries
+        """If True, RevisionSummary are cached and passed to
+        revisions_loaded, rather than Revision."""
+        self.cancelled = False
+        self.finished = False
+        self.pending_jobs = 0
+
+    def cancel(self):
+        self.cancelled = True
+
+    def is_active(self):
+        return not self.cancelled and not self.finished
+
+    def wait(self):
+        """Process events until the request has finished or is cancelled."""
+        while self.is_active():
+            QtCore.QCoreApplication.processEvents(
+                QtCore.QEventLoop.AllEvents, 50)
+
+
+class _RevisionLoadJob(object):
+    """The revids of a request that are in one repository."""
+
+    def __init__(self, request, repo, revids, batch_size, sizer):
+        self.request = request
+        self.repo = repo
+        self.revids = revids
+        self.batch_size = batch_size
+        self.sizer = sizer
+
+
+class _RevisionLoadWorker(threading.Thread):
+    """Thread that loads revisions from one repository.
+
+    Breezy repositories are not thread safe, so the worker opens its own
+    instance of the repository, and never touches the one the GUI uses.
+
+    Jobs are taken from a priority queue one batch at a time, so that a long
+    running job does not hold up a job with a higher priority.
+    """
+
+    def __init__(self, loader, url):
+        threading.Thread.__init__(self, name="qbrz revision loader %s" % url)
+        self.daemon = True
+        self.loader = loader
+        self.url = url
+        self.queue = queue.PriorityQueue()
+        self.repo = None
+        self.failed = None
+
+    def put(self, job):
+        self.queue.put((-job.request.priority, next(self.loader.job_counter),
+                        job))
+
+    def stop(self):
+        self.queue.put((float("-inf"), next(self.loader.job_counter), None))
+
+    def run(self):
+        while True:
+            priority, count, job = self.queue.get()
+            if job is None:
+                break
+            if job.request.cancelled or self.failed is not None:
+                self.loader.jobFinished.emit(job, self.failed)
+                continue
+
+            batch_size = job.batch_size
+            if batch_size is None:
+                batch_size = job.sizer.size
+            batch_revids = job.revids[:batch_size]
+            job.revids = job.revids[batch_size:]
+            try:
+                if self.repo is None:
+                    self.repo = _mod_repository.Repository.open(self.url)
+                with self.repo.lock_read():
+                    batch_start = time.perf_counter()
+                    revs = self.repo.get_revisions(batch_revids)
+                    if job.batch_size is None:
+                        job.sizer.record(len(batch_revids),
+                                         time.perf_counter() - batch_start)
+            except Exception as e:
+                # The revids that were not loaded go back on the job, so
+                # that the GUI thread can load them.
+                job.revids = batch_revids + job.revids
+                self.failed = e
+                self.loader.jobFinished.emit(job, e)
+                continue
+
+            self.loader.batchLoaded.emit(
+                job, dict((rev.revision_id, rev) for rev in revs))
+            if job.revids:
+                self.put(job)
+            else:
+                self.loader.jobFinished.emit(job, None)
+
+
+class RevisionLoader(QtCore.QObject):
+    """Loads revisions on worker threads, one for each repository, and
+    delivers them to the GUI thread.
+
+    Revisions that are already in cached_revisions, or in the revision store,
+    are delivered straight away. The rest are loaded by the worker, in
+    batches, and each batch is added to cached_revisions and passed to the
+    request's revisions_loaded callback on the GUI thread.
+
+    Requests for summaries work the same way, with cached_summaries, and the
+    full revisions are not kept.
+    """
+
+    batchLoaded = QtCore.pyqtSignal(object, object)
+    jobFinished = QtCore.pyqtSignal(object, object)
+
+    def __init__(self, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self.workers = {}
+        self.job_counter = itertools.count()
+        self.batchLoaded.connect(self.on_batch_loaded)
+        self.jobFinished.connect(self.on_job_finished)
+
+    def submit(self, revids, repo, revisions_loaded=None, priority=0,
+               local_batch_size=None, remote_batch_size=None,
+               pass_prev_loaded_rev=False, summaries=False):
+        """Load revisions.
+
+        :param repo: repository, or a callable that takes revids and returns
+            a list of (repository, revids) tuples.
+        :param revisions_loaded: callable that is passed a dict of the
+            revisions that have been loaded, and whether this is the last
+            call. As with load_revisions, it is only called if there are
+            revisions that are not cached, unless pass_prev_loaded_rev is
+            True, in which case it is first called with the cached revisions.
+        :param priority: requests with a higher priority are loaded first.
+        :param local_batch_size, remote_batch_size: number of revisions to
+            load at a time. By default, this is chosen by the repository's
+            BatchSizer.
+        :param summaries: load RevisionSummary instead of Revision.
+        :return: RevisionLoadRequest
+        """
+        request = RevisionLoadRequest(revids, revisions_loaded, priority,
+                                      summaries)
+        revids = [revid for revid in revids if not revid == "root:"]
+
+        cached = {}
+        if summaries:
+            cache = cached_summaries
+            for revid in revids:
+                summary = get_revision_summary(revid)
+                if summary is not None:
+                    cached[revid] = summary
+        else:
+            cache = cached_revisions
+            for revid in revids:
+                if revid in cached_revisions:
+                    cached[revid] = cached_revisions[revid]
+        cache.hits += len(cached)
+        revids = [revid for revid in revids if revid not in cached]
+        cache.misses += len(revids)
+        if pass_prev_loaded_rev:
+            self.deliver(request, cached, False)
+
+        missing = revids
+        loaded = {}
+        jobs = []
+        if missing:
+            if isinstance(repo, Repository) or isinstance(repo, RemoteRepository):
+                repo_revids = ((repo, missing),)
+            else:
+                repo_revids = repo(list(missing))
+
+            store = get_revision_store()
+            for repo, revids in repo_revids:
+                if not revids:
+                    continue
+                repo_is_local = isinstance(repo.controldir.transport, LocalTransport)
+                if store is not None and not repo_is_local:
+                    stored = store.get_revisions(revids)
+                    for revid, rev in stored.items():
+                        loaded[revid] = self.add(request, repo, rev)
+                    revids = [revid for revid in revids if revid not in stored]
+                    if not revids:
+                        continue
+
+                worker = self.get_worker(repo)
+                if worker is None:
+                    # No worker for this repository. Load it here.
+                    for revid, rev in load_revisions(revids, repo).items():
+                        loaded[revid] = self.add(request, repo, rev)
+                    continue
+                if repo_is_local:
+                    batch_size = local_batch_size
+                else:
+                    batch_size = remote_batch_size
+                jobs.append((worker, _RevisionLoadJob(
+                    request, repo, revids, batch_size,
+                    get_batch_sizer(repo, repo_is_local))))
+
+        request.pending_jobs = len(jobs)
+        if not missing:
+            request.finished = True
+        elif loaded or not jobs:
+            self.deliver(request, loaded, not jobs)
+        for worker, job in jobs:
+            worker.put(job)
+        return request
+
+    def get_worker(self, repo):
+        try:
+            url = repo.user_url
+        except AttributeError:
+            return None
+        if url in self.workers:
+            worker = self.workers[url]
+            if worker is not None and worker.failed is not None:
+                trace.mutter("qbrz: revision loader for %s failed: %s",
+                             url, worker.failed)
+                # Don't try again.
+                self.workers[url] = worker = None
+            return worker
+        worker = _RevisionLoadWorker(self, url)
+        worker.start()
+        self.workers[url] = worker
+        return worker
+
+    def stop(self):
+        """Stop the worker threads, and wait for them to finish.
+
+        Jobs that have not been loaded are dropped.
+        """
+        workers = [worker for worker in self.workers.values()
+                   if worker is not None]
+        self.workers = {}
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            worker.join()
+
+    def deliver(self, request, revisions, last_call):
+        if last_call:
+            request.finished = True
+        if request.cancelled:
+            return
+        if request.revisions_loaded is not None:
+            request.revisions_loaded(revisions, last_call)
+
+    def add(self, request, repo, rev):
+        """Add a loaded revision to the cache that request uses.
+
+        :return: what to pass to revisions_loaded for the revision.
+        """
+        if request.summaries:
+            summary = RevisionSummary(rev)
+            cached_summaries[rev.revision_id] = summary
+            return summary
+        rev.repository = repo
+        cached_revisions[rev.revision_id] = rev
+        return rev
+
+    def on_batch_loaded(self, job, revisions):
+        store = get_revision_store()
+        repo_is_local = isinstance(job.repo.controldir.transport, LocalTransport)
+        if store is not None and not repo_is_local:
+            store.add_revisions(list(revisions.values()))
+        loaded = {}
+        for revid, rev in revisions.items():
+            loaded[revid] = self.add(job.request, job.repo, rev)
+        if not job.request.cancelled:
+            self.deliver(job.request, loaded, False)
+
+    def on_job_finished(self, job, error):
+        request = job.request
+        if error is not None and not request.cancelled and job.revids:
+            # The worker could not load them, so load them here.
+            loaded = {}
+            for revid, rev in load_revisions(job.revids, job.repo).items():
+                loaded[revid] = self.add(request, job.repo, rev)
+            self.deliver(request, loaded, False)
+        request.pending_jobs -= 1
+        if request.pending_jobs == 0:
+            self.deliver(request, {}, True)
+
+
+_revision_loader = None
+
+def get_revision_loader():
+    """Get the global RevisionLoader."""
+    global _revision_loader
+    if _revision_loader is None:
+        _revision_loader = RevisionLoader()
+    return _revision_loader
@@ -17,8 +17,12 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
+import threading
+
 from PyQt5 import QtCore, QtGui, QtWidgets
 
+from breezy import repository as _mod_repository
+from breezy import trace
 from breezy.revision import CURRENT_REVISION
 
 from breezy.plugins.qbrz.lib.util import (
@@ -34,6 +38,11 @@ from breezy.plugins.qbrz.lib.util import (
 from breezy.plugins.qbrz.lib.trace import reports_exception
 from breezy.plugins.qbrz.lib.uifactory import ui_current_widget
 from breezy.plugins.qbrz.lib.loggraphviz import GhostRevisionError
+from breezy.plugins.qbrz.lib.filelistcache import (
+    get_file_list_caches,
+    iter_revision_deltas,
+    revision_delta_key,
+    )
 
 import re
 
@@ -43,6 +52,7 @@ from breezy.controldir import ControlDir
 from breezy.urlutils import determine_relative_path, join, split
 
 from breezy.plugins.qbrz.lib.logwidget import LogList
+from breezy.plugins.qbrz.lib.logquery import is_query
 from breezy.plugins.qbrz.lib import logmodel
 from breezy.plugins.qbrz.lib.loggraphviz import BranchInfo
 
@@ -76,11 +86,12 @@ class LogWindow(QBzrWindow):
     FilterSearchRole = QtCore.Qt.UserRole + 104
     FilterTagRole = QtCore.Qt.UserRole + 105
     FilterBugRole = QtCore.Qt.UserRole + 106
+    FilterContentRole = QtCore.Qt.UserRole + 107
 
     def __init__(self, locations=None,
                  branch=None, tree=None, specific_file_ids=None,
                  parent=None, ui_mode=True, no_graph=False,
-                 show_trees=False):
+                 show_trees=False, limit=None, since=None):
         """Create qlog window.
 
         Note: you must use either locations or branch+tree+specific_file_id
@@ -104,6 +115,13 @@ class LogWindow(QBzrWindow):
 
         @param  no_graph:   don't show the graph of revisions (make sense
             for `bzr qlog FILE` to force plain log a-la `bzr log`).
+
+        @param  limit:  only load this many revisions of the mainline, and
+            the revisions they merge. More are loaded when scrolling to the
+            end of the log.
+
+        @param  since:  only load the mainline revisions committed after
+            this timestamp, and the revisions they merge.
         """
         self.title = gettext("Log")
         QBzrWindow.__init__(self, [self.title], parent, ui_mode=ui_mode)
@@ -111,6 +129,8 @@ class LogWindow(QBzrWindow):
 
         self.no_graph = no_graph
         self.show_trees = show_trees
+        self.limit = limit
+        self.since = since
         if branch:
             self.branch = branch
             self.tree = tree
@@ -224,9 +244,12 @@ class LogWindow(QBzrWindow):
             else:
                 gz_cls = logmodel.GraphVizLoader
 
-            self.log_list.load(branches, primary_bi, file_ids, self.no_graph, gz_cls)
+            self.log_list.load(branches, primary_bi, file_ids, self.no_graph, gz_cls,
+                               limit=self.limit, since=self.since)
             self.log_list.selectionModel().selectionChanged[QtCore.QItemSelection, QtCore.QItemSelection].connect(self.update_selection)
             self.load_search_indexes(branches)
+            if file_ids and self.searchType.findData(self.FilterContentRole) == -1:
+                self.searchType.addItem(gettext("Changes to file text"), self.FilterContentRole)
         finally:
             self.refresh_button.setDisabled(False)
             self.throbber.hide()
@@ -379,7 +402,7 @@ class LogWindow(QBzrWindow):
         return elided_text(location)
 
     def refresh(self):
-        self.file_list_container.drop_delta_cache_with_wt()
+        self.file_list_container.invalidate_caches()
         self.replace = {}
         self.load()
 
@@ -412,8 +435,13 @@ class LogWindow(QBzrWindow):
         gv = self.log_list.log_model.graph_viz
         role = self.searchType.itemData(self.searchType.currentIndex())
         search_text = str(self.search_edit.text())
+        if role != self.FilterContentRole or search_text == "":
+            self.log_list.set_content_search(None)
         if search_text == "":
             self.log_list.set_search(None, None)
+        elif role == self.FilterContentRole:
+            self.log_list.set_search(None, None)
+            self.log_list.set_content_search(search_text)
         elif role == self.FilterIdRole:
             self.log_list.set_search(None, None)
             self.log_list.select_revid(search_text)
@@ -442,6 +470,8 @@ class LogWindow(QBzrWindow):
             else:
                 raise Exception("Not done")
 
+            if field != "index" and is_query(search_text):
+                field = "query"
             self.log_list.set_search(search_text, field)
 
         self.log_list.scrollTo(self.log_list.currentIndex())
@@ -496,8 +526,67 @@ class LogWindow(QBzrWindow):
             return ", ".join(title_for_location(location) for location in locations)
 
 
+class DeltaPrefetchWorker(threading.Thread):
+    """Thread that works out the deltas of the revisions next to the
+    selected one, so that they are shown straight away when they are
+    selected.
+
+    Like the revision loader, it opens its own instances of the
+    repositories, because they are not thread safe.
+    """
+
+    def __init__(self, container, jobs):
+        threading.Thread.__init__(self, name="qbrz delta prefetch")
+        self.daemon = True
+        self.container = container
+        self.jobs = jobs
+        """List of (repo url, (revid, compared to revid)), nearest to the
+        selection first."""
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        jobs_by_url = {}
+        for url, key in self.jobs:
+            jobs_by_url.setdefault(url, []).append(key)
+        try:
+            for url, keys in jobs_by_url.items():
+                if self.cancelled:
+                    return
+                repo = _mod_repository.Repository.open(url)
+                with repo.lock_read():
+                    revisions = repo.get_revisions([key[0] for key in keys])
+                    # The deltas compared to left hand parents are loaded
+                    # together, and any others from the trees.
+                    revisions = [rev for rev, key in zip(revisions, keys)
+                                 if revision_delta_key(rev) == key]
+                    for key, delta in iter_revision_deltas(repo, revisions):
+                        if self.cancelled:
+                            return
+                        self.container.deltaPrefetched.emit(self, key, delta)
+                    done = set(revision_delta_key(rev) for rev in revisions)
+                    for key in keys:
+                        if key in done:
+                            continue
+                        delta = repo.revision_tree(key[0]).changes_from(
+                            repo.revision_tree(key[1]))
+                        if self.cancelled:
+                            return
+                        self.container.deltaPrefetched.emit(self, key, delta)
+        except Exception as e:
+            trace.mutter("qbrz: delta prefetch failed: %s", e)
+
+
 class FileListContainer(QtWidgets.QWidget):
 
+    deltaPrefetched = QtCore.pyqtSignal(object, object, object)
+
+    prefetch_rows = 3
+    """Number of rows before and after the selected row to work out the
+    deltas of in the background."""
+
     def __init__(self, log_list, parent=None):
         QtWidgets.QWidget.__init__(self, parent)
 
@@ -536,8 +625,10 @@ class FileListContainer(QtWidgets.QWidget):
         self.delta_load_timer.timeout.connect(self.load_delta)
         self.current_revids = None
 
-        self.tree_cache = {}
-        self.delta_cache = {}
+        self.delta_prefetcher = None
+        self.prefetch_caches = {}
+        """The caches to put the deltas that delta_prefetcher finds in."""
+        self.deltaPrefetched.connect(self.on_delta_prefetched)
 
     def processEvents(self):
         self.window().processEvents()
@@ -545,6 +636,7 @@ class FileListContainer(QtWidgets.QWidget):
     def revision_selection_changed(self, selected, deselected):
         revids, count = self.log_list.get_selection_top_and_parent_revids_and_count()
         if revids != self.current_revids:
+            self.cancel_prefetch()
             self.file_list.clear()
             self.current_revids = None
             self.delta_load_timer.start(200)
@@ -557,7 +649,6 @@ class FileListContainer(QtWidgets.QWidget):
             return
 
         graph_viz = self.log_list.log_model.graph_viz
-        is_working_tree_graph_viz = isinstance(graph_viz, logmodel.WithWorkingTreeGraphVizLoader)
         if self.log_list.log_model.file_id_filter:
             specific_file_ids = self.log_list.log_model.file_id_filter.file_ids
         else:
@@ -566,14 +657,23 @@ class FileListContainer(QtWidgets.QWidget):
         if not revids or revids == (None, None):
             return
 
-        if revids not in self.delta_cache:
+        try:
+            repos = [graph_viz.get_revid_branch(revid).repository for revid in revids]
+        except GhostRevisionError:
+            repos = None
+            delta_cache = {}
+        else:
+            # The caches are shared with the other logs of the repository.
+            caches = get_file_list_caches(repos[0])
+            tree_cache = caches.trees
+            delta_cache = caches.deltas
+
+        if revids not in delta_cache:
             self.throbber.show()
             try:
-                repos = [graph_viz.get_revid_branch(revid).repository for revid in revids]
-            except GhostRevisionError:
-                delta = None
-            else:
-                if repos[0].__class__.__name__ == 'SvnRepository' or repos[1].__class__.__name__ == 'SvnRepository':
+                if repos is None:
+                    delta = None
+                elif repos[0].__class__.__name__ == 'SvnRepository' or repos[1].__class__.__name__ == 'SvnRepository':
                     # Loading trees from a remote svn repo is unusably slow.
                     # See https://bugs.launchpad.net/qbrz/+bug/450225
                     # If only 1 revision is selected, use a optimized svn method
@@ -584,33 +684,17 @@ class FileListContainer(QtWidgets.QWidget):
                     else:
                         delta = None
                 else:
-                    if len(repos) == 2 and repos[0].base == repos[1].base:
-                        # Both revids are from the same repository. Load together.
-                        repos_revids = [(repos[0], revids)]
-                    else:
-                        repos_revids = [(repo, [revid]) for revid, repo in zip(revids, repos)]
-
-                    for repo, repo_revids in repos_revids:
-                        repo_revids = [revid for revid in repo_revids if revid not in self.tree_cache]
-                        if repo_revids:
-                            with repo.lock_read():
-                                self.processEvents()
-                                for revid in repo_revids:
-                                    if revid.startswith(CURRENT_REVISION) and is_working_tree_graph_viz:
-                                        tree = graph_viz.working_trees[revid]
-                                    else:
-                                        tree = repo.revision_tree(revid)
-                                    self.tree_cache[revid] = tree
-                                self.processEvents()
-                        self.processEvents()
-
-                    delta = self.tree_cache[revids[0]].changes_from(self.tree_cache[revids[1]])
-                self.delta_cache[revids] = delta
+                    delta = None
+                    if count == 1 and repos[0].base == repos[1].base:
+                        delta = self.load_revision_delta(graph_viz, repos[0], revids)
+                    if delta is None:
+                        delta = self.load_tree_delta(graph_viz, repos, revids, tree_cache)
+                delta_cache[revids] = delta
             finally:
                 self.throbber.hide()
                 self.processEvents()
         else:
-            delta = self.delta_cache[revids]
+            delta = delta_cache[revids]
 
         new_revids, count = self.log_list.get_selection_top_and_parent_revids_and_count()
 
@@ -704,14 +788,136 @@ class FileListContainer(QtWidgets.QWidget):
                     item.setFont(f)
             self.current_revids = revids
 
-    def drop_delta_cache_with_wt(self):
+        if count == 1:
+            self.prefetch_deltas()
+
+    def load_revision_delta(self, graph_viz, repo, revids):
+        """Load the delta of a revision compared to its left hand parent
+        with the revision delta API of the repository, without keeping the
+        trees. Return None if revids is not a revision and its left hand
+        parent."""
+        revid = revids[0]
+        if revid.startswith(CURRENT_REVISION):
+            return None
+        rev = graph_viz.load_revisions([revid]).get(revid)
+        if rev is None or revision_delta_key(rev) != revids:
+            return None
+        with repo.lock_read():
+            self.processEvents()
+            try:
+                for key, delta in iter_revision_deltas(repo, [rev]):
+                    return delta
+            except (errors.NoSuchRevision, errors.RevisionNotPresent) as e:
+                trace.mutter("qbrz: loading the delta of %s failed: %s",
+                             revid, e)
+        return None
+
+    def load_tree_delta(self, graph_viz, repos, revids, tree_cache):
+        """Load the delta between two revisions by comparing their trees,
+        which are kept in tree_cache."""
+        is_working_tree_graph_viz = isinstance(graph_viz, logmodel.WithWorkingTreeGraphVizLoader)
+        if len(repos) == 2 and repos[0].base == repos[1].base:
+            # Both revids are from the same repository. Load together.
+            repos_revids = [(repos[0], revids)]
+        else:
+            repos_revids = [(repo, [revid]) for revid, repo in zip(revids, repos)]
+
+        # Trees are kept here as well as in the cache, as the
+        # cache may evict one while the other is loaded.
+        trees = {}
+        for repo, repo_revids in repos_revids:
+            for revid in repo_revids:
+                if revid.startswith(CURRENT_REVISION) and is_working_tree_graph_viz:
+                    trees[revid] = graph_viz.working_trees[revid]
+                else:
+                    tree = tree_cache.get(revid)
+                    if tree is not None:
+                        trees[revid] = tree
+            repo_revids = [revid for revid in repo_revids if revid not in trees]
+            if repo_revids:
+                with repo.lock_read():
+                    self.processEvents()
+                    for revid in repo_revids:
+                        tree = repo.revision_tree(revid)
+                        tree_cache[revid] = tree
+                        trees[revid] = tree
+                    self.processEvents()
+            self.processEvents()
+
+        delta = trees[revids[0]].changes_from(trees[revids[1]])
+        # Comparing the trees loads more of their inventories.
+        for revid in trees:
+            tree_cache.resize(revid)
+        return delta
+
+    def cancel_prefetch(self):
+        if self.delta_prefetcher is not None:
+            self.delta_prefetcher.cancel()
+            self.delta_prefetcher = None
+            self.prefetch_caches = {}
+
+    def prefetch_deltas(self):
+        """Start working out the deltas of the rows around the selected
+        row on a worker thread, nearest first.
+
+        This is only done once the delta of the selected row is shown, so it
+        does not hold it up, and it stops when the selection changes."""
+        self.cancel_prefetch()
+        current = self.log_list.currentIndex()
+        if not current.isValid():
+            return
+        model = self.log_list.model()
+        graph_viz = self.log_list.log_model.graph_viz
+        jobs = []
+        prefetch_caches = {}
+        for offset in range(1, self.prefetch_rows + 1):
+            for row in (current.row() + offset, current.row() - offset):
+                index = model.index(row, 0, current.parent())
+                if not index.isValid():
+                    continue
+                key, count = self.log_list.get_selection_top_and_parent_revids_and_count(index)
+                if key in prefetch_caches or any(
+                        revid is None or revid.startswith(CURRENT_REVISION)
+                        for revid in key):
+                    continue
+                try:
+                    repos = [graph_viz.get_revid_branch(revid).repository for revid in key]
+                except GhostRevisionError:
+                    continue
+                if (repos[0].base != repos[1].base or
+                        repos[0].__class__.__name__ == 'SvnRepository'):
+                    continue
+                caches = get_file_list_caches(repos[0])
+                if key in caches.deltas:
+                    continue
+                prefetch_caches[key] = caches
+                jobs.append((repos[0].user_url, key))
+        if jobs:
+            self.prefetch_caches = prefetch_caches
+            self.delta_prefetcher = DeltaPrefetchWorker(self, jobs)
+            self.delta_prefetcher.start()
+
+    def on_delta_prefetched(self, worker, key, delta):
+        if worker is not self.delta_prefetcher:
+            return
+        caches = self.prefetch_caches.get(key)
+        if caches is not None and key not in caches.deltas:
+            caches.deltas[key] = delta
+
+    def invalidate_caches(self, revids=None):
+        """Remove the cached trees and deltas of revids from the caches of
+        the repositories of the log, or the deltas of the working trees if
+        revids is None, e.g. when the log is refreshed."""
         gv = self.log_list.log_model.graph_viz
-        if not isinstance(gv, logmodel.WithWorkingTreeGraphVizLoader):
+        if revids is None and not isinstance(gv, logmodel.WithWorkingTreeGraphVizLoader):
             return
-        cache = self.delta_cache
-        keys = [k for k in cache.keys() if k[0].startswith(CURRENT_REVISION)]
-        for key in keys:
-            del(cache[key])
+        for repo in gv.repos:
+            caches = get_file_list_caches(repo)
+            if revids is None:
+                caches.invalidate_working_trees()
+            else:
+                caches.invalidate_revids(revids)
+        self.current_revids = None
 
     def show_file_list_context_menu(self, pos):
         (top_revid, old_revid), count = self.log_list.get_selection_top_and_parent_revids_and_count()
@@ -33,11 +33,21 @@ Usage example
 
 """
 
-import gc
-from functools import reduce
-
-
-from breezy import errors
+import concurrent.futures
+import hashlib
+import heapq
+import itertools
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+from breezy import errors, osutils, trace
 from breezy.controldir import ControlDir
 from breezy.transport.local import LocalTransport
 from breezy.revision import NULL_REVISION, CURRENT_REVISION
@@ -67,41 +77,165 @@ class BranchInfo(object):
         return False
 
 
+class RevisionStore(object):
+    """
+    Column store for the data of the revisions in a graph that gets
+    calculated when the graph is loaded.
+
+    Rather than having a few python objects for each revision (the merge_sort
+    node, its revno tuple, a branch_id tuple, a list for merges, ...), the
+    data is held in typed arrays, indexed by the revision index. Branch ids
+    are interned, and each revision only stores a reference to its branch
+    id. RevisionData instances are light weight views on to the store.
+    """
+
+    __slots__ = ["revids", "branch_refs", "revnos", "merge_depths",
+                 "end_of_merges", "merged_by", "merges",
+                 "branch_ids", "branch_id_refs", "colors", "branch_lines"]
+
+    def __init__(self):
+        self.revids = []
+        self.branch_refs = array("I")
+        """Index in to branch_ids of the branch_id of each revision."""
+        self.revnos = array("I")
+        """Least significant digit of the revno of each revision."""
+        self.merge_depths = array("I")
+        self.end_of_merges = bytearray()
+        self.merged_by = array("i")
+        """Revision index that merges each revision, or -1."""
+        self.merges = {}
+        """Dict of revision index to list of revision indexes that it merges.
+        Only revisions that merge something have an entry."""
+
+        self.branch_ids = []
+        self.branch_id_refs = {}
+        self.colors = []
+        self.branch_lines = []
+        """BranchLine for each branch_id, or None if the branch lines have
+        not been computed."""
+
+    def __len__(self):
+        return len(self.revids)
+
+    def branch_id_ref(self, branch_id):
+        ref = self.branch_id_refs.get(branch_id)
+        if ref is None:
+            ref = len(self.branch_ids)
+            self.branch_id_refs[branch_id] = ref
+            self.branch_ids.append(branch_id)
+            self.colors.append(sum(branch_id))
+            self.branch_lines.append(None)
+        return ref
+
+    def extend(self, nodes):
+        """Append revisions.
+
+        :param nodes: iterable of (revid, revno, merge_depth, end_of_merge).
+        """
+        revids = self.revids
+        branch_refs = self.branch_refs
+        revnos = self.revnos
+        merge_depths = self.merge_depths
+        end_of_merges = self.end_of_merges
+        branch_id_refs = self.branch_id_refs
+        start = len(revids)
+        for revid, revno, merge_depth, end_of_merge in nodes:
+            revids.append(revid)
+            branch_id = revno[:-1]
+            ref = branch_id_refs.get(branch_id)
+            if ref is None:
+                ref = self.branch_id_ref(branch_id)
+            branch_refs.append(ref)
+            revnos.append(revno[-1])
+            merge_depths.append(merge_depth)
+            end_of_merges.append(end_of_merge and 1 or 0)
+        self.merged_by.extend([-1] * (len(revids) - start))
+
+    def prepend(self, nodes):
+        """Insert revisions before all the existing revisions. The indexes
+        of the existing revisions are shifted by the number of revisions
+        inserted.
+
+        :param nodes: iterable of (revid, revno, merge_depth, end_of_merge).
+        :return: The number of revisions inserted.
+        """
+        new = RevisionStore()
+        new.branch_ids = self.branch_ids
+        new.branch_id_refs = self.branch_id_refs
+        new.colors = self.colors
+        new.branch_lines = self.branch_lines
+        new.extend(nodes)
+        count = len(new)
+
+        self.revids[0:0] = new.revids
+        self.branch_refs[0:0] = new.branch_refs
+        self.revnos[0:0] = new.revnos
+        self.merge_depths[0:0] = new.merge_depths
+        self.end_of_merges[0:0] = new.end_of_merges
+        self.merged_by = new.merged_by + array(
+            "i", [merged_by + count if merged_by >= 0 else -1
+                  for merged_by in self.merged_by])
+        self.merges = dict(
+            (index + count, [merged + count for merged in merges])
+            for index, merges in self.merges.items())
+        return count
+
+
 class RevisionData(object):
     """
-    Container for data for a revision in the graph that gets calculated
-    when the graph is loaded.
+    View of the data for a revision in the graph that gets calculated when
+    the graph is loaded. The data is held in a RevisionStore.
     """
 
     # Instance of this object are typically named "rev".
 
-    __slots__ = ["index", "_merge_sort_node", "branch", "_revno_str",
-                 "merges", "merged_by", 'branch_id', 'color']
+    __slots__ = ["index", "_store"]
 
-    def __init__(self, index, merge_sort_node):
+    def __init__(self, index, store):
         """Create a new RevisionData instance."""
         self.index = index
-        self._merge_sort_node = merge_sort_node
-        self.branch = None
-        self._revno_str = None
-        self.merges = []
-        """Revision indexes that this revision merges"""
-        self.merged_by = None
-        """Revision index that merges this revision."""
-        self.branch_id = self._merge_sort_node.revno[0:-1]
-        self.color = reduce(lambda x, y: x + y, self.branch_id, 0)
-
-    revid = property(lambda self: self._merge_sort_node.key)
-    merge_depth = property(lambda self: self._merge_sort_node.merge_depth)
-    revno_sequence = property(lambda self: self._merge_sort_node.revno)
-    end_of_merge = property(lambda self: self._merge_sort_node.end_of_merge)
+        self._store = store
+
+    revid = property(lambda self: self._store.revids[self.index])
+    merge_depth = property(lambda self: self._store.merge_depths[self.index])
+    end_of_merge = property(
+        lambda self: bool(self._store.end_of_merges[self.index]))
+
+    branch_id = property(lambda self: self._store.branch_ids[
+        self._store.branch_refs[self.index]])
+    color = property(lambda self: self._store.colors[
+        self._store.branch_refs[self.index]])
+    branch = property(lambda self: self._store.branch_lines[
+        self._store.branch_refs[self.index]])
+    """BranchLine that this revision is in."""
+
+    @property
+    def revno_sequence(self):
+        store = self._store
+        return (store.branch_ids[store.branch_refs[self.index]] +
+                (store.revnos[self.index],))
+
+    def get_merged_by(self):
+        merged_by = self._store.merged_by[self.index]
+        if merged_by < 0:
+            return None
+        return merged_by
+
+    def set_merged_by(self, merged_by):
+        if merged_by is None:
+            merged_by = -1
+        self._store.merged_by[self.index] = merged_by
+    merged_by = property(get_merged_by, set_merged_by)
+    """Revision index that merges this revision."""
+
+    merges = property(lambda self: self._store.merges.get(self.index, ()))
+    """Revision indexes that this revision merges"""
 
     def get_revno_str(self):
-        if self._revno_str is None:
-            self._revno_str = ".".join(["%d" % revno for revno in self.revno_sequence])
-            if self.revid.startswith(CURRENT_REVISION):
-                self._revno_str += " ?"
-        return self._revno_str
+        revno_str = ".".join(["%d" % revno for revno in self.revno_sequence])
+        if self.revid.startswith(CURRENT_REVISION):
+            revno_str += " ?"
+        return revno_str
     revno_str = property(get_revno_str)
 
     def __repr__(self):
@@ -124,6 +258,334 @@ class BranchLine(object):
         return "%s <%s>" % (self.__class__.__name__, self.branch_id)
 
 
+class AncestryIndex(object):
+    """Answers ancestry queries for the loaded revisions, without walking the
+    repository graph.
+
+    Revisions are identified by their index in the merge sorted revisions.
+    As merge_sort puts children before their parents, a revision can only be
+    an ancestor of revisions with a smaller index.
+
+    A depth first walk from the heads labels each revision with the range of
+    pre-order numbers of the revisions below it in the walk's spanning tree.
+    If a revision's number is within that range of another revision, it is
+    an ancestor of it. Otherwise, the ancestry may still be through a
+    cross edge of the spanning tree, so the parents are searched, skipping
+    revisions that have a greater index than the ancestor being looked for.
+    """
+
+    __slots__ = ["revid_index", "revids", "parent_offsets", "parent_refs",
+                 "pre", "end"]
+
+    def __init__(self, revids, get_parent_keys):
+        """Create a new index.
+
+        :param revids: Merge sorted list of revids.
+        :param get_parent_keys: callable that returns the parents of a revid.
+        """
+        self.revids = revids
+        self.revid_index = revid_index = dict(
+            (revid, index) for index, revid in enumerate(revids))
+
+        # The parents of revision i are
+        # parent_refs[parent_offsets[i]:parent_offsets[i + 1]]
+        parent_offsets = array("I", [0])
+        parent_refs = array("I")
+        for revid in revids:
+            parent_refs.extend([revid_index[parent]
+                                for parent in get_parent_keys(revid)])
+            parent_offsets.append(len(parent_refs))
+        self.parent_offsets = parent_offsets
+        self.parent_refs = parent_refs
+
+        count = len(revids)
+        pre = array("i", [-1]) * count
+        end = array("i", [-1]) * count
+        number = 0
+        # Revisions that have not been reached when we get to them in merge
+        # sort order have no children, so they are the roots of the walk.
+        for root in range(count):
+            if pre[root] != -1:
+                continue
+            pre[root] = number
+            number += 1
+            stack = [[root, parent_offsets[root]]]
+            while stack:
+                item = stack[-1]
+                index, offset = item
+                if offset < parent_offsets[index + 1]:
+                    item[1] = offset + 1
+                    parent = parent_refs[offset]
+                    if pre[parent] == -1:
+                        pre[parent] = number
+                        number += 1
+                        stack.append([parent, parent_offsets[parent]])
+                else:
+                    end[index] = number - 1
+                    stack.pop()
+        self.pre = pre
+        self.end = end
+
+    def __contains__(self, revid):
+        return revid in self.revid_index
+
+    def is_ancestor(self, ancestor_revid, revid):
+        """Test if ancestor_revid is an ancestor of, or the same as, revid."""
+        ancestor = self.revid_index[ancestor_revid]
+        index = self.revid_index[revid]
+        if ancestor == index:
+            return True
+        if ancestor < index:
+            return False
+
+        pre = self.pre
+        end = self.end
+        parent_offsets = self.parent_offsets
+        parent_refs = self.parent_refs
+        ancestor_pre = pre[ancestor]
+        pending = [index]
+        seen = set(pending)
+        while pending:
+            index = pending.pop()
+            if pre[index] <= ancestor_pre <= end[index]:
+                return True
+            for parent in parent_refs[parent_offsets[index]:parent_offsets[index + 1]]:
+                if parent <= ancestor and parent not in seen:
+                    if parent == ancestor:
+                        return True
+                    seen.add(parent)
+                    pending.append(parent)
+        return False
+
+    def unique_ancestors(self, revid, other_revids):
+        """Find the ancestors of revid, including revid, that are not
+        ancestors of other_revids.
+
+        Revisions are visited in merge sort order, so the descendants of a
+        revision that are reachable from revid or other_revids have all been
+        visited before it. The walk stops when there are no pending revisions
+        that are only reachable from revid.
+
+        :return: list of revids, in merge sort order.
+        """
+        HEAD = 1
+        OTHER = 2
+        parent_offsets = self.parent_offsets
+        parent_refs = self.parent_refs
+        flags = {}
+        pending = []
+        # Number of revisions in pending that are only reachable from revid.
+        head_only = [0]
+
+        def add(index, flag):
+            old_flag = flags.get(index, 0)
+            new_flag = old_flag | flag
+            if new_flag != old_flag:
+                if old_flag == 0:
+                    heapq.heappush(pending, index)
+                elif old_flag == HEAD:
+                    head_only[0] -= 1
+                if new_flag == HEAD:
+                    head_only[0] += 1
+                flags[index] = new_flag
+
+        add(self.revid_index[revid], HEAD)
+        for other_revid in other_revids:
+            add(self.revid_index[other_revid], OTHER)
+
+        unique = []
+        while head_only[0]:
+            index = heapq.heappop(pending)
+            flag = flags[index]
+            if flag == HEAD:
+                head_only[0] -= 1
+                unique.append(self.revids[index])
+            for parent in parent_refs[parent_offsets[index]:parent_offsets[index + 1]]:
+                add(parent, flag)
+        return unique
+
+    def head_masks(self, head_revids):
+        """Find which heads each revision is reachable from, in one pass.
+
+        Bit i of a mask is set if the revision is head_revids[i], or an
+        ancestor of it. As merge sort puts children before their parents,
+        the mask of a revision is complete when we get to it, and can be
+        passed on to its parents.
+
+        :return: list of masks, one for each revision, in merge sort order.
+        """
+        masks = [0] * len(self.revids)
+        start = len(self.revids)
+        for bit, revid in enumerate(head_revids):
+            index = self.revid_index[revid]
+            masks[index] |= 1 << bit
+            start = min(start, index)
+
+        parent_offsets = self.parent_offsets
+        parent_refs = self.parent_refs
+        for index in range(start, len(masks)):
+            mask = masks[index]
+            if mask:
+                for parent in parent_refs[parent_offsets[index]:parent_offsets[index + 1]]:
+                    masks[parent] |= mask
+        return masks
+
+
+class MergeSortCache(object):
+    """Persistent on disk cache of the merge sorted revisions of a graph.
+
+    There is one cache file per repository identity. The file holds the
+    merge sorted revisions (revid, revno, merge_depth, end_of_merge and
+    parents) and the ghosts for one set of heads. If the heads change, or a
+    ghost is no longer a ghost, the cache misses, and the file is replaced
+    the next time the graph is saved.
+
+    The file is made up of a header, followed by arrays of unsigned 32 bit
+    ints, followed by all the revids concatenated. It is mmapped on load.
+    """
+
+    magic = b"qbrz-mergesort1\n"
+    header = struct.Struct("=16s20s6I")
+    """magic, key digest, revision count, revno parts count, parent refs
+    count, ghost count, revid bytes count, flags (unused)"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def _filename(self, name):
+        return osutils.pathjoin(self.cache_dir, name)
+
+    def load(self, name, digest):
+        """Load the cached merge sorted revisions.
+
+        :return: None if there is no valid cache for digest, else a tuple of
+            (revids, revnos, merge_depths, end_of_merges, parents, ghosts).
+            parents is a list of tuples of revids.
+        """
+        try:
+            f = open(self._filename(name), "rb")
+        except (IOError, OSError):
+            return None
+        try:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                # Empty file, or mmap not supported.
+                return None
+            try:
+                return self._read(mm, digest)
+            finally:
+                mm.close()
+        finally:
+            f.close()
+
+    def _read(self, mm, digest):
+        if len(mm) < self.header.size:
+            return None
+        (magic, file_digest, rev_count, revno_part_count, parent_ref_count,
+         ghost_count, revids_size, flags) = self.header.unpack_from(mm, 0)
+        if magic != self.magic or file_digest != digest:
+            return None
+
+        array_lengths = (rev_count + 1,     # revid offsets
+                         rev_count + 1,     # revno offsets
+                         revno_part_count,  # revno parts
+                         rev_count,         # merge depths
+                         rev_count,         # end of merges
+                         rev_count + 1,     # parent offsets
+                         parent_ref_count,  # parent refs
+                         ghost_count)       # ghosts
+        expected_size = self.header.size + 4 * sum(array_lengths) + revids_size
+        if len(mm) != expected_size:
+            return None
+
+        view = memoryview(mm)
+        try:
+            offset = self.header.size
+            arrays = []
+            for length in array_lengths:
+                arrays.append(view[offset:offset + 4 * length].cast("I").tolist())
+                offset += 4 * length
+            revids_blob = bytes(view[offset:offset + revids_size])
+        finally:
+            view.release()
+
+        (revid_offsets, revno_offsets, revno_parts, merge_depths,
+         end_of_merges, parent_offsets, parent_refs, ghost_indexes) = arrays
+
+        revids = [revids_blob[revid_offsets[i]:revid_offsets[i + 1]]
+                  for i in range(rev_count)]
+        revnos = [tuple(revno_parts[revno_offsets[i]:revno_offsets[i + 1]])
+                  for i in range(rev_count)]
+        parents = [tuple([revids[ref] for ref in
+                          parent_refs[parent_offsets[i]:parent_offsets[i + 1]]])
+                   for i in range(rev_count)]
+        end_of_merges = [bool(eom) for eom in end_of_merges]
+        ghosts = set(revids[i] for i in ghost_indexes)
+        return revids, revnos, merge_depths, end_of_merges, parents, ghosts
+
+    def save(self, name, digest, revisions, get_parent_keys, ghosts):
+        """Save merge sorted revisions.
+
+        :param revisions: list of RevisionData.
+        :param get_parent_keys: callable that returns the parents of a revid.
+        """
+        revid_index = {}
+        for rev in revisions:
+            if not isinstance(rev.revid, bytes):
+                # Only real revisions can be cached.
+                return
+            revid_index[rev.revid] = rev.index
+
+        revid_offsets = array("I", [0])
+        revno_offsets = array("I", [0])
+        revno_parts = array("I")
+        merge_depths = array("I")
+        end_of_merges = array("I")
+        parent_offsets = array("I", [0])
+        parent_refs = array("I")
+        revids = []
+        revids_size = 0
+        try:
+            for rev in revisions:
+                revids.append(rev.revid)
+                revids_size += len(rev.revid)
+                revid_offsets.append(revids_size)
+                revno_parts.extend(rev.revno_sequence)
+                revno_offsets.append(len(revno_parts))
+                merge_depths.append(rev.merge_depth)
+                end_of_merges.append(bool(rev.end_of_merge))
+                parent_refs.extend([revid_index[parent]
+                                    for parent in get_parent_keys(rev.revid)])
+                parent_offsets.append(len(parent_refs))
+            ghost_indexes = array("I", sorted(revid_index[ghost] for ghost in ghosts))
+        except (KeyError, OverflowError):
+            # A parent that is not in the graph, or a revno that does not fit.
+            return
+
+        header = self.header.pack(
+            self.magic, digest, len(revisions), len(revno_parts),
+            len(parent_refs), len(ghost_indexes), revids_size, 0)
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            fd, tmp_filename = tempfile.mkstemp(dir=self.cache_dir)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(header)
+                    for a in (revid_offsets, revno_offsets, revno_parts,
+                              merge_depths, end_of_merges, parent_offsets,
+                              parent_refs, ghost_indexes):
+                        a.tofile(f)
+                    f.write(b"".join(revids))
+                os.replace(tmp_filename, self._filename(name))
+            except:
+                os.unlink(tmp_filename)
+                raise
+        except (IOError, OSError) as e:
+            trace.mutter("qbrz: could not save merge sort cache: %s", e)
+
+
 class GhostRevisionError(errors.InternalBzrError):
 
     _fmt = "{%(revision_id)s} is a ghost."
@@ -151,12 +613,35 @@ class GraphVizLoader(object):
     # revisions is filtered_revs. Revision indexes in this list are called
     # f_index.
 
+    cache_merge_sort = True
+    """If the merge sorted revisions may be stored in merge_sort_cache."""
+
     def __init__(self, branches, primary_bi, no_graph):
         self.branches = branches
         """List of BranchInfo for each branch."""
         self.primary_bi = primary_bi
         self.no_graph = no_graph
 
+        self.merge_sort_cache = None
+        """MergeSortCache used to avoid walking the graph, if not None."""
+        self.graph_extra_parents = {}
+
+        self.limit = None
+        """If not None, only this many revisions of the mainline, and the
+        revisions that they merge, are loaded."""
+        self.since = None
+        """If not None, only the mainline revisions committed after this
+        timestamp, and the revisions that they merge, are loaded."""
+        self.truncated_revid = None
+        """The newest mainline revision that was not loaded because of limit
+        or since, or None if the whole history was loaded."""
+        self.truncated_revids = set()
+        """The parents of the loaded revisions that were not loaded because
+        of limit or since. These are only used to merge sort the revisions."""
+        self.revno_offset = 0
+        """Added to the mainline revnos from merge_sort, which count from
+        truncated_revid when only a window of the history is loaded."""
+
         self.repos = []
         self.local_repo_copies = []
         """A list of repositories that revisions will be attempted to be loaded from first."""
@@ -174,17 +659,196 @@ class GraphVizLoader(object):
 
         self.ghosts = set()
 
+        self.store = RevisionStore()
+        """RevisionStore that holds the data for revisions."""
+
         self.revisions = []
-        """List of RevisionInfo from merge_sort."""
+        """List of RevisionData from merge_sort."""
 
         self.revid_rev = {}
+        self._revno_rev = None
+        self._ancestry_index = None
         self.graph_children = {}
 
         self.tags = {}      # map revid -> tags set
 
     def load(self):
+        self.load_repos()
+
+        self.lock_read_branches()
+        try:
+            head_revids, graph_parents = self.load_graph_parents()
+            if not self.load_merge_sort_cache(head_revids):
+                self.process_graph_parents(head_revids, graph_parents)
+                self.save_merge_sort_cache(head_revids)
+
+            self.compute_head_info()
+            del self.graph
+
+            if not self.no_graph:
+                self.compute_branch_lines()
+                self.compute_merge_info()
+
+            self.load_tags()
+        finally:
+            self.unlock_branches()
+
+    def update(self):
+        """Update a loaded graph after the branch tip has advanced.
+
+        Only the ancestry of the new head down to the previously loaded head
+        is walked from the repository. The whole graph is still merge sorted
+        and the head info is recomputed, but if the existing revisions sort
+        the same as before, their RevisionData and branch lines are kept,
+        and only the new revisions are spliced in to revisions, revid_rev,
+        revno_rev and branch_lines.
+
+        This only works when there is one head, and the previous head is in
+        the left hand ancestry of the new head, because then the revnos of
+        the revisions that were already loaded don't change.
+
+        :return: True if the graph was updated. False if the graph can't be
+            updated incrementally, in which case a new loader must be loaded.
+        """
+        if (len(self.revid_head_info) != 1 or not self.revisions or
+                self.truncated_revid is not None):
+            return False
+        old_head_revid = self.revisions[0].revid
+        old_revid_head_info = self.revid_head_info
+        old_revid_branch_info = self.revid_branch_info
+
+        self.load_repos()
+        self.lock_read_branches()
+        try:
+            self.revid_head_info = {}
+            head_revids, graph_parents = self.load_graph_parents()
+            new_graph_parents = None
+            if (len(head_revids) == 1 and len(self.revid_head_info) == 1 and
+                    not self.graph_extra_parents):
+                new_graph_parents = self.load_new_graph_parents(
+                    head_revids[0], old_head_revid)
+
+            if new_graph_parents is None or not self.splice_new_revisions(
+                    head_revids[0], new_graph_parents):
+                self.revid_head_info = old_revid_head_info
+                self.revid_branch_info = old_revid_branch_info
+                del self.graph
+                return False
+
+            self.compute_head_info()
+            del self.graph
+            self.save_merge_sort_cache(head_revids)
+            self.load_tags()
+        finally:
+            self.unlock_branches()
+        return True
+
+    def load_new_graph_parents(self, head_revid, old_head_revid):
+        """Load the parents of the revisions that are ancestors of head_revid,
+        but are not loaded yet.
+
+        :return: list of (revid, parents) with parents before their children,
+            or None if old_head_revid is not in the left hand ancestry of
+            head_revid, or if there are ghosts in the new revisions.
+        """
+        graph_parents = {}
+        new_revids = []
+        pending = set()
+        if head_revid not in self.revid_rev:
+            pending.add(head_revid)
+        while pending:
+            parent_map = self.graph.get_parent_map(pending)
+            next_pending = set()
+            for revid in pending:
+                parent_revids = parent_map.get(revid)
+                if parent_revids is None:
+                    # Ghost. Let load deal with it.
+                    return None
+                if parent_revids == (NULL_REVISION,):
+                    parent_revids = ()
+                graph_parents[revid] = parent_revids
+                new_revids.append(revid)
+                for parent_revid in parent_revids:
+                    if parent_revid in self.ghosts:
+                        # This ghost may have been filled in.
+                        return None
+                    if (parent_revid not in self.revid_rev and
+                            parent_revid not in graph_parents):
+                        next_pending.add(parent_revid)
+            pending = next_pending
+            self.update_ui()
+
+        # The revnos of the loaded revisions only stay the same if the
+        # previous head is in the left hand ancestry of the new head.
+        revid = head_revid
+        while revid in graph_parents:
+            if not graph_parents[revid]:
+                return None
+            revid = graph_parents[revid][0]
+        if revid != old_head_revid:
+            return None
+
+        new_revids.reverse()
+        return [(revid, graph_parents[revid]) for revid in new_revids]
+
+    def splice_new_revisions(self, head_revid, new_graph_parents):
+        if not new_graph_parents:
+            return True
+
+        for revid, parent_revids in new_graph_parents:
+            self.known_graph.add_node(revid, parent_revids)
+
+        # There is only one head, so sorting from it gives the same result as
+        # sorting from 'top:', less 'top:'.
+        merge_sorted_revisions = self.known_graph.merge_sort(head_revid)
+        new_count = len(new_graph_parents)
+        if len(merge_sorted_revisions) != new_count + len(self.revisions):
+            return False
+        # The existing rows, and everything computed from them, can only be
+        # kept if they sort exactly the same as before.
+        for node, rev in zip(merge_sorted_revisions[new_count:], self.revisions):
+            if (node.key != rev.revid or
+                    node.merge_depth != rev.merge_depth or
+                    node.revno != rev.revno_sequence):
+                return False
+
+        self.store.prepend(
+            (node.key, node.revno, node.merge_depth, node.end_of_merge)
+            for node in merge_sorted_revisions[:new_count])
+        new_revs = [RevisionData(index, self.store)
+                    for index in range(new_count)]
+        for rev in self.revisions:
+            rev.index += new_count
+        self.revisions = new_revs + self.revisions
+
+        for rev in new_revs:
+            self.max_mainline_revno = max(self.max_mainline_revno, rev.revno_sequence[0])
+            self.revid_rev[rev.revid] = rev
+        self._revno_rev = None
+        self._ancestry_index = None
+
+        if not self.no_graph:
+            self.splice_branch_lines(new_revs)
+
+            # compute_merge_info processes revisions from the top. The
+            # revisions that were already loaded would have been processed
+            # after the new revisions, so their merged_by wins.
+            old_parents_merged_by = []
+            for rev in new_revs:
+                for parent_revid in self.known_graph.get_parent_keys(rev.revid):
+                    parent = self.revid_rev[parent_revid]
+                    if parent.index >= new_count and parent.merged_by is not None:
+                        old_parents_merged_by.append((parent, parent.merged_by))
+            self.compute_merge_info(new_revs)
+            for parent, merged_by in old_parents_merged_by:
+                parent.merged_by = merged_by
+        return True
+
+    def load_repos(self):
         # Get a unique list of repositories. If the url is the same,
         # we consider it the same repositories
+        self.repos = []
+        self.local_repo_copies = []
         repo_urls = set()
         for bi in self.branches:
             repo = bi.branch.repository
@@ -200,22 +864,6 @@ class GraphVizLoader(object):
             self.load_current_dir_repo()
         self.repos.sort(key=lambda repo: not repo_is_local(repo))
 
-        self.lock_read_branches()
-        try:
-            head_revids, graph_parents = self.load_graph_parents()
-            self.process_graph_parents(head_revids, graph_parents)
-
-            self.compute_head_info()
-            del self.graph
-
-            if not self.no_graph:
-                self.compute_branch_lines()
-                self.compute_merge_info()
-
-            self.load_tags()
-        finally:
-            self.unlock_branches()
-
     def load_current_dir_repo(self):
         # There are no local repositories. Try open the repository
         # of the current directory, and try load revisions data from
@@ -240,6 +888,20 @@ class GraphVizLoader(object):
     def throbber_hide(self):
         pass
 
+    def throbber_message(self, message):
+        """Show what is being done while the throbber is shown, or the
+        default if message is None."""
+        pass
+
+    def get_file_changes_index(self, repo):
+        """Return the FileChangesIndex to use for repo, or None."""
+        return None
+
+    def get_file_id_process_pool(self):
+        """Return the pool of processes to load the revisions that change
+        directories with, or None to load them in this process."""
+        return None
+
     def lock_read_branches(self):
         for bi in self.branches:
             bi.branch.lock_read()
@@ -344,11 +1006,134 @@ class GraphVizLoader(object):
         load_heads = [revid for load_heads_, sort_heads_ in branches_heads for revid in load_heads_]
         sort_heads = [revid for load_heads_, sort_heads_ in branches_heads for revid in sort_heads_]
 
+        self.graph_extra_parents = extra_parents
         parents_providers = [repo._make_parents_provider() for repo in self.repos]
         parents_providers.append(DictParentsProvider(extra_parents))
         self.graph = Graph(StackedParentsProvider(parents_providers))
+
+        self.truncated_revid = None
+        self.truncated_revids = set()
+        self.revno_offset = 0
+        if sort_heads and (self.limit is not None or self.since is not None):
+            truncated_revid = self.find_truncated_revid(sort_heads[0])
+            if truncated_revid is not None:
+                return self.load_truncated_graph_parents(
+                    sort_heads, truncated_revid, parents_providers)
         return sort_heads, self.graph.iter_ancestry(sort_heads)
 
+    def find_truncated_revid(self, head_revid):
+        """Find the newest revision in the left hand ancestry of head_revid
+        that is outside of the window given by limit and since.
+
+        head_revid is always in the window, even if it is older than since,
+        so that there is something to show.
+
+        :return: revid, or None if the whole of the mainline is in the
+            window.
+        """
+        mainline = self.graph.iter_lefthand_ancestry(head_revid)
+        limit = self.limit
+        if limit is not None:
+            limit = max(limit, 1)
+            mainline = itertools.islice(mainline, limit + 1)
+        count = 0
+        try:
+            while True:
+                batch = [revid for revid in itertools.islice(mainline, 100)
+                         if revid != NULL_REVISION]
+                if not batch:
+                    return None
+                if limit is not None and count + len(batch) > limit:
+                    limit_index = limit - count
+                else:
+                    limit_index = None
+                if self.since is not None:
+                    revs = self.load_revisions(
+                        [revid for revid in batch[:limit_index]
+                         if not revid.startswith(CURRENT_REVISION)])
+                    for revid in batch[:limit_index]:
+                        if (revid in revs and revs[revid].timestamp < self.since
+                                and revid != head_revid):
+                            return revid
+                if limit_index is not None:
+                    return batch[limit_index]
+                count += len(batch)
+                self.update_ui()
+        except errors.RevisionNotPresent:
+            # There is a ghost in the mainline, so there is no more to load.
+            return None
+
+    def load_truncated_graph_parents(self, sort_heads, truncated_revid,
+                                     parents_providers):
+        """Load the parents of the revisions that are ancestors of sort_heads,
+        but not of truncated_revid.
+
+        The parents of the loaded revisions that are ancestors of
+        truncated_revid are returned with no parents, so that merge_sort
+        still knows which parent is the left hand parent, and are added to
+        truncated_revids. Revisions of branches that started before
+        truncated_revid get revnos like 0.1.1, as the mainline revno that
+        they are based on is not known.
+
+        :return: (sort_heads, list of (revid, parents)), where heads that
+            are ancestors of truncated_revid have been removed.
+        """
+        # Search from all the heads at once, from a revision that has them as
+        # parents.
+        top_revid = b"top:"
+        graph = Graph(StackedParentsProvider(
+            [DictParentsProvider({top_revid: tuple(sort_heads)})] +
+            parents_providers))
+        revids = graph.find_unique_ancestors(top_revid, [truncated_revid])
+        revids.discard(top_revid)
+        revids.discard(NULL_REVISION)
+
+        sort_heads = [revid for revid in sort_heads if revid in revids]
+        for revid in list(self.revid_head_info.keys()):
+            if revid not in revids:
+                del self.revid_head_info[revid]
+
+        self.truncated_revid = truncated_revid
+        self.revno_offset = self.get_mainline_revno(
+            sort_heads[0], truncated_revid) - 1
+
+        parent_map = self.graph.get_parent_map(revids)
+        graph_parents = []
+        truncated_revids = set()
+        for revid in revids:
+            parent_revids = parent_map.get(revid)
+            graph_parents.append((revid, parent_revids))
+            if parent_revids is not None:
+                truncated_revids.update(
+                    [parent_revid for parent_revid in parent_revids
+                     if parent_revid not in revids and parent_revid != NULL_REVISION])
+        graph_parents.extend([(revid, ()) for revid in truncated_revids])
+        self.truncated_revids = truncated_revids
+        return sort_heads, graph_parents
+
+    def get_mainline_revno(self, head_revid, revid):
+        """Get the revno of revid, which is in the left hand ancestry of
+        head_revid.
+
+        This is worked out from the primary branch's revno if its tip is
+        between head_revid and revid, otherwise the left hand ancestry of
+        revid is walked.
+        """
+        if self.primary_bi and self.primary_bi.branch:
+            tip_revno, tip_revid = self.primary_bi.branch.last_revision_info()
+            tip_index = None
+            for index, mainline_revid in enumerate(
+                    self.graph.iter_lefthand_ancestry(head_revid)):
+                if mainline_revid == tip_revid:
+                    tip_index = index
+                if mainline_revid == revid:
+                    if tip_index is not None:
+                        return tip_revno - (index - tip_index)
+                    break
+        return len([mainline_revid for mainline_revid
+                    in self.graph.iter_lefthand_ancestry(revid)
+                    if mainline_revid != NULL_REVISION])
+
     def process_graph_parents(self, head_revids, graph_parents_iter):
         graph_parents = {}
         self.ghosts = set()
@@ -369,64 +1154,165 @@ class GraphVizLoader(object):
 
         graph_parents["top:"] = head_revids
 
-        if len(graph_parents) > 0:
-            enabled = gc.isenabled()
-            if enabled:
-                gc.disable()
-
-            def make_kg():
-                return KnownGraph(graph_parents)
-            self.known_graph = make_kg()
-
-            merge_sorted_revisions = self.known_graph.merge_sort('top:')
-            # So far, we are a bit faster than the pure-python code. But the
-            # last step hurts. Specifically, we take
-            #   377ms KnownGraph(self.graph_parents)
-            #   263ms kg.merge_sort() [640ms combined]
-            #  1322ms self.revisions = [...]
-            # vs
-            #  1152ms tsort.merge_sort(self.graph_parents)
-            #   691ms self.revisions = [...]
-            #
-            # It is a gc thing... :(
-            # Adding gc.disable() / gc.enable() around this whole loop changes
-            # things to be:
-            #   100ms   KnownGraph(self.graph_parents)
-            #    77ms   kg.merge_sort() [177ms combined]
-            #   174ms   self.revisions = [...]
-            # vs
-            #   639ms   tsort.merge_sort(self.graph_parents)
-            #   150ms   self.revisions = [...]
-            # Also known as "wow that's a lot faster". This is because KG()
-            # creates a bunch of Python objects, then merge_sort() creates a
-            # bunch more. And then self.revisions() creates another whole set.
-            # And all of these are moderately long lived, so you have a *lot*
-            # of allocations without removals (which triggers the gc checker
-            # over and over again.) And they probably don't live in cycles
-            # anyway, so you can skip it for now, and just run at the end.
-
-            # self.revisions *is* a little bit slower. Probably because pyrex
-            # MergeSortNodes use long integers rather than PyIntObject and thus
-            # create them on-the-fly.
-
-            # Get rid of the 'top:' revision
-            merge_sorted_revisions.pop(0)
-            self.revisions = [RevisionData(index, node)
-                for index, node in enumerate(merge_sorted_revisions)]
-            if enabled:
-                gc.enable()
+        self.known_graph = KnownGraph(graph_parents)
+        merge_sorted_revisions = self.known_graph.merge_sort('top:')
+        # Get rid of the 'top:' revision
+        merge_sorted_revisions.pop(0)
+
+        # The data is copied in to the arrays of a RevisionStore, so that the
+        # merge_sort nodes can be freed, and so that only one small object
+        # gets created per revision.
+        self.store = RevisionStore()
+        if self.truncated_revids:
+            self.store.extend(self.remove_truncated_revisions(
+                graph_parents, merge_sorted_revisions))
         else:
-            self.revisions = ()
+            self.store.extend(
+                (node.key, node.revno, node.merge_depth, node.end_of_merge)
+                for node in merge_sorted_revisions)
+        del merge_sorted_revisions
+        self.revisions = [RevisionData(index, self.store)
+                          for index in range(len(self.store))]
 
-        self.revid_rev = {}
-        self.revno_rev = {}
+        self.index_revisions()
 
-        self.max_mainline_revno = 0
+    def remove_truncated_revisions(self, graph_parents, merge_sorted_revisions):
+        """Remove truncated_revids from the merge sorted revisions and from
+        known_graph, and add revno_offset to the mainline revnos.
 
-        for rev in self.revisions:
-            self.max_mainline_revno = max(self.max_mainline_revno, rev.revno_sequence[0])
-            self.revid_rev[rev.revid] = rev
-            self.revno_rev[rev.revno_sequence] = rev
+        :return: list of (revid, revno, merge_depth, end_of_merge).
+        """
+        truncated_revids = self.truncated_revids
+        revno_offset = self.revno_offset
+        nodes = []
+        for node in merge_sorted_revisions:
+            if node.key in truncated_revids:
+                if (node.end_of_merge and nodes and
+                        nodes[-1][2] == node.merge_depth):
+                    nodes[-1] = nodes[-1][:3] + (True,)
+                continue
+            revno = node.revno
+            # Revisions that are not based on a loaded mainline revision have
+            # 0 as their mainline revno.
+            if revno[0]:
+                revno = (revno[0] + revno_offset,) + revno[1:]
+            nodes.append((node.key, revno, node.merge_depth, node.end_of_merge))
+
+        for revid in truncated_revids:
+            del graph_parents[revid]
+        for revid, parent_revids in graph_parents.items():
+            if any(parent_revid in truncated_revids for parent_revid in parent_revids):
+                graph_parents[revid] = tuple(
+                    [parent_revid for parent_revid in parent_revids
+                     if parent_revid not in truncated_revids])
+        self.known_graph = KnownGraph(graph_parents)
+        return nodes
+
+    def index_revisions(self):
+        self.revid_rev = dict(zip(self.store.revids, self.revisions))
+        self._revno_rev = None
+        self._ancestry_index = None
+
+        # The max of revno_sequence[0] for all the revisions.
+        self.max_mainline_revno = max(
+            [branch_id[0] for branch_id in self.store.branch_ids if branch_id] +
+            [revno for ref, revno in zip(self.store.branch_refs, self.store.revnos)
+             if not self.store.branch_ids[ref]] + [0])
+
+    @property
+    def ancestry_index(self):
+        """AncestryIndex for the revisions.
+
+        This is only built when it is first used.
+        """
+        if self._ancestry_index is None:
+            self._ancestry_index = AncestryIndex(
+                self.store.revids, self.known_graph.get_parent_keys)
+        return self._ancestry_index
+
+    def find_unique_ancestors(self, revid, other_revids):
+        """Find the ancestors of revid that are not ancestors of other_revids,
+        using the ancestry_index, or the repository graph for revisions that
+        are not loaded."""
+        ancestry_index = self.ancestry_index
+        if revid in ancestry_index and all(
+                other_revid in ancestry_index for other_revid in other_revids):
+            return ancestry_index.unique_ancestors(revid, other_revids)
+        return self.graph.find_unique_ancestors(revid, other_revids)
+
+    @property
+    def revno_rev(self):
+        """Dict of revno_sequence to RevisionData.
+
+        This is only built when it is first used.
+        """
+        if self._revno_rev is None:
+            self._revno_rev = dict(
+                [(rev.revno_sequence, rev) for rev in self.revisions])
+        return self._revno_rev
+
+    def merge_sort_cache_key(self, head_revids):
+        """Return the (name, digest) that the merge sort cache is stored
+        under for head_revids.
+
+        The name identifies the repositories, and the digest the heads of the
+        graph.
+        """
+        name = hashlib.sha1()
+        name.update(self.__class__.__name__.encode("utf-8"))
+        for repo in self.repos:
+            name.update(b"\0" + repo.base.encode("utf-8"))
+
+        digest = hashlib.sha1()
+        digest.update(sys.byteorder.encode("ascii"))
+        for revid in head_revids:
+            digest.update(b"\0" + revid)
+        for revid, parents in sorted(self.graph_extra_parents.items()):
+            digest.update(b"\1" + revid)
+            for parent in parents:
+                digest.update(b"\0" + parent)
+        return name.hexdigest(), digest.digest()
+
+    def can_use_merge_sort_cache(self, head_revids):
+        return (self.merge_sort_cache is not None and self.cache_merge_sort and
+                self.truncated_revid is None and
+                all(isinstance(revid, bytes) for revid in head_revids))
+
+    def load_merge_sort_cache(self, head_revids):
+        """Load the merge sorted revisions from merge_sort_cache.
+
+        :return: True if the revisions were loaded from the cache, False if
+            the graph needs to be processed.
+        """
+        if not self.can_use_merge_sort_cache(head_revids):
+            return False
+        cached = self.merge_sort_cache.load(*self.merge_sort_cache_key(head_revids))
+        if cached is None:
+            return False
+        revids, revnos, merge_depths, end_of_merges, parents, ghosts = cached
+        if ghosts and self.graph.get_parent_map(ghosts):
+            # A ghost has been fetched since the cache was saved, e.g. by a
+            # pull from another branch, so the cached graph is missing its
+            # ancestry.
+            return False
+
+        graph_parents = dict(zip(revids, parents))
+        graph_parents["top:"] = head_revids
+        self.ghosts = ghosts
+        self.known_graph = KnownGraph(graph_parents)
+        self.store = RevisionStore()
+        self.store.extend(zip(revids, revnos, merge_depths, end_of_merges))
+        self.revisions = [RevisionData(index, self.store)
+                          for index in range(len(self.store))]
+        self.index_revisions()
+        return True
+
+    def save_merge_sort_cache(self, head_revids):
+        if not self.can_use_merge_sort_cache(head_revids) or not self.revisions:
+            return
+        name, digest = self.merge_sort_cache_key(head_revids)
+        self.merge_sort_cache.save(name, digest, self.revisions,
+                                   self.known_graph.get_parent_keys, self.ghosts)
 
     def branch_id_sort_key(self, x):
         merge_depth = self.branch_lines[x].merge_depth
@@ -479,23 +1365,55 @@ class GraphVizLoader(object):
         """List of branch ids, sorted in the order that the branches will
         be shown, from left to right on the graph."""
 
-        for rev in self.revisions:
-
-            branch_line = None
-            if rev.branch_id not in self.branch_lines:
-                branch_line = BranchLine(rev.branch_id)
-                self.branch_lines[rev.branch_id] = branch_line
-            else:
-                branch_line = self.branch_lines[rev.branch_id]
+        store = self.store
+        for ref, branch_id in enumerate(store.branch_ids):
+            branch_line = BranchLine(branch_id)
+            self.branch_lines[branch_id] = branch_line
+            store.branch_lines[ref] = branch_line
 
+        for rev, ref, merge_depth in zip(self.revisions, store.branch_refs,
+                                         store.merge_depths):
+            branch_line = store.branch_lines[ref]
             branch_line.revs.append(rev)
-            branch_line.merge_depth = max(rev.merge_depth, branch_line.merge_depth)
-            rev.branch = branch_line
+            if merge_depth > branch_line.merge_depth:
+                branch_line.merge_depth = merge_depth
 
         self.branch_ids = list(self.branch_lines.keys())
         self.branch_ids.sort(key=self.branch_id_sort_key)
 
-    def compute_merge_info(self):
+    def splice_branch_lines(self, new_revs):
+        """Add revisions that come before all the existing revisions to the
+        branch lines."""
+        branch_new_revs = {}
+        for rev in new_revs:
+            branch_new_revs.setdefault(rev.branch_id, []).append(rev)
+
+        for branch_id, revs in branch_new_revs.items():
+            if branch_id not in self.branch_lines:
+                branch_line = BranchLine(branch_id)
+                self.branch_lines[branch_id] = branch_line
+                self.store.branch_lines[self.store.branch_id_ref(branch_id)] = branch_line
+            branch_line = self.branch_lines[branch_id]
+            branch_line.revs[0:0] = revs
+            for rev in revs:
+                branch_line.merge_depth = max(rev.merge_depth, branch_line.merge_depth)
+
+        if len(self.branch_ids) != len(self.branch_lines):
+            self.branch_ids = list(self.branch_lines.keys())
+            self.branch_ids.sort(key=self.branch_id_sort_key)
+
+    def compute_merge_info(self, revs=None):
+        """Compute merges and merged_by for revs, or all the revisions if revs
+        is None."""
+
+        store_merges = self.store.merges
+        # (branch_id, merged_by_branch_id) of the branch line merges already
+        # recorded, to avoid searching the BranchLine lists, which can be
+        # long for the mainline.
+        branch_merges = set(
+            (branch_line.branch_id, merged_by_branch_id)
+            for branch_line in self.branch_lines.values()
+            for merged_by_branch_id in branch_line.merged_by)
 
         def set_merged_by(rev, merged_by, merged_by_rev, do_branches=False):
             if merged_by is None:
@@ -504,20 +1422,24 @@ class GraphVizLoader(object):
             if merged_by_rev is None:
                 merged_by_rev = self.revisions[merged_by]
             rev.merged_by = merged_by
-            merged_by_rev.merges.append(rev.index)
+            merges = store_merges.get(merged_by)
+            if merges is None:
+                store_merges[merged_by] = [rev.index]
+            else:
+                merges.append(rev.index)
 
             if do_branches:
                 branch_id = rev.branch_id
-                branch_merged_by = self.branch_lines[branch_id].merged_by
-                merged_by_branch_id = self.revisions[merged_by].branch_id
-                merged_by_branch_merges = self.branch_lines[merged_by_branch_id].merges
+                merged_by_branch_id = merged_by_rev.branch_id
+                if (branch_id, merged_by_branch_id) not in branch_merges:
+                    branch_merges.add((branch_id, merged_by_branch_id))
+                    self.branch_lines[merged_by_branch_id].merges.append(branch_id)
+                    self.branch_lines[branch_id].merged_by.append(merged_by_branch_id)
 
-                if branch_id not in merged_by_branch_merges:
-                    merged_by_branch_merges.append(branch_id)
-                if merged_by_branch_id not in branch_merged_by:
-                    branch_merged_by.append(merged_by_branch_id)
+        if revs is None:
+            revs = self.revisions
 
-        for rev in self.revisions:
+        for rev in revs:
 
             parents = [self.revid_rev[parent] for parent in self.known_graph.get_parent_keys(rev.revid)]
             if len(parents) > 0:
@@ -533,27 +1455,66 @@ class GraphVizLoader(object):
             revision_map = {}
             for i in range(len(heads)):
                 prev_revids = [revid for revid, head in heads[:i]]
-                unique_ancestors = self.graph.find_unique_ancestors(
+                unique_ancestors = self.find_unique_ancestors(
                     heads[i][0], prev_revids)
                 for ancestor_revid in unique_ancestors:
                     revision_map[ancestor_revid] = heads[i][1]
             return revision_map
 
+        head_count = 0
+        for head_info, ur in self.revid_head_info.values():
+            head_count += len(head_info)
+
         if len(self.branches) > 1:
             head_revid_branch_info = sorted(
                 [(revid, branch_info)
                  for revid, (head_info, ur) in self.revid_head_info.items()
                  for (branch_info, tag) in head_info],
                 key=lambda x: not repo_is_local(x[1].branch.repository))
-            self.revid_branch_info = get_revid_head(head_revid_branch_info)
         else:
-            self.revid_branch_info = {}
+            head_revid_branch_info = None
+
+        # Rather than walking the graph for each head, find which heads
+        # reach each revision in one pass. The bits are in the order of
+        # head_revid_branch_info, so that the lowest bit set in a mask is the
+        # first head that has the revision.
+        head_revids = []
+        if head_revid_branch_info is not None:
+            for revid, branch_info in head_revid_branch_info:
+                if revid not in head_revids:
+                    head_revids.append(revid)
+        else:
+            head_revids = list(self.revid_head_info.keys())
+        ancestry_index = self.ancestry_index
+        if ((head_revid_branch_info is not None or head_count > 1) and
+                all(revid in ancestry_index for revid in head_revids)):
+            masks = ancestry_index.head_masks(head_revids)
+        else:
+            masks = None
 
-        head_count = 0
-        for head_info, ur in self.revid_head_info.values():
-            head_count += len(head_info)
+        if head_revid_branch_info is None:
+            self.revid_branch_info = {}
+        elif masks is None:
+            self.revid_branch_info = get_revid_head(head_revid_branch_info)
+        else:
+            head_branch_info = {}
+            for revid, branch_info in reversed(head_revid_branch_info):
+                head_branch_info[revid] = branch_info
+            bit_branch_info = [head_branch_info[revid] for revid in head_revids]
+            self.revid_branch_info = dict(
+                (revid, bit_branch_info[(mask & -mask).bit_length() - 1])
+                for revid, mask in zip(ancestry_index.revids, masks) if mask)
 
         if head_count > 1:
+            if masks is not None:
+                # Revisions that are only reachable from one head.
+                head_unique_revids = {}
+                for revid, mask in zip(ancestry_index.revids, masks):
+                    if mask and not mask & (mask - 1):
+                        head_unique_revids.setdefault(mask, []).append(revid)
+                head_bits = dict(
+                    (revid, 1 << bit) for bit, revid in enumerate(head_revids))
+
             # Populate unique revisions for heads
             for revid, (head_info, ur) in self.revid_head_info.items():
                 rev = None
@@ -570,12 +1531,15 @@ class GraphVizLoader(object):
 
                     merged_by_revid = self.revisions[rev.merged_by].revid
                     other_revids = [self.known_graph.get_parent_keys(merged_by_revid)[0]]
+                    unique_ancestors = self.find_unique_ancestors(revid, other_revids)
+                elif masks is not None:
+                    unique_ancestors = head_unique_revids.get(head_bits[revid], ())
                 else:
                     other_revids = [other_revid for other_revid in self.revid_head_info.keys()
                         if not other_revid == revid]
+                    unique_ancestors = self.find_unique_ancestors(revid, other_revids)
                 ur.append(revid)
-                ur.extend([revid for revid
-                    in self.graph.find_unique_ancestors(revid, other_revids)
+                ur.extend([revid for revid in unique_ancestors
                     if not revid == NULL_REVISION and revid in self.revid_rev])
                 ur.sort(key=lambda x: self.revid_rev[x].index)
 
@@ -590,31 +1554,26 @@ class GraphVizLoader(object):
         #   (such a the line from the last rev in a branch) are treated a
         #   special cases.
         # Return ComputedGraphViz object
-        gc_enabled = gc.isenabled()
-        gc.disable()
-        try:
-            computed = ComputedGraphViz(self)
-            computed.filtered_revs = [ComputedRevisionData(rev) for rev in state.get_filtered_revisions()]
-
-            c_revisions = computed.revisions
-            for f_index, c_rev in enumerate(computed.filtered_revs):
-                c_revisions[c_rev.rev.index] = c_rev
-                c_rev.f_index = f_index
-
-            for (revid, (head_info, unique_revids)) in self.revid_head_info.items():
-                for unique_revid in unique_revids:
-                    rev = self.revid_rev[unique_revid]
-                    c_rev = c_revisions[rev.index]
-                    if c_rev is not None:
-                        c_rev.branch_labels.extend(head_info)
-                        break
-        finally:
-            if gc_enabled:
-                gc.enable()
+        computed = ComputedGraphViz(self)
+        computed.filtered_revs = [ComputedRevisionData(rev, computed) for rev in state.get_filtered_revisions()]
+
+        c_revisions = computed.revisions
+        for f_index, c_rev in enumerate(computed.filtered_revs):
+            c_revisions[c_rev.rev.index] = c_rev
+            c_rev.f_index = f_index
+
+        for (revid, (head_info, unique_revids)) in self.revid_head_info.items():
+            for unique_revid in unique_revids:
+                rev = self.revid_rev[unique_revid]
+                c_rev = c_revisions[rev.index]
+                if c_rev is not None:
+                    c_rev.branch_labels.extend(head_info)
+                    break
 
         if self.no_graph:
             for c_rev in computed.filtered_revs:
                 c_rev.col_index = c_rev.rev.merge_depth * 0.5
+            computed.set_lines([])
             return computed
 
         # This will hold a tuple of (child, parent, col_index, direct) for each
@@ -623,10 +1582,10 @@ class GraphVizLoader(object):
         # between the child and parent because either the child and parent are
         # in the same branch line, or the child and parent are 1 row apart.
         lines = []
-        lines_by_column = []
+        column_occupancy = ColumnOccupancy()
 
         def branch_line_col_search_order(start_col_index):
-            for col_index in range(start_col_index, len(lines_by_column)):
+            for col_index in range(start_col_index, len(column_occupancy)):
                 yield col_index
             #for col_index in range(parent_col_index-1, -1, -1):
             #    yield col_index
@@ -652,35 +1611,28 @@ class GraphVizLoader(object):
                 yield 0
             i = 1
             # then yield the columns on either side.
-            while max_index + i < len(lines_by_column) or min_index - i > -1:
-                if max_index + i < len(lines_by_column):
+            while max_index + i < len(column_occupancy) or min_index - i > -1:
+                if max_index + i < len(column_occupancy):
                     yield max_index + i
                 #if min_index - i > -1:
                 #    yield min_index - i
                 i += 1
 
-        def is_col_free_for_range(col_index, child_f_index, parent_f_index):
-            return not any(
-                range_overlaps(child_f_index, parent_f_index, line_child_f_index, line_parent_f_index)
-                for line_child_f_index, line_parent_f_index
-                in lines_by_column[col_index])
-
         def find_free_column(col_search_order, child_f_index, parent_f_index):
             for col_index in col_search_order:
-                if is_col_free_for_range(col_index, child_f_index, parent_f_index):
+                if column_occupancy.is_free(col_index, child_f_index, parent_f_index):
                     break
             else:
                 # No free columns found. Add an empty one on the end.
-                col_index = len(lines_by_column)
-                lines_by_column.append([])
+                col_index = column_occupancy.add_column()
             return col_index
 
         def append_line(child, parent, direct, col_index=None):
             lines.append((child, parent, col_index, direct))
 
             if col_index is not None:
-                lines_by_column[int(round(col_index))].append(
-                    (child.f_index, parent.f_index))
+                column_occupancy.add(
+                    int(round(col_index)), child.f_index, parent.f_index)
 
         def find_visible_parent(c_rev, parent, twisty_hidden_parents):
             if c_revisions[parent.index] is not None:
@@ -900,24 +1852,14 @@ class GraphVizLoader(object):
             branch_rev_visible_parents_post.reverse()
             append_branch_parent_lines(branch_rev_visible_parents_post)
 
-        # It has now been calculated which column a line must go into. Now
-        # copy the lines in to computed_revisions.
-        for (child, parent, line_col_index, direct) in lines:
-            parent_color = parent.rev.color
-            line_length = parent.f_index - child.f_index
-            if line_length == 0:
-                # Nothing to do
-                pass
-            elif line_length == 1:
-                child.lines.append((child.col_index, parent.col_index, parent_color, direct))
-            else:
-                # line from the child's column to the lines column
-                child.lines.append((child.col_index, line_col_index, parent_color, direct))
-                # lines down the line's column
-                for line_part_f_index in range(child.f_index + 1, parent.f_index - 1):
-                    computed.filtered_revs[line_part_f_index].lines.append((line_col_index, line_col_index, parent_color, direct))
-                # line from the line's column to the parent's column
-                computed.filtered_revs[parent.f_index - 1].lines.append((line_col_index, parent.col_index, parent_color, direct))
+        # It has now been calculated which column a line must go into. The
+        # lines only get copied in to the computed revisions when the rows
+        # they pass are needed. See ComputedGraphViz.compute_lines.
+        computed.set_lines(
+            [(child.f_index, parent.f_index, child.col_index, line_col_index,
+              parent.col_index, parent.rev.color, direct)
+             for (child, parent, line_col_index, direct) in lines
+             if parent.f_index > child.f_index])
 
         return computed
 
@@ -1017,6 +1959,79 @@ def range_overlaps(start_a, end_a, start_b, end_b):
     return start_b < start_a < end_b or start_b < end_a < end_b or (start_a <= start_b and end_a >= end_b)
 
 
+class ColumnOccupancy(object):
+    """Index of the ranges of rows that are occupied by lines in each column
+    of a graph.
+
+    `is_free` gives the same answer as testing the range against every range
+    added to the column with `range_overlaps`, but in logarithmic time.
+
+    For ranges where start <= end, range_overlaps(a, b) is true if the open
+    ranges (start_a, end_a) and (start_b, end_b) intersect, or if b is within
+    a. So for each column, the ranges where start < end are kept merged in to
+    sorted lists of starts and ends of disjoint open ranges, and the ranges
+    where start == end are kept as a sorted list of points. Ranges where
+    start > end are rare, and are tested against linearly.
+    """
+
+    __slots__ = ["columns"]
+
+    def __init__(self):
+        self.columns = []
+        """For each column, a tuple of (starts, ends, points, reversed_ranges,
+        ranges), where ranges is every range added to the column."""
+
+    def __len__(self):
+        return len(self.columns)
+
+    def add_column(self):
+        """Add an empty column on the end.
+
+        :return: The index of the new column.
+        """
+        self.columns.append(([], [], [], [], []))
+        return len(self.columns) - 1
+
+    def add(self, col_index, start, end):
+        """Mark the rows from start to end as occupied in the column."""
+        starts, ends, points, reversed_ranges, ranges = self.columns[col_index]
+        ranges.append((start, end))
+        if start > end:
+            reversed_ranges.append((start, end))
+        elif start == end:
+            points.insert(bisect_right(points, start), start)
+        else:
+            # Merge with the ranges whose open ranges intersect with this
+            # range. Ranges that only touch are not merged, as a range
+            # between them does not overlap with either.
+            first = bisect_right(ends, start)
+            last = bisect_left(starts, end)
+            if first < last:
+                start = min(start, starts[first])
+                end = max(end, ends[last - 1])
+            starts[first:last] = [start]
+            ends[first:last] = [end]
+
+    def is_free(self, col_index, start, end):
+        """Test if none of the ranges added to the column overlap with the
+        range from start to end."""
+        starts, ends, points, reversed_ranges, ranges = self.columns[col_index]
+        if start > end:
+            return not any(range_overlaps(start, end, range_start, range_end)
+                           for range_start, range_end in ranges)
+        if any(range_overlaps(start, end, range_start, range_end)
+               for range_start, range_end in reversed_ranges):
+            return False
+
+        i = bisect_left(starts, end)
+        if i > 0 and ends[i - 1] > start:
+            return False
+        i = bisect_left(points, start)
+        if i < len(points) and points[i] <= end:
+            return False
+        return True
+
+
 class PendingMergesGraphVizLoader(GraphVizLoader):
     """GraphVizLoader that only loads pending merges.
 
@@ -1027,6 +2042,8 @@ class PendingMergesGraphVizLoader(GraphVizLoader):
 
     """
 
+    cache_merge_sort = False
+
     def load_graph_parents(self):
         if not len(self.branches) == 1 or not len(self.repos) == 1:
             AssertionError("load_graph_pending_merges should only be called when 1 branch and repo has been opened.")
@@ -1169,10 +2186,15 @@ class GraphVizFilterState(object):
 
         self.filters = []
 
-        # This keeps a cache of the filter state so that when one of the
-        # filters notifies us of a change, we can check if anything did change.
+        self.filter_bitmaps = {}
+        """Dict of filter to a bytearray with a byte for each revision, which
+        is 1 if the filter shows the revision."""
 
-        self.filter_cache = [None for rev in self.graph_viz.revisions]
+        self.filter_cache = None
+        """bytearray with a byte for each revision, which is 1 if the
+        revision is visible if its branch is visible. This keeps the filter
+        state so that when one of the filters notifies us of a change, we can
+        check if anything did change. None if it needs to be computed."""
 
     def get_filtered_revisions(self):
         if self.graph_viz.no_graph:
@@ -1187,66 +2209,75 @@ class GraphVizFilterState(object):
                 rev_whos_branch_is_visible.extend(branch_line.revs)
             rev_whos_branch_is_visible.sort(key=lambda rev: rev.index)
 
-        visible = self.get_revision_visible_if_branch_visible
-        return (rev for rev in rev_whos_branch_is_visible if visible(rev))
+        filter_cache = self.get_filter_cache()
+        return (rev for rev in rev_whos_branch_is_visible
+                if filter_cache[rev.index])
 
     def get_revision_visible_if_branch_visible(self, rev):
-        rev_filter_cache = self.filter_cache[rev.index]
-        if rev_filter_cache is None:
-            rev_filter_cache = self._get_revision_visible_if_branch_visible(rev)
-            self.filter_cache[rev.index] = rev_filter_cache
-        return rev_filter_cache
-
-    def _get_revision_visible_if_branch_visible(self, rev):
-        filters_value = True
+        return bool(self.get_filter_cache()[rev.index])
+
+    def get_filter_bitmap(self, filter):
+        bitmap = self.filter_bitmaps.get(filter)
+        if bitmap is None or len(bitmap) != len(self.graph_viz.revisions):
+            get_revisions_visible = getattr(filter, "get_revisions_visible", None)
+            if get_revisions_visible is not None:
+                bitmap = get_revisions_visible()
+            else:
+                get_revision_visible = filter.get_revision_visible
+                bitmap = bytearray([bool(get_revision_visible(rev))
+                                    for rev in self.graph_viz.revisions])
+            self.filter_bitmaps[filter] = bitmap
+        return bitmap
+
+    def get_filter_cache(self):
+        revisions = self.graph_viz.revisions
+        if (self.filter_cache is not None and
+                len(self.filter_cache) == len(revisions)):
+            return self.filter_cache
+
+        # And the filters together, a whole bitmap at a time.
+        visible = int.from_bytes(b"\x01" * len(revisions), "little")
         for filter in self.filters:
-            if not filter.get_revision_visible(rev):
-                filters_value = False
-                break
-        if filters_value:
-            return True
+            visible &= int.from_bytes(self.get_filter_bitmap(filter), "little")
+        filter_cache = bytearray(visible.to_bytes(len(revisions), "little"))
 
         if not self.graph_viz.no_graph:
-            for merged_index in rev.merges:
-                merged_rev = self.graph_viz.revisions[merged_index]
-                if self.get_revision_visible_if_branch_visible(merged_rev):
-                    return True
+            # A revision is visible if any of the revisions that it merges
+            # are visible. Merged revisions come after the revision that
+            # merges them, so going backwards, they have already been done.
+            merges = self.graph_viz.store.merges
+            for index in sorted(merges, reverse=True):
+                if not filter_cache[index]:
+                    for merged_index in merges[index]:
+                        if filter_cache[merged_index]:
+                            filter_cache[index] = 1
+                            break
 
-        return False
+        self.filter_cache = filter_cache
+        return filter_cache
 
     def filter_changed(self, revs=None, last_call=True):
         if revs is None:
-            self.filter_cache = [None for rev in self.graph_viz.revisions]
+            self.filter_bitmaps = {}
+            self.filter_cache = None
             if self.filter_changed_callback:
                 self.filter_changed_callback()
         else:
-            pending_revs = revs
-            processed_revs = set()
-            prev_cached_revs = []
-            while pending_revs:
-                rev = pending_revs.pop(0)
-                if rev in processed_revs:
-                    continue
-                processed_revs.add(rev)
-
-                rev_filter_cache = self.filter_cache[rev.index]
-
-                if rev_filter_cache is not None:
-                    prev_cached_revs.append((rev, rev_filter_cache))
-                self.filter_cache[rev.index] = None
-
-                if not self.graph_viz.no_graph:
-                    if rev.merged_by is not None:
-                        pending_revs.append(self.graph_viz.revisions[rev.merged_by])
+            prev_filter_cache = self.filter_cache
+            if prev_filter_cache is None:
+                # Nothing has been shown yet, so nothing can have changed.
+                return
+            for filter, bitmap in self.filter_bitmaps.items():
+                get_revision_visible = filter.get_revision_visible
+                for rev in revs:
+                    bitmap[rev.index] = bool(get_revision_visible(rev))
 
             # Check if any visibilities have changes. If they have, call
             # filter_changed_callback
-            for rev, prev_visible in prev_cached_revs:
-                visible = self.get_revision_visible_if_branch_visible(rev)
-                if visible != prev_visible:
-                    if self.filter_changed_callback:
-                        self.filter_changed_callback()
-                    break
+            self.filter_cache = None
+            if self.get_filter_cache() != prev_filter_cache:
+                if self.filter_changed_callback:
+                    self.filter_changed_callback()
 
     def ensure_rev_visible(self, rev):
         if self.graph_viz.no_graph:
@@ -1314,12 +2345,24 @@ class FileIdFilter (object):
     Filter that only shows revisions that modify one of the specified files.
     """
 
+    chunk_size = 500
+    """Number of revisions to check the files in at a time."""
+    inventory_chunk_size = 200
+    """Number of revisions to check at a time for directories, which needs
+    the inventory of each revision."""
+
     def __init__(self, graph_viz, filter_changed_callback, file_ids):
         self.graph_viz = graph_viz
         self.filter_changed_callback = filter_changed_callback
         self.file_ids = file_ids
         self.has_dir = False
-        self.filter_file_id = [False for rev in self.graph_viz.revisions]
+        self.filter_file_id = bytearray(len(self.graph_viz.revisions))
+        self.text_parent_maps = {}
+        """repo.base to (repo, parent_map), where parent_map is the parent
+        text keys of the text keys of the revisions that change the files."""
+        self.loaded = False
+        self.loaded_callbacks = []
+        """Called when the revisions that change the files are loaded."""
 
         # don't filter working tree nodes
         if isinstance(self.graph_viz, WithWorkingTreeGraphVizLoader):
@@ -1356,56 +2399,283 @@ class FileIdFilter (object):
             revids = [revid for revid in revids if not revid.startswith(CURRENT_REVISION)]
 
             for repo, revids in self.graph_viz.get_repo_revids(revids):
+                index = self.graph_viz.get_file_changes_index(repo)
+                if index is not None and self.load_from_index(index, repo, revids):
+                    continue
                 if self.uses_inventory():
-                    chunk_size = 200
+                    chunk_size = self.inventory_chunk_size
                 else:
-                    chunk_size = 500
-                for start in range(0, len(revids), chunk_size):
-                    self.load_filter_file_id_chunk(repo, revids[start:start + chunk_size])
+                    chunk_size = self.chunk_size
+                chunks = [revids[start:start + chunk_size]
+                          for start in range(0, len(revids), chunk_size)]
+                if self.load_chunks_in_processes(repo, chunks):
+                    continue
+                for chunk in chunks:
+                    self.load_filter_file_id_chunk(repo, chunk)
 
             self.load_filter_file_id_chunk_finished()
 
-    def load_filter_file_id_chunk(self, repo, revids):
-        graph = repo.get_file_graph()
-
-        def check_text_keys(text_keys):
-            changed_revs = []
-            for file_id, revid in graph.get_parent_map(text_keys):
-                rev = self.graph_viz.revid_rev[revid]
-                self.filter_file_id[rev.index] = True
-                changed_revs.append(rev)
+    def load_from_index(self, index, repo, revids):
+        """Load which of revids affect the file_ids from a
+        FileChangesIndex, first adding the revisions that are not in it.
+        Return False if the index can't be used."""
+        with repo.lock_read():
+            revids_to_add = [revid for revid in revids
+                             if revid not in index.indexed]
+            for start in range(0, len(revids_to_add), 500):
+                if not index.add_revisions(repo, revids_to_add[start:start + 500]):
+                    return False
+                self.graph_viz.update_ui()
+            if self.uses_inventory():
+                revids_to_add = [revid for revid in revids
+                                 if revid not in index.rolled_up]
+                chunk_size = self.inventory_chunk_size
+                chunks = [revids_to_add[start:start + chunk_size]
+                          for start in range(0, len(revids_to_add), chunk_size)]
+                if not self.add_rollups_in_processes(index, repo, chunks):
+                    for chunk in chunks:
+                        if not index.add_rollups(repo, chunk):
+                            return False
+                        self.graph_viz.update_ui()
+
+            text_keys = index.get_text_keys(self.file_ids, self.uses_inventory())
+            if text_keys is None:
+                return False
+            revids = set(revids)
+            text_keys = [key for key in text_keys if key[1] in revids]
+            for start in range(0, len(text_keys), 1000):
+                self.check_text_keys(repo, text_keys[start:start + 1000])
+        return True
+
+    def load_chunks_in_processes(self, repo, chunks):
+        """Load the chunks of revisions for directories on the pool of
+        processes of graph_viz, showing the results as they come in.
+        Return False if the chunks were not loaded."""
+        if not self.uses_inventory():
+            return False
+        url = repo.controldir.root_transport.base
+        return self.run_in_processes(
+            repo,
+            [(load_chunk_text_parent_map, (url, chunk, self.file_ids))
+             for chunk in chunks],
+            lambda args, parent_map: self.add_text_parent_map(repo, parent_map),
+            lambda args: self.load_filter_file_id_chunk(repo, args[1]))
+
+    def add_rollups_in_processes(self, index, repo, chunks):
+        """Roll up the changes of the chunks of revisions in a
+        FileChangesIndex on the pool of processes of graph_viz, which reads
+        the inventories. Return False if the chunks were not rolled up."""
+        if len(chunks) < 2 or not repo_is_local(repo):
+            return False
+        url = repo.controldir.root_transport.base
+        calls = []
+        for chunk in chunks:
+            call = index.get_rollup_call(url, chunk)
+            if call is None:
+                return False
+            calls.append(call)
+        # If add_rollup_rows or add_rollups fail, they disable the index,
+        # and then load_from_index does not use it.
+        return self.run_in_processes(
+            repo, calls,
+            lambda args, rows: index.add_rollup_rows(args[1], rows),
+            lambda args: index.add_rollups(repo, args[1]))
+
+    def run_in_processes(self, repo, calls, result_callback, failed_callback):
+        """Run calls, a list of (function, args), on the pool of processes
+        of graph_viz, and pass the args and the result of each call to
+        result_callback as they come in. The args of the calls that fail are
+        passed to failed_callback, to do them in this process.
+
+        The functions open the repository themselves, so this is only done
+        for local repositories. Return False if the calls were not run."""
+        if len(calls) < 2 or not repo_is_local(repo):
+            return False
+        pool = self.graph_viz.get_file_id_process_pool()
+        if pool is None:
+            return False
+        try:
+            futures = dict((pool.submit(function, *args), args)
+                           for function, args in calls)
+        except RuntimeError:
+            # The pool has been shut down, or is broken.
+            return False
+        pending = set(futures)
+        try:
+            while pending:
+                done, pending = concurrent.futures.wait(
+                    pending, timeout=0.05,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        trace.mutter("qbrz: loading file changes in a process"
+                                     " failed: %s", e)
+                        failed_callback(futures[future])
+                    else:
+                        result_callback(futures[future], result)
+                self.graph_viz.update_ui()
+        finally:
+            for future in pending:
+                future.cancel()
+        return True
+
+    def check_text_keys(self, repo, text_keys):
+        """Show the revisions of the text keys that exist."""
+        self.add_text_parent_map(
+            repo, repo.get_file_graph().get_parent_map(text_keys))
+
+    def add_text_parent_map(self, repo, parent_map):
+        """Show the revisions of the text keys of parent_map."""
+        changed_revs = []
+        self.text_parent_maps.setdefault(
+            repo.base, (repo, {}))[1].update(parent_map)
+        for file_id, revid in parent_map:
+            rev = self.graph_viz.revid_rev[revid]
+            self.filter_file_id[rev.index] = True
+            changed_revs.append(rev)
 
-            self.graph_viz.update_ui()
-            self.filter_changed_callback(changed_revs, False)
-            self.graph_viz.update_ui()
+        self.graph_viz.update_ui()
+        self.filter_changed_callback(changed_revs, False)
+        self.graph_viz.update_ui()
 
+    def load_filter_file_id_chunk(self, repo, revids):
         with repo.lock_read():
             if not self.uses_inventory():
                 text_keys = [(file_id, revid) for revid in revids for file_id in self.file_ids]
-                check_text_keys(text_keys)
+                self.check_text_keys(repo, text_keys)
             else:
-                text_keys = []
-                # We have to load the inventory for each revisions, to find
-                # the children of any directories.
-                for inv, revid in zip(repo.iter_inventories(revids), revids):
-                    entries = inv.iter_entries_by_dir(specific_file_ids=self.file_ids)
-                    for path, entry in entries:
-                        text_keys.append((entry.file_id, revid))
-                        if entry.kind == "directory":
-                            sub_entries = inv.iter_entries(from_dir=entry)
-                            for rc_path, rc_entry in sub_entries:
-                                text_keys.append((rc_entry.file_id, revid))
-
-                    self.graph_viz.update_ui()
-
-                check_text_keys(text_keys)
+                text_keys = get_inventory_text_keys(
+                    repo, revids, self.file_ids, self.graph_viz.update_ui)
+                self.check_text_keys(repo, text_keys)
 
     def load_filter_file_id_chunk_finished(self):
         self.filter_changed_callback([], True)
         self.graph_viz.throbber_hide()
+        self.loaded = True
+        for callback in self.loaded_callbacks:
+            callback()
 
     def get_revision_visible(self, rev):
-        return self.filter_file_id[rev.index]
+        return bool(self.filter_file_id[rev.index])
+
+    def get_revisions_visible(self):
+        return bytearray(self.filter_file_id)
+
+
+def get_inventory_text_keys(repo, revids, file_ids, update_ui=None):
+    """Return the text keys of file_ids, and of the files in them if they
+    are directories, in each of revids. repo must be locked."""
+    text_keys = []
+    # We have to load the inventory for each revisions, to find
+    # the children of any directories.
+    for inv, revid in zip(repo.iter_inventories(revids), revids):
+        entries = inv.iter_entries_by_dir(specific_file_ids=file_ids)
+        for path, entry in entries:
+            text_keys.append((entry.file_id, revid))
+            if entry.kind == "directory":
+                sub_entries = inv.iter_entries(from_dir=entry)
+                for rc_path, rc_entry in sub_entries:
+                    text_keys.append((rc_entry.file_id, revid))
+        if update_ui is not None:
+            update_ui()
+    return text_keys
+
+
+def load_chunk_text_parent_map(url, revids, file_ids):
+    """Return the parent map of the text keys of file_ids, and the files
+    in them, that revids change, for the repository at url.
+
+    This runs in the processes of get_process_pool, so it opens the
+    repository itself, and only returns the text keys that exist, which
+    are the ones of the revisions that change the files."""
+    from breezy.repository import Repository
+    repo = Repository.open(url)
+    with repo.lock_read():
+        text_keys = get_inventory_text_keys(repo, revids, file_ids)
+        return repo.get_file_graph().get_parent_map(text_keys)
+
+
+def make_process_pool(processes):
+    """Make a pool of processes that load the plugins when they start, so
+    that they can run the functions of qbrz, and open any repository.
+
+    The processes are spawned rather than forked, as the qbrz process has
+    threads.
+    """
+    from breezy.plugin import load_plugins
+    return concurrent.futures.ProcessPoolExecutor(
+        processes, mp_context=multiprocessing.get_context("spawn"),
+        initializer=load_plugins, initargs=(None, None, False))
+
+
+_process_pool = None
+_process_pool_size = None
+
+def get_process_pool(processes):
+    """Get the pool of processes that is shared by all the logs."""
+    global _process_pool, _process_pool_size
+    if _process_pool is not None and (
+            _process_pool_size != processes or
+            getattr(_process_pool, '_broken', False)):
+        _process_pool.shutdown(wait=False)
+        _process_pool = None
+    if _process_pool is None:
+        _process_pool = make_process_pool(processes)
+        _process_pool_size = processes
+    return _process_pool
+
+
+def iter_text_count_changes(repo, keys, parent_map, pattern, batch_size=100):
+    """Find the text keys where the number of times pattern is in the text
+    is not the same as in the text of its left hand parent, like git's
+    pickaxe.
+
+    The texts are read from the repository in batches. Each text is only
+    read once, and only its count is kept.
+
+    :param keys: text keys to check, in the order to check them.
+    :param parent_map: dict of text key to parent text keys, as
+        returned by the file graph.
+    :param pattern: bytes to count.
+    :return: iterator of (number of keys checked, keys that changed), for
+        each batch.
+    """
+    counts = {}
+
+    def count_texts(wanted):
+        for key, chunks in repo.iter_files_bytes(
+                [(key[0], key[1], key) for key in wanted]):
+            counts[key] = b"".join(chunks).count(pattern)
+
+    for start in range(0, len(keys), batch_size):
+        batch = keys[start:start + batch_size]
+        wanted = set()
+        for key in batch:
+            wanted.add(key)
+            parents = parent_map.get(key)
+            if parents:
+                wanted.add(parents[0])
+        wanted.difference_update(counts)
+        try:
+            count_texts(wanted)
+        except (errors.RevisionNotPresent, errors.NoSuchRevision):
+            # A parent is a ghost, so read them one at a time, and count
+            # the ones that are missing as 0.
+            for key in wanted:
+                try:
+                    count_texts([key])
+                except (errors.RevisionNotPresent, errors.NoSuchRevision):
+                    counts[key] = 0
+
+        changed = []
+        for key in batch:
+            parents = parent_map.get(key)
+            parent_count = counts[parents[0]] if parents else 0
+            if counts[key] != parent_count:
+                changed.append(key)
+        yield len(batch), changed
 
 
 class WorkingTreeHasChangeFilter(object):
@@ -1471,6 +2741,14 @@ class WorkingTreeHasChangeFilter(object):
         else:
             return True
 
+    def get_revisions_visible(self):
+        visible = bytearray(b"\x01") * len(self.graph_viz.revisions)
+        for wt_revid in self.graph_viz.working_trees:
+            rev = self.graph_viz.revid_rev.get(wt_revid)
+            if rev is not None and wt_revid not in self.tree_revids_with_changes:
+                visible[rev.index] = 0
+        return visible
+
 
 class ComputedRevisionData(object):
     """Container for computed layout data for a revision.
@@ -1490,6 +2768,9 @@ class ComputedRevisionData(object):
         ancestry, with revisions that are filtered. This should be shown as
         a dotted line.
 
+        This is computed when it is first accessed, together with the lines
+        for the neighbouring rows.
+
     :ivar branch_labels: Labels for branch tips.
     :ivar twisty_state: State of the revision:
 
@@ -1503,16 +2784,27 @@ class ComputedRevisionData(object):
     """
 
     # Instance of this object are typically named "c_rev".
-    __slots__ = ['rev', 'f_index', 'lines', 'col_index', 'branch_labels', 'twisty_state', 'twisty_expands_branch_ids']
+    __slots__ = ['rev', 'computed', 'f_index', '_lines', 'col_index',
+                 'branch_labels', 'twisty_state', 'twisty_expands_branch_ids']
 
-    def __init__(self, rev):
+    def __init__(self, rev, computed=None):
         self.rev = rev
-        self.lines = []
+        self.computed = computed
+        self._lines = None
         self.col_index = None
         self.twisty_state = None
         self.twisty_expands_branch_ids = []
         self.branch_labels = []
 
+    def get_lines(self):
+        if self._lines is None:
+            if self.computed is None:
+                self._lines = []
+            else:
+                self.computed.compute_lines(self.f_index)
+        return self._lines
+    lines = property(get_lines)
+
 
 class ComputedGraphViz(object):
     """Computed layout data for a graph.
@@ -1522,8 +2814,84 @@ class ComputedGraphViz(object):
         are included.
     :ivar revisions: List `ComputedRevisionData`. Revision that are not
         visible are None.
+    :ivar lines: List of lines between revisions. Each line is a tuple of
+        `(child f_index, parent f_index, child col_index, line col_index,
+        parent col_index, color, direct)`.
+
+    The column of each revision is computed for the whole graph, but the
+    lines for each row are only computed for blocks of rows, when the rows
+    are needed. As the view only shows a small number of rows at a time, this
+    avoids copying every segment of every long line in to every row that it
+    passes.
     """
+
+    block_size = 64
+    """Number of rows that lines get computed for at a time."""
+
+    look_ahead_blocks = 1
+    """Number of blocks after the requested rows to compute lines for, so
+    that scrolling down does not need to compute lines for every page."""
+
     def __init__(self, graph_viz):
         self.graph_viz = graph_viz
         self.filtered_revs = []
         self.revisions = [None] * len(graph_viz.revisions)
+        self.lines = []
+        self.block_lines = []
+        """For each block of rows, the indexes in lines of the lines that
+        pass through the block."""
+        self.computed_blocks = bytearray()
+
+    def set_lines(self, lines):
+        block_size = self.block_size
+        block_count = (len(self.filtered_revs) + block_size - 1) // block_size
+        block_lines = [[] for i in range(block_count)]
+        for line_index, line in enumerate(lines):
+            # A line has a segment in the rows from the child up to, but not
+            # including, the parent.
+            for block in range(line[0] // block_size,
+                               (line[1] - 1) // block_size + 1):
+                block_lines[block].append(line_index)
+        self.lines = lines
+        self.block_lines = block_lines
+        self.computed_blocks = bytearray(block_count)
+
+    def compute_lines(self, start_f_index, end_f_index=None):
+        """Compute the lines of the rows from start_f_index to end_f_index
+        (inclusive), and of the look ahead blocks after them, if they have
+        not been computed yet."""
+        if end_f_index is None:
+            end_f_index = start_f_index
+        block_size = self.block_size
+        filtered_revs = self.filtered_revs
+        first_block = max(start_f_index // block_size, 0)
+        last_block = min(end_f_index // block_size + self.look_ahead_blocks,
+                         len(self.computed_blocks) - 1)
+        for block in range(first_block, last_block + 1):
+            if self.computed_blocks[block]:
+                continue
+            self.computed_blocks[block] = 1
+            block_start = block * block_size
+            block_end = min(block_start + block_size, len(filtered_revs))
+            for c_rev in filtered_revs[block_start:block_end]:
+                c_rev._lines = []
+
+            for line_index in self.block_lines[block]:
+                (child_f_index, parent_f_index, child_col_index, line_col_index,
+                 parent_col_index, color, direct) = self.lines[line_index]
+                if parent_f_index - child_f_index == 1:
+                    filtered_revs[child_f_index]._lines.append(
+                        (child_col_index, parent_col_index, color, direct))
+                    continue
+                for f_index in range(max(child_f_index, block_start),
+                                     min(parent_f_index, block_end)):
+                    if f_index == child_f_index:
+                        # line from the child's column to the lines column
+                        line = (child_col_index, line_col_index, color, direct)
+                    elif f_index == parent_f_index - 1:
+                        # line from the line's column to the parent's column
+                        line = (line_col_index, parent_col_index, color, direct)
+                    else:
+                        # lines down the line's column
+                        line = (line_col_index, line_col_index, color, direct)
+                    filtered_revs[f_index]._lines.append(line)
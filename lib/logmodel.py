@@ -18,22 +18,35 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
 from PyQt5 import QtCore, QtGui
-from time import (strftime, localtime)
+import os
 import time
-import re
-import fnmatch
+import threading
+from collections import OrderedDict
 
-from breezy.revision import Revision
+from breezy import bedding, osutils, trace
+from breezy import repository as _mod_repository
+from breezy.revision import CURRENT_REVISION, Revision
 
-from breezy.plugins.qbrz.lib.bugs import get_bug_id
 from breezy.plugins.qbrz.lib import loggraphviz
 from breezy.plugins.qbrz.lib.lazycachedrevloader import (load_revisions,
-                                                         cached_revisions)
+                                                         cached_revisions,
+                                                         get_revision_loader,
+                                                         get_revision_summary)
 from breezy.plugins.qbrz.lib.revtreeview import RevIdRole as im_RevIdRole
+from breezy.plugins.qbrz.lib.logquery import Query, RevisionColumns
+from breezy.plugins.qbrz.lib.fileindex import get_file_changes_index
+from breezy.plugins.qbrz.lib.searchindex import (
+    FIELDS as SEARCH_INDEX_FIELDS,
+    SearchQuery,
+    compile_pattern,
+    get_field_texts,
+    get_search_index,
+    )
 from breezy.plugins.qbrz.lib.i18n import gettext
 from breezy.plugins.qbrz.lib.util import (
     extract_name,
     get_apparent_author,
+    get_qbrz_config,
     runs_in_loading_queue,
     )
 
@@ -68,6 +81,8 @@ class GraphVizLoader(loggraphviz.GraphVizLoader):
         self.processEvents = processEvents
         self.throbber = throbber
         loggraphviz.GraphVizLoader.__init__(self, branches, primary_bi, no_graph)
+        self.merge_sort_cache = loggraphviz.MergeSortCache(
+            osutils.pathjoin(bedding.cache_dir(), 'qbrz', 'mergesort'))
 
     def update_ui(self):
         self.processEvents()
@@ -78,6 +93,26 @@ class GraphVizLoader(loggraphviz.GraphVizLoader):
     def throbber_hide(self):
         self.throbber.hide()
 
+    def throbber_message(self, message):
+        if message is None:
+            message = gettext("Loading...")
+        self.throbber.message.setText(message)
+
+    def get_file_changes_index(self, repo):
+        return get_file_changes_index(repo)
+
+    def get_file_id_process_pool(self):
+        # The number of processes is the file_id_filter_processes option of
+        # qbrz.conf, by default the number of cpus. 0 turns the pool off.
+        processes = get_qbrz_config().get_option('file_id_filter_processes')
+        try:
+            processes = int(processes)
+        except (TypeError, ValueError):
+            processes = os.cpu_count() or 1
+        if processes <= 0:
+            return None
+        return loggraphviz.get_process_pool(processes)
+
     def revisions_filter_changed(self):
         self.on_filter_changed()
 
@@ -98,6 +133,9 @@ class WithWorkingTreeGraphVizLoader(loggraphviz.WithWorkingTreeGraphVizLoader, G
         for wt_revid, tree in self.working_trees.items():
             # bla - nasty hack.
             cached_revisions[wt_revid] = WorkingTreeRevision(wt_revid, tree)
+        # The working tree revisions can't be loaded from a repository, so
+        # keep them in the cache for as long as this log is open.
+        cached_revisions.pin(self, self.working_trees.keys())
 
 
 class FileIdFilter(loggraphviz.FileIdFilter):
@@ -106,6 +144,134 @@ class FileIdFilter(loggraphviz.FileIdFilter):
         super(FileIdFilter, self).load(revids)
 
 
+class ContentSearchWorker(threading.Thread):
+    """Thread that reads the texts for a ContentSearchFilter.
+
+    Like the revision loader, it opens its own instances of the
+    repositories, because they are not thread safe.
+    """
+
+    def __init__(self, search_filter, jobs, pattern):
+        threading.Thread.__init__(self, name="qbrz content search")
+        self.daemon = True
+        self.search_filter = search_filter
+        self.jobs = jobs
+        """List of (repo url, text keys, parent map)."""
+        self.pattern = pattern
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        total = sum(len(keys) for url, keys, parent_map in self.jobs)
+        done = 0
+        try:
+            for url, keys, parent_map in self.jobs:
+                repo = _mod_repository.Repository.open(url)
+                with repo.lock_read():
+                    for count, changed in loggraphviz.iter_text_count_changes(
+                            repo, keys, parent_map, self.pattern):
+                        if self.cancelled:
+                            return
+                        done += count
+                        self.search_filter.textsSearched.emit(
+                            self, [key[1] for key in changed], done, total)
+        except Exception as e:
+            trace.mutter("qbrz: content search failed: %s", e)
+        finally:
+            self.search_filter.searchFinished.emit(self)
+
+
+class ContentSearchFilter(QtCore.QObject):
+    """Filter that only shows the revisions that change the number of times
+    a string is in the files of a FileIdFilter, like git log -S.
+
+    Only the revisions that the FileIdFilter found change the files are
+    searched, using the text keys that it loaded. The texts are read on a
+    worker thread, and the revisions are shown as they are found.
+    """
+
+    textsSearched = QtCore.pyqtSignal(object, object, int, int)
+    searchFinished = QtCore.pyqtSignal(object)
+
+    def __init__(self, graph_viz, filter_changed_callback, file_id_filter):
+        QtCore.QObject.__init__(self)
+        self.graph_viz = graph_viz
+        self.filter_changed_callback = filter_changed_callback
+        self.file_id_filter = file_id_filter
+        self.pattern = None
+        self.matched_revids = set()
+        self.worker = None
+        self.textsSearched.connect(self.on_texts_searched)
+        self.searchFinished.connect(self.on_search_finished)
+        file_id_filter.loaded_callbacks.append(self.start)
+
+    def set_search(self, s):
+        """Only show the revisions that change the number of times s is in
+        the files, or all of them if s is None or empty."""
+        pattern = s.encode("utf-8") if s else None
+        if pattern == self.pattern:
+            return
+        self.cancel()
+        self.matched_revids = set()
+        self.pattern = pattern
+        self.filter_changed_callback(None, True)
+        if self.file_id_filter.loaded:
+            self.start()
+
+    def cancel(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+            self.graph_viz.throbber_message(None)
+            self.graph_viz.throbber_hide()
+
+    def start(self):
+        if self.pattern is None or self.worker is not None:
+            return
+        revid_rev = self.graph_viz.revid_rev
+        jobs = []
+        for repo, parent_map in self.file_id_filter.text_parent_maps.values():
+            # Newest first, so that they are shown first.
+            keys = sorted((key for key in parent_map if key[1] in revid_rev),
+                          key=lambda key: revid_rev[key[1]].index)
+            jobs.append((repo.user_url, keys, parent_map))
+        self.worker = ContentSearchWorker(self, jobs, self.pattern)
+        self.graph_viz.throbber_show()
+        self.worker.start()
+
+    def on_texts_searched(self, worker, revids, done, total):
+        if worker is not self.worker:
+            return
+        self.graph_viz.throbber_message(
+            gettext("Searching file texts: %d of %d") % (done, total))
+        revid_rev = self.graph_viz.revid_rev
+        revs = [revid_rev[revid] for revid in revids
+                if revid not in self.matched_revids]
+        self.matched_revids.update(revids)
+        self.filter_changed_callback(revs, False)
+
+    def on_search_finished(self, worker):
+        if worker is not self.worker:
+            return
+        self.worker = None
+        self.graph_viz.throbber_message(None)
+        self.graph_viz.throbber_hide()
+        self.filter_changed_callback([], True)
+
+    def get_revision_visible(self, rev):
+        if self.pattern is None or rev.revid.startswith(CURRENT_REVISION):
+            return True
+        return rev.revid in self.matched_revids
+
+    def get_revisions_visible(self):
+        revisions = self.graph_viz.revisions
+        if self.pattern is None:
+            return bytearray(b"\x01") * len(revisions)
+        return bytearray([self.get_revision_visible(rev) for rev in revisions])
+
+
 class WorkingTreeHasChangeFilter(loggraphviz.WorkingTreeHasChangeFilter):
     @runs_in_loading_queue
     def load(self):
@@ -160,14 +326,33 @@ class LogModel(QtCore.QAbstractTableModel):
 
         self.clicked_f_index = None
         self.last_rev_is_placeholder = False
+        self.content_search_filter = None
         self.bugtext = gettext("bug #%s")
 
-    def load(self, branches, primary_bi, file_ids, no_graph, graph_provider_type):
+    def load(self, branches, primary_bi, file_ids, no_graph, graph_provider_type,
+             limit=None, since=None):
+        """Load the log.
+
+        If limit or since are not None, only a window of the most recent
+        history is loaded. See GraphVizLoader.limit and GraphVizLoader.since.
+        """
         self.throbber.show()
         self.processEvents()
         try:
-            graph_viz = graph_provider_type(branches, primary_bi, no_graph, processEvents=self.processEvents, throbber=self.throbber)
-            graph_viz.load()
+            graph_viz = None
+            if self.can_update_graph_viz(branches, primary_bi, no_graph, graph_provider_type,
+                                         limit, since):
+                # Only load the new revisions if the branch tip has advanced.
+                graph_viz = self.graph_viz
+                graph_viz.branches = branches
+                graph_viz.primary_bi = primary_bi
+                if not graph_viz.update():
+                    graph_viz = None
+            if graph_viz is None:
+                graph_viz = graph_provider_type(branches, primary_bi, no_graph, processEvents=self.processEvents, throbber=self.throbber)
+                graph_viz.limit = limit
+                graph_viz.since = since
+                graph_viz.load()
             graph_viz.on_filter_changed = self.on_filter_changed
 
             state = loggraphviz.GraphVizFilterState(graph_viz, self.compute_lines)
@@ -183,8 +368,12 @@ class LogModel(QtCore.QAbstractTableModel):
             if file_ids:
                 file_id_filter = FileIdFilter(graph_viz, scheduler.filter_changed, file_ids)
                 state.filters.append(file_id_filter)
+                content_search_filter = ContentSearchFilter(
+                    graph_viz, scheduler.filter_changed, file_id_filter)
+                state.filters.append(content_search_filter)
             else:
                 file_id_filter = None
+                content_search_filter = None
 
             if isinstance(graph_viz, WithWorkingTreeGraphVizLoader):
                 working_tree_filter = WorkingTreeHasChangeFilter(graph_viz, scheduler.filter_changed, file_ids)
@@ -200,6 +389,7 @@ class LogModel(QtCore.QAbstractTableModel):
             self.state = state
             self.file_ids = file_ids
             self.file_id_filter = file_id_filter
+            self.content_search_filter = content_search_filter
             self.working_tree_filter = working_tree_filter
             self.prop_search_filter = prop_search_filter
             self.computed = loggraphviz.ComputedGraphViz(graph_viz)
@@ -214,6 +404,16 @@ class LogModel(QtCore.QAbstractTableModel):
         finally:
             self.throbber.hide()
 
+    def can_update_graph_viz(self, branches, primary_bi, no_graph, graph_provider_type,
+                             limit=None, since=None):
+        graph_viz = self.graph_viz
+        return (type(graph_viz) is graph_provider_type and
+                bool(graph_viz.revisions) and
+                graph_viz.no_graph == no_graph and
+                graph_viz.limit == limit and graph_viz.since == since and
+                graph_viz.primary_bi == primary_bi and
+                set(graph_viz.branches) == set(branches))
+
     def compute_lines(self):
         computed = self.graph_viz.compute_viz(self.state)
         if self.last_rev_is_placeholder:
@@ -258,10 +458,7 @@ class LogModel(QtCore.QAbstractTableModel):
         if c_rev is None:
             return blank()
 
-        if c_rev.rev.revid in cached_revisions:
-            revision = cached_revisions[c_rev.rev.revid]
-        else:
-            revision = None
+        revision = get_revision_summary(c_rev.rev.revid)
 
         if role == GraphDataRole:
             prev_c_rev = None
@@ -280,18 +477,8 @@ class LogModel(QtCore.QAbstractTableModel):
 
             # Bugs
             if revision:
-                if hasattr(revision, '_qlog_bugs'):
-                    bugs = revision._qlog_bugs
-                else:
-                    bugs = []
-                    for bug in revision.properties.get('bugs', '').split('\n'):
-                        if bug:
-                            url = bug.split(' ', 1)[0]
-                            bug_id = get_bug_id(url)
-                            if bug_id:
-                                bugs.append(self.bugtext % bug_id)
-                    revision._qlog_bugs = bugs
-                tags.extend([ (bug, QtGui.QColor(164, 0, 0), QtGui.QColor(QtCore.Qt.white)) for bug in bugs])
+                tags.extend([(self.bugtext % bug_id, QtGui.QColor(164, 0, 0), QtGui.QColor(QtCore.Qt.white))
+                             for bug_id in revision.bug_ids])
             is_clicked = c_rev.f_index == self.clicked_f_index
             return c_rev, prev_c_rev, tags, is_clicked
 
@@ -310,11 +497,11 @@ class LogModel(QtCore.QAbstractTableModel):
             return blank()
 
         if role == QtCore.Qt.DisplayRole and index.column() == COL_DATE:
-            return strftime("%Y-%m-%d %H:%M", localtime(revision.timestamp))
+            return revision.date
         if role == QtCore.Qt.DisplayRole and index.column() == COL_AUTHOR:
-            return extract_name(get_apparent_author(revision))
+            return extract_name(revision.author)
         if role == QtCore.Qt.DisplayRole and index.column() == COL_MESSAGE:
-            return revision.get_summary()
+            return revision.summary
 
         return blank()
 
@@ -368,15 +555,48 @@ class LogModel(QtCore.QAbstractTableModel):
             return None
 
 
+MAX_SEARCH_RESULTS = 8
+"""Number of recent searches for which PropertySearchFilter keeps the
+matched revisions."""
+
+
+def is_narrower_search(prev_search, search):
+    """Return True if everything that matches search is known to match
+    prev_search, because the pattern has only had text added to the end."""
+    if prev_search is None:
+        return False
+    prev_field, prev_s = prev_search
+    field, s = search
+    return (field == prev_field and field in SEARCH_INDEX_FIELDS and
+            s.startswith(prev_s) and "[" not in prev_s)
+
+
 class PropertySearchFilter (object):
     def __init__(self, graph_viz, filter_changed_callback):
         self.graph_viz = graph_viz
         self.filter_changed_callback = filter_changed_callback
         self.field = None
         self.filter_re = None
+        self.filter_matched_revids = set()
+        """revids of the revisions that have been loaded, and match
+        filter_re. They are recorded as the revisions come in, because they
+        may be evicted from the revision cache before the search finishes."""
         self.cache = None
         self.index_matched_revids = None
-        self.loading_revisions = False
+        self.load_request = None
+        self.query = None
+        """SearchQuery, if the search is answered by the search indexes."""
+        self.index_request = None
+        self.search = None
+        """(field, s) of the current search."""
+        self.matched_revids = None
+        """frozenset of the revids that match the current search, once all
+        the revisions have been checked, else None."""
+        self.results = OrderedDict()
+        """Recent searches to their matched_revids, most recent last."""
+        self.log_query = None
+        """Query, if the search is on more than one field."""
+        self.columns = None
 
     def set_search(self, s, field):
         """Set search string for specified kind of data.
@@ -388,33 +608,92 @@ class PropertySearchFilter (object):
                 - author
                 - tag
                 - bug
+                - query
 
         Value of `str` interpreted based on field value. For index it's used
         as input value for bzr-search engine.
         For message, author, tag and bug it's used as shell pattern
         (glob pattern) to search in corresponding metadata of revisions.
+        If the repositories have search indexes, and the pattern is a single
+        word, message, author and bug are searched in the indexes, which
+        match the same revisions.
+        For query it's parsed as a Query, e.g.
+        'author:alice date:2024-01..2024-06 -tag:rc*'.
+
+        If the search is one that was done recently, or it narrows the
+        previous one, e.g. a character was typed, and all the revisions were
+        checked against that, only the revisions that matched it are checked,
+        and only the revisions that changed are filtered again.
         """
+        search = (field, s)
+        prev_search = self.search
+        prev_matched_revids = self.matched_revids
+        self.search = search
+        self.matched_revids = None
         self.field = field
+        self.query = None
+        self.log_query = None
+        self.filter_matched_revids = set()
 
         def revisions_loaded(revisions, last_call):
+            if self.log_query is not None:
+                self.log_query.revisions_loaded(self.columns, revisions)
+            if self.filter_re is not None:
+                self.filter_matched_revids.update(
+                    revid for revid, revision in revisions.items()
+                    if self.revision_matches(revision))
             revs = [self.graph_viz.revid_rev[revid] for revid in revisions.keys()]
             self.filter_changed_callback(revs, last_call)
-
-        def before_batch_load(repo, revids):
-            if self.filter_re is None:
-                return True
-            return False
-
-        def wildcard2regex(wildcard):
-            """Translate shel pattern to regexp."""
-            return fnmatch.translate(wildcard + '*')
+            if last_call and self.needs_revisions():
+                self.loaded_search_finished()
+
+        matched_revids = None
+        # If the search narrows the previous one, only the revisions that
+        # matched that have to be checked.
+        search_revids = None
+        if s:
+            matched_revids = self.results.get(search)
+            if (matched_revids is None and prev_matched_revids is not None
+                    and is_narrower_search(prev_search, search)):
+                matched_revids = self.narrow_search(prev_matched_revids)
+                if matched_revids is None:
+                    search_revids = prev_matched_revids
 
         if s is None or s == "":
+            self.search = None
             self.filter_re = None
             self.index_matched_revids = None
             self.filter_changed_callback(None, True)
+        elif matched_revids is not None:
+            self.filter_re = None
+            self.index_matched_revids = matched_revids
+            self.set_matched_revids(matched_revids)
+            if prev_matched_revids is None:
+                self.filter_changed_callback(None, True)
+            else:
+                # Only the revisions that have been shown or hidden need to
+                # be filtered again.
+                revid_rev = self.graph_viz.revid_rev
+                revs = [revid_rev[revid] for revid in
+                        prev_matched_revids ^ matched_revids
+                        if revid in revid_rev]
+                self.filter_changed_callback(revs, True)
         else:
-            if self.field == "index":
+            search_indexes = None
+            if self.field in SEARCH_INDEX_FIELDS and SearchQuery.can_search(s):
+                search_indexes = self.get_search_indexes()
+
+            if search_indexes:
+                self.filter_re = None
+                self.query = SearchQuery(s)
+                self.index_matched_revids = set()
+                for index in search_indexes:
+                    self.index_matched_revids.update(
+                        index.search(self.field, self.query))
+                self.update_search_indexes(search_indexes)
+                if self.index_request is None or not self.index_request.is_active():
+                    self.set_matched_revids(self.index_matched_revids)
+            elif self.field == "index":
                 from breezy.plugins.search import index as search_index
                 self.filter_re = None
                 indexes = [bi.index for bi in self.graph_viz.branches if bi.index is not None]
@@ -432,56 +711,174 @@ class PropertySearchFilter (object):
                                 self.index_matched_revids[result.text_key[1]] = True
                             if isinstance(result, search_index.PathHit):
                                 pass
+            elif self.field == "query":
+                self.filter_re = None
+                self.index_matched_revids = None
+                self.log_query = Query(s)
+                search_indexes = self.get_search_indexes()
+                if search_indexes:
+                    self.log_query.use_search_indexes(
+                        search_indexes,
+                        [rev.revid for rev in self.graph_viz.revisions])
+                if self.columns is None:
+                    self.columns = RevisionColumns(self.graph_viz)
+                self.log_query.prepare(self.columns)
+                if not self.log_query.needs_revisions:
+                    self.loaded_search_finished()
             elif self.field == "tag":
                 self.filter_re = None
-                filter_re = re.compile(wildcard2regex(s), re.IGNORECASE)
+                filter_re = compile_pattern(s)
                 self.index_matched_revids = {}
                 for revid in self.graph_viz.tags:
                     for t in self.graph_viz.tags[revid]:
                         if filter_re.search(t):
                             self.index_matched_revids[revid] = True
                             break
+                self.set_matched_revids(self.index_matched_revids)
             else:
-                self.filter_re = re.compile(wildcard2regex(s), re.IGNORECASE)
+                self.filter_re = compile_pattern(s)
                 self.index_matched_revids = None
 
             self.filter_changed_callback(None, True)
 
-            if self.filter_re is not None and not self.loading_revisions:
-                self.loading_revisions = True
-                try:
-                    revids = [rev.revid for rev in self.graph_viz.revisions ]
-                    load_revisions(revids, self.graph_viz.get_repo_revids,
-                                   time_before_first_ui_update = 0,
-                                   local_batch_size = 100, remote_batch_size = 10,
-                                   before_batch_load = before_batch_load,
-                                   revisions_loaded = revisions_loaded)
-                finally:
-                    self.loading_revisions = False
+        if self.load_request is not None:
+            # The revisions that it has loaded were checked against the
+            # previous search, so start again.
+            self.load_request.cancel()
+            self.load_request = None
+        if self.needs_revisions():
+            revids = [rev.revid for rev in self.graph_viz.revisions
+                      if search_revids is None or rev.revid in search_revids]
+            self.load_request = get_revision_loader().submit(
+                revids, self.graph_viz.get_repo_revids,
+                revisions_loaded=revisions_loaded,
+                pass_prev_loaded_rev=True)
+            if not self.load_request.is_active():
+                # They were all cached.
+                self.loaded_search_finished()
+
+    def needs_revisions(self):
+        """Return True if the revisions have to be loaded to check them
+        against the current search."""
+        return self.filter_re is not None or (
+            self.log_query is not None and self.log_query.needs_revisions)
+
+    def set_matched_revids(self, matched_revids):
+        """Record the revids that match the current search, now that all
+        the revisions have been checked."""
+        matched_revids = frozenset(matched_revids)
+        self.matched_revids = matched_revids
+        self.results[self.search] = matched_revids
+        self.results.move_to_end(self.search)
+        while len(self.results) > MAX_SEARCH_RESULTS:
+            self.results.popitem(last=False)
+
+    def loaded_search_finished(self):
+        self.set_matched_revids(
+            rev.revid for rev in self.graph_viz.revisions
+            if self.get_revision_visible(rev))
+
+    def narrow_search(self, prev_matched_revids):
+        """Return the revids that match the current search, which narrows
+        a search that prev_matched_revids matched, or None if they can't be
+        worked out straight away, because some of those revisions are not
+        cached. Then only those revisions need to be loaded."""
+        field, s = self.search
+        search_indexes = None
+        if SearchQuery.can_search(s):
+            search_indexes = self.get_search_indexes()
+        if search_indexes:
+            query = SearchQuery(s)
+            matched_revids = set()
+            for index in search_indexes:
+                matched_revids.update(
+                    index.search(field, query) & prev_matched_revids)
+            return matched_revids
+
+        revid_rev = self.graph_viz.revid_rev
+        revisions = [cached_revisions.get(revid) for revid in
+                     prev_matched_revids if revid in revid_rev]
+        if None in revisions:
+            return None
+        filter_re = compile_pattern(s)
+        return set(revision.revision_id for revision in revisions
+                   if self.revision_matches(revision, filter_re))
+
+    def get_search_indexes(self):
+        """Return the search indexes of the repositories, or None if one of
+        them does not have one."""
+        indexes = []
+        for repo in self.graph_viz.repos:
+            index = get_search_index(repo)
+            if index is None:
+                return None
+            indexes.append(index)
+        return indexes
+
+    def update_search_indexes(self, indexes):
+        """Load the revisions that are not in the search indexes, and add
+        them, checking them against the query as they come in."""
+        if self.index_request is not None and self.index_request.is_active():
+            return
+        revids = [rev.revid for rev in self.graph_viz.revisions
+                  if isinstance(rev.revid, bytes) and
+                  not any(rev.revid in index.indexed for index in indexes)]
+        if revids:
+            self.index_request = get_revision_loader().submit(
+                revids, self.graph_viz.get_repo_revids,
+                revisions_loaded=self.search_index_revisions_loaded,
+                pass_prev_loaded_rev=True)
+
+    def search_index_revisions_loaded(self, revisions, last_call):
+        # The revisions may have come from the cache, loaded from another
+        # repository, so go by the repositories that this log has them in.
+        for repo, revids in self.graph_viz.get_repo_revids(list(revisions)):
+            index = get_search_index(repo)
+            if index is not None and revids:
+                index.add_revisions([revisions[revid] for revid in revids])
+
+        if self.query is not None:
+            field = SEARCH_INDEX_FIELDS[self.field]
+            revid_rev = self.graph_viz.revid_rev
+            revs = []
+            for revid, revision in revisions.items():
+                if revid in revid_rev:
+                    if self.query.matches_text(get_field_texts(revision)[field]):
+                        self.index_matched_revids.add(revid)
+                    revs.append(revid_rev[revid])
+            self.filter_changed_callback(revs, last_call)
+            if last_call:
+                self.set_matched_revids(self.index_matched_revids)
+
+    def revision_matches(self, revision, filter_re=None):
+        """Return True if filter_re, by default that of the current search,
+        matches the searched field of revision."""
+        if filter_re is None:
+            filter_re = self.filter_re
+        filtered_str = None
+        if self.field == "message":
+            filtered_str = revision.message
+        elif self.field == "author":
+            filtered_str = get_apparent_author(revision)
+        elif self.field == "bug":
+            rbugs = revision.properties.get('bugs', '')
+            if rbugs:
+                filtered_str = rbugs.replace('\n', ' ')
+            else:
+                return False
+
+        if filtered_str is not None:
+            if filter_re.search(filtered_str) is None:
+                return False
+        return True
 
     def get_revision_visible(self, rev):
+        if self.log_query is not None:
+            return self.log_query.matches(self.columns, rev.index)
 
         if self.filter_re:
-            revid = rev.revid
-            if revid not in cached_revisions:
+            if rev.revid not in self.filter_matched_revids:
                 return False
-            revision = cached_revisions[revid]
-
-            filtered_str = None
-            if self.field == "message":
-                filtered_str = revision.message
-            elif self.field == "author":
-                filtered_str = get_apparent_author(revision)
-            elif self.field == "bug":
-                rbugs = revision.properties.get('bugs', '')
-                if rbugs:
-                    filtered_str = rbugs.replace('\n', ' ')
-                else:
-                    return False
-
-            if filtered_str is not None:
-                if self.filter_re.search(filtered_str) is None:
-                    return False
 
         if self.index_matched_revids is not None:
             revid = rev.revid
@@ -489,3 +886,22 @@ class PropertySearchFilter (object):
                 return False
 
         return True
+
+    def get_revisions_visible(self):
+        revisions = self.graph_viz.revisions
+        if self.log_query is not None:
+            return self.log_query.get_visible(self.columns)
+
+        if self.filter_re:
+            return bytearray([self.get_revision_visible(rev) for rev in revisions])
+
+        if self.index_matched_revids is None:
+            return bytearray(b"\x01") * len(revisions)
+
+        visible = bytearray(len(revisions))
+        revid_rev = self.graph_viz.revid_rev
+        for revid in self.index_matched_revids:
+            rev = revid_rev.get(revid)
+            if rev is not None:
+                visible[rev.index] = 1
+        return visible
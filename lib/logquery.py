@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+#
+# QBzr - Qt frontend to Bazaar commands
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""Queries on more than one field of the revisions in qlog, e.g.
+
+    author:alice message:"fix*" date:2024-01..2024-06 bug:1234 -tag:rc*
+
+Words without a field are searched for in the message. Values are shell
+patterns, like the other searches, and a term that starts with - matches
+the revisions that don't match it.
+
+The terms are checked against columns of the metadata of the revisions,
+with the cheapest and most selective terms first, each only on the
+revisions that the terms before it have not ruled out.
+"""
+
+import re
+from array import array
+from datetime import date, timedelta
+from itertools import compress
+from time import mktime
+
+from breezy.plugins.qbrz.lib.lazycachedrevloader import (
+    cached_revisions, cached_summaries)
+from breezy.plugins.qbrz.lib.searchindex import SearchQuery, compile_pattern
+from breezy.plugins.qbrz.lib.util import get_apparent_author
+
+FIELDS = ("message", "author", "date", "bug", "tag")
+
+_query_re = re.compile(
+    r'(?:^|\s)(?P<negate>-?)(?:(?P<field>%s):)?'
+    r'(?:"(?P<quoted>[^"]*)"?|(?P<value>\S*))' % "|".join(FIELDS))
+_field_re = re.compile(r'(?:^|\s)-?(?:%s):' % "|".join(FIELDS))
+_date_re = re.compile(r'^(\d{4})(?:-(\d{1,2})(?:-(\d{1,2}))?)?$')
+
+
+def is_query(s):
+    """Return True if s has terms for a field, and so should be searched
+    as a query rather than as a pattern for one field."""
+    return _field_re.search(s) is not None
+
+
+def parse_date(s, end=False):
+    """Return the local timestamp of the start of the year, month or day
+    in s, or of the one after it if end is True. Return None if s is not
+    a date."""
+    m = _date_re.match(s)
+    if m is None:
+        return None
+    year, month, day = m.groups()
+    try:
+        if day is not None:
+            d = date(int(year), int(month), int(day))
+            if end:
+                d += timedelta(days=1)
+        elif month is not None:
+            d = date(int(year), int(month), 1)
+            if end:
+                d = (d + timedelta(days=31)).replace(day=1)
+        else:
+            d = date(int(year) + end, 1, 1)
+        return mktime(d.timetuple())
+    except (ValueError, OverflowError):
+        return None
+
+
+class RevisionColumns(object):
+    """The metadata of the revisions of a graph, a column for each kind,
+    with a row for each revision in the order of graph_viz.revisions.
+
+    Rows are filled in from the revisions as they are loaded, or from the
+    revision caches. Authors are stored as ids, so that a pattern only has to
+    be matched against each author once.
+    """
+
+    def __init__(self, graph_viz):
+        self.graph_viz = graph_viz
+        self.revids = [rev.revid for rev in graph_viz.revisions]
+        count = len(self.revids)
+        self.count = count
+        self.loaded = bytearray(count)
+        self.timestamps = array('d', bytes(8 * count))
+        self.author_ids = array('l', [-1]) * count
+        self.bugs = [None] * count
+        self.authors = []
+        self.author_ids_by_name = {}
+        for row in range(count):
+            self.update_row(row)
+
+    def update_row(self, row, rev=None):
+        """Fill in a row from rev, its Revision, or if that is None, from
+        the revision caches. Return True if the row is loaded."""
+        if self.loaded[row]:
+            return True
+        revid = self.revids[row]
+        if rev is None:
+            rev = cached_revisions.get(revid)
+        if rev is not None:
+            author = get_apparent_author(rev)
+            bugs = rev.properties.get('bugs', '').replace('\n', ' ')
+        else:
+            rev = cached_summaries.get(revid)
+            if rev is None:
+                return False
+            author = rev.author
+            bugs = ' '.join(rev.bug_ids)
+        author_id = self.author_ids_by_name.get(author)
+        if author_id is None:
+            author_id = self.author_ids_by_name[author] = len(self.authors)
+            self.authors.append(author)
+        self.timestamps[row] = rev.timestamp
+        self.author_ids[row] = author_id
+        self.bugs[row] = bugs
+        self.loaded[row] = 1
+        return True
+
+    def iter_rows(self, revisions):
+        """Yield the row and Revision of each of revisions, a dict of revid
+        to Revision, that has a row."""
+        revid_rev = self.graph_viz.revid_rev
+        for revid, revision in revisions.items():
+            rev = revid_rev.get(revid)
+            if rev is not None and rev.index < self.count:
+                yield rev.index, revision
+
+    def update_revisions(self, revisions):
+        """Fill in the rows of revisions, a dict of revid to Revision, as
+        they are loaded. They may be evicted from the cache before the rows
+        are used."""
+        for row, revision in self.iter_rows(revisions):
+            self.update_row(row, revision)
+
+
+class QueryTerm(object):
+    """A term of a Query.
+
+    matches returns True or False, or None if the row has not been loaded
+    yet, and so it is not known.
+    """
+
+    cost = 0
+    """How expensive the term is to check, relative to the other terms."""
+    needs_revisions = True
+    """Whether the revisions have to be loaded to check the term."""
+
+    def __init__(self, value, negate):
+        self.value = value
+        self.negate = negate
+
+    def prepare(self, columns):
+        """Work out anything that is needed for all the rows, before they
+        are checked."""
+        pass
+
+    def revisions_loaded(self, columns, revisions):
+        """Check revisions, a dict of revid to Revision, as they are loaded,
+        for a term that needs more of them than the columns have."""
+        pass
+
+    def matches(self, columns, row):
+        raise NotImplementedError(self.matches)
+
+    @property
+    def order(self):
+        # Negated terms rule out fewer revisions, as do shorter patterns.
+        return (self.cost, self.negate, -len(self.value))
+
+
+class TagTerm(QueryTerm):
+
+    cost = 0
+    needs_revisions = False
+
+    def prepare(self, columns):
+        regex = compile_pattern(self.value)
+        revid_rev = columns.graph_viz.revid_rev
+        self.rows = set()
+        for revid, tags in columns.graph_viz.tags.items():
+            if revid in revid_rev and any(regex.search(t) for t in tags):
+                self.rows.add(revid_rev[revid].index)
+
+    def matches(self, columns, row):
+        return row in self.rows
+
+
+class RevidsTerm(QueryTerm):
+    """A term that a search index has worked out the matching revids of."""
+
+    cost = 1
+    needs_revisions = False
+
+    def __init__(self, value, negate, revids):
+        QueryTerm.__init__(self, value, negate)
+        self.revids = revids
+
+    def matches(self, columns, row):
+        return columns.revids[row] in self.revids
+
+
+class DateTerm(QueryTerm):
+    """Matches revisions from the start of the first date to the end of the
+    second, e.g. 2024-01..2024-06. Either may be left out."""
+
+    cost = 2
+
+    def __init__(self, value, negate):
+        QueryTerm.__init__(self, value, negate)
+        start, sep, end = value.partition("..")
+        if not sep:
+            end = start
+        self.start = parse_date(start) if start else None
+        self.end = parse_date(end, end=True) if end else None
+
+    @property
+    def order(self):
+        unbounded = (self.start is None) + (self.end is None)
+        return (self.cost, self.negate, unbounded)
+
+    def matches(self, columns, row):
+        if not columns.loaded[row]:
+            return None
+        timestamp = columns.timestamps[row]
+        return ((self.start is None or timestamp >= self.start) and
+                (self.end is None or timestamp < self.end))
+
+
+class AuthorTerm(QueryTerm):
+
+    cost = 2
+
+    def prepare(self, columns):
+        self.regex = compile_pattern(self.value)
+        self.author_ids = set()
+        self.authors_checked = 0
+        self.check_authors(columns)
+
+    def check_authors(self, columns):
+        authors = columns.authors
+        for author_id in range(self.authors_checked, len(authors)):
+            if self.regex.search(authors[author_id]):
+                self.author_ids.add(author_id)
+        self.authors_checked = len(authors)
+
+    def matches(self, columns, row):
+        if not columns.loaded[row]:
+            return None
+        author_id = columns.author_ids[row]
+        if author_id >= self.authors_checked:
+            self.check_authors(columns)
+        return author_id in self.author_ids
+
+
+class BugTerm(QueryTerm):
+
+    cost = 3
+
+    def prepare(self, columns):
+        self.regex = compile_pattern(self.value)
+
+    def matches(self, columns, row):
+        if not columns.loaded[row]:
+            return None
+        return self.regex.search(columns.bugs[row]) is not None
+
+
+class MessageTerm(QueryTerm):
+    """Messages are too big to keep in a column, so the rows are checked
+    as the revisions are loaded, and the results kept."""
+
+    cost = 4
+
+    def prepare(self, columns):
+        self.regex = compile_pattern(self.value)
+        self.checked = bytearray(columns.count)
+        self.matched = bytearray(columns.count)
+
+    def check(self, row, rev):
+        self.checked[row] = 1
+        self.matched[row] = self.regex.search(rev.message or "") is not None
+
+    def revisions_loaded(self, columns, revisions):
+        for row, revision in columns.iter_rows(revisions):
+            self.check(row, revision)
+
+    def matches(self, columns, row):
+        if not self.checked[row]:
+            rev = cached_revisions.get(columns.revids[row])
+            if rev is None:
+                return None
+            self.check(row, rev)
+        return bool(self.matched[row])
+
+
+TERMS = {
+    "message": MessageTerm,
+    "author": AuthorTerm,
+    "date": DateTerm,
+    "bug": BugTerm,
+    "tag": TagTerm,
+    }
+
+
+class Query(object):
+    """A query, parsed from a string."""
+
+    def __init__(self, s):
+        self.terms = []
+        for m in _query_re.finditer(s):
+            value = m.group("quoted")
+            if value is None:
+                value = m.group("value")
+            field = m.group("field") or "message"
+            negate = bool(m.group("negate"))
+            if not value:
+                # Still being typed.
+                continue
+            term = TERMS[field](value, negate)
+            if isinstance(term, DateTerm) and term.start is None and term.end is None:
+                continue
+            self.terms.append(term)
+
+    def use_search_indexes(self, search_indexes, revids):
+        """Replace the terms that the search indexes can answer with the
+        revids that they match, if all of revids are indexed."""
+        if not all(any(revid in index.indexed for index in search_indexes)
+                   for revid in revids if isinstance(revid, bytes)):
+            return
+        terms = []
+        for term in self.terms:
+            field = {MessageTerm: "message", AuthorTerm: "author",
+                     BugTerm: "bug"}.get(type(term))
+            if field is not None and SearchQuery.can_search(term.value):
+                query = SearchQuery(term.value)
+                matched_revids = set()
+                for index in search_indexes:
+                    matched_revids.update(index.search(field, query))
+                term = RevidsTerm(term.value, term.negate, matched_revids)
+            terms.append(term)
+        self.terms = terms
+
+    @property
+    def needs_revisions(self):
+        return any(term.needs_revisions for term in self.terms)
+
+    def prepare(self, columns):
+        self.terms.sort(key=lambda term: term.order)
+        for term in self.terms:
+            term.prepare(columns)
+
+    def revisions_loaded(self, columns, revisions):
+        """Fill in the columns and check the terms for revisions, a dict of
+        revid to Revision, as they are loaded."""
+        columns.update_revisions(revisions)
+        for term in self.terms:
+            term.revisions_loaded(columns, revisions)
+
+    def matches(self, columns, row):
+        """Return whether a row matches all the terms. Rows that are not
+        loaded don't match terms that need them."""
+        columns.update_row(row)
+        for term in self.terms:
+            match = term.matches(columns, row)
+            if match is None or match == term.negate:
+                return False
+        return True
+
+    def get_visible(self, columns):
+        """Return a bytearray with a 1 for each row that matches.
+
+        Each term is checked in one pass over the rows that are still
+        visible, starting with the cheapest."""
+        rows = range(columns.count)
+        if self.needs_revisions:
+            for row in rows:
+                if not columns.loaded[row]:
+                    columns.update_row(row)
+        visible = bytearray(b"\x01") * columns.count
+        for term in self.terms:
+            matches = term.matches
+            negate = term.negate
+            for row in compress(rows, visible):
+                match = matches(columns, row)
+                if match is None or match == negate:
+                    visible[row] = 0
+        return visible
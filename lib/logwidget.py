@@ -89,12 +89,17 @@ class LogList(RevisionTreeView):
             self.doubleClicked[QtCore.QModelIndex].connect(self.default_action)
         self.context_menu = QtWidgets.QMenu(self)
         self.context_menu_initialized = False
+        # When the rows fit in the view, there is nothing to scroll, so more
+        # is loaded when the view is shown or resized.
+        self.verticalScrollBar().rangeChanged[int, int].connect(
+            self.load_more_if_near_end)
 
     def load(self, *args, **kargs):
         self.load_args = (args, kargs)
         self.log_model.load(*args, **kargs)
         self.create_context_menu()
         self._adjust_revno_column()
+        self.load_more_if_near_end()
 
     @runs_in_loading_queue
     @ui_current_widget
@@ -102,6 +107,42 @@ class LogList(RevisionTreeView):
         (args, kargs) = self.load_args
         self.load(*args, **kargs)
 
+    def scroll_changed(self, value):
+        RevisionTreeView.scroll_changed(self, value)
+        self.load_more_if_near_end()
+
+    def load_more_if_near_end(self, *args):
+        if (self.log_model.graph_viz.truncated_revid is not None and
+                self.is_scrolled_near_end()):
+            QtCore.QTimer.singleShot(1, self.load_more)
+
+    def is_scrolled_near_end(self):
+        """Return True if the log is scrolled to near the end, or the rows
+        fit in the view, so it can't be scrolled."""
+        if not self.isVisible():
+            return False
+        # Make sure that the range of the scroll bar is for the rows that
+        # are loaded now.
+        self.executeDelayedItemsLayout()
+        scroll_bar = self.verticalScrollBar()
+        return scroll_bar.value() >= scroll_bar.maximum() - scroll_bar.pageStep()
+
+    @runs_in_loading_queue
+    @ui_current_widget
+    def load_more(self):
+        """Load twice as much of the mainline, when only the most recent
+        history was loaded, and the log is scrolled to near the end, or it
+        all fits in the view."""
+        graph_viz = self.log_model.graph_viz
+        if graph_viz.truncated_revid is None or not self.is_scrolled_near_end():
+            return
+        (args, kargs) = self.load_args
+        kargs = dict(kargs)
+        truncated_revno = graph_viz.revno_offset + 1
+        kargs["limit"] = max(graph_viz.max_mainline_revno - truncated_revno, 1) * 2
+        kargs["since"] = None
+        self.load(*args, **kargs)
+
     def create_context_menu(self, diff_is_default_action=True):
         if self.context_menu_initialized:
             return
@@ -337,6 +378,10 @@ class LogList(RevisionTreeView):
     def set_search(self, str, field):
         self.log_model.prop_search_filter.set_search(str, field)
 
+    def set_content_search(self, str):
+        if self.log_model.content_search_filter is not None:
+            self.log_model.content_search_filter.set_search(str)
+
     def default_action(self, index=None):
         self.show_diff_specified_files()
 
@@ -589,8 +634,8 @@ class BranchMenu(QtWidgets.QMenu):
         for action in self.actions():
             branch_info = action.data()
             branch_tip = branch_info.branch.last_revision()
-            is_ancestor_ = (
-                frozenset((branch_tip,)) == self.graphprovider.known_graph.heads((branch_tip, rev)))
+            is_ancestor_ = self.graphprovider.ancestry_index.is_ancestor(
+                rev, branch_tip)
             visible = is_ancestor_ == is_ancestor
             action.setVisible(visible)
             if visible:
@@ -33,7 +33,7 @@ from breezy import (
 from breezy.plugins.qbrz.lib.i18n import gettext, ngettext
 
 from breezy.plugins.qbrz.lib.lazycachedrevloader import (
-        load_revisions, cached_revisions)
+        get_revision_loader, cached_revisions)
 from breezy.plugins.qbrz.lib.util import (
     runs_in_loading_queue,
     format_timestamp,
@@ -115,6 +115,7 @@ class RevisionMessageBrowser(QtWidgets.QTextBrowser):
         # TODO(jelmer): Use branch stack
         conf = config.GlobalStack()
         self._gpg_strategy = gpg.GPGStrategy(conf)
+        self._load_request = None
 
         boxsize = self.fontMetrics().ascent()
         center = boxsize * 0.5
@@ -169,7 +170,12 @@ class RevisionMessageBrowser(QtWidgets.QTextBrowser):
             revids_to_load.update(set(self.get_parents(revid)))
             revids_to_load.update(set(self.get_children(revid)))
 
-        load_revisions(list(revids_to_load), repo, revisions_loaded=self.revisions_loaded, pass_prev_loaded_rev=True)
+        cached_revisions.pin(self, revids_to_load)
+        if self._load_request is not None:
+            self._load_request.cancel()
+        self._load_request = get_revision_loader().submit(
+            list(revids_to_load), repo, revisions_loaded=self.revisions_loaded,
+            pass_prev_loaded_rev=True, priority=10)
 
     def revisions_loaded(self, revs_loaded, last_call):
         self._all_loaded_revs.update(revs_loaded)
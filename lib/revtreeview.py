@@ -17,20 +17,38 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
+import time
+
 from PyQt5 import QtCore, QtGui, QtWidgets
 from breezy.plugins.qbrz.lib import MS_WINDOWS
-from breezy.plugins.qbrz.lib.util import run_in_loading_queue
-from breezy.plugins.qbrz.lib.lazycachedrevloader import load_revisions
+from breezy.plugins.qbrz.lib.util import run_in_loading_queue, get_qbrz_config
+from breezy.plugins.qbrz.lib.lazycachedrevloader import (
+    get_revision_loader, cached_summaries)
 from breezy.plugins.qbrz.lib.diff import ExtDiffContext
-from breezy.transport.local import LocalTransport
 
 RevIdRole = QtCore.Qt.UserRole + 1
 
+DEFAULT_PREFETCH_PAGES = 2
+"""Default number of pages of revisions to load ahead of the scroll
+direction."""
+
+MAX_PREFETCH_PAGES = 10
+
+
+def get_prefetch_pages():
+    pages = get_qbrz_config().get_option('revision_prefetch_pages')
+    try:
+        return max(0, float(pages))
+    except (TypeError, ValueError):
+        return DEFAULT_PREFETCH_PAGES
+
 
 class RevisionTreeView(QtWidgets.QTreeView):
     """TreeView widget to shows revisions.
 
-    Only revisions that are visible on screen are loaded.
+    Revisions that are visible on screen are loaded, followed, at a lower
+    priority, by a few pages in the direction of scrolling, and half a page
+    in the other direction, so that they are there when they are scrolled to.
 
     The model for this tree view must have the following methods:
     def on_revisions_loaded(self, revisions, last_call)
@@ -44,8 +62,19 @@ class RevisionTreeView(QtWidgets.QTreeView):
         self.collapsed[QtCore.QModelIndex].connect(self.collapsed_expanded)
         self.expanded[QtCore.QModelIndex].connect(self.collapsed_expanded)
 
-        self.load_revisions_call_count = 0
-        self.load_revisions_throbber_shown = False
+        self.load_revisions_request = None
+        self.prefetch_request = None
+        self.prefetch_pages = get_prefetch_pages()
+        self.scroll_direction = 1
+        self.scroll_speed = 0
+        """Pages a second."""
+        self.last_scroll_value = 0
+        self.last_scroll_time = 0
+        # Load once a burst of scroll events has stopped.
+        self.scroll_timer = QtCore.QTimer(self)
+        self.scroll_timer.setSingleShot(True)
+        self.scroll_timer.setInterval(50)
+        self.scroll_timer.timeout.connect(self.load_visible_revisions)
         self.revision_loading_disabled = False
         self.diff_context = ExtDiffContext(self)
 
@@ -67,7 +96,19 @@ class RevisionTreeView(QtWidgets.QTreeView):
             model.layoutChanged.connect(self.layout_changed)
 
     def scroll_changed(self, value):
-        self.load_visible_revisions()
+        now = time.monotonic()
+        delta = value - self.last_scroll_value
+        elapsed = now - self.last_scroll_time
+        page_step = max(self.verticalScrollBar().pageStep(), 1)
+        if delta:
+            self.scroll_direction = 1 if delta > 0 else -1
+        if elapsed > 0.5:
+            self.scroll_speed = 0
+        elif elapsed > 0:
+            self.scroll_speed = abs(delta) / page_step / elapsed
+        self.last_scroll_value = value
+        self.last_scroll_time = now
+        self.scroll_timer.start()
 
     def data_changed(self, start_index, end_index):
         self.load_visible_revisions()
@@ -97,59 +138,77 @@ class RevisionTreeView(QtWidgets.QTreeView):
         #    throbber_height = self.throbber.   etc...
         bottom_index = self.indexAt(self.viewport().rect().bottomLeft())  # + throbber_height
 
+        top_index = index
         revids = []
+        rows = 0
         while True:
+            rows += 1
             revid = index.data(RevIdRole)
             if revid is not None:
                 if revid not in revids:
                     revids.append(revid)
             if index == bottom_index:
                 break
-            index = self.indexBelow(index)
-            if not index.isValid():
+            next_index = self.indexBelow(index)
+            if not next_index.isValid():
                 break
+            index = next_index
+        bottom_index = index
 
         revids = list(revids)
         if len(revids) == 0:
             return
+        # Don't let the revisions that we are displaying be evicted.
+        cached_summaries.pin(model, revids)
+
+        request = self.load_revisions_request
+        if not (request is not None and request.is_active()
+                and request.revids == revids):
+            # The previously visible revisions are no longer needed.
+            if request is not None:
+                request.cancel()
+            self.load_revisions_request = get_revision_loader().submit(
+                revids, model.get_repo(),
+                revisions_loaded=model.on_revisions_loaded, priority=10,
+                summaries=True)
+
+        self._prefetch_revisions(top_index, bottom_index, rows)
+
+    def _prefetch_revisions(self, top_index, bottom_index, rows):
+        """Load the revisions of the rows near the visible rows, mostly in
+        the direction of scrolling. Scrolling faster loads further ahead, up
+        to a second of scrolling."""
+        pages_ahead = min(max(self.prefetch_pages, self.scroll_speed),
+                          MAX_PREFETCH_PAGES)
+        if not pages_ahead:
+            return
+        rows_ahead = int(rows * pages_ahead)
+        rows_behind = rows // 2
+        if self.scroll_direction < 0:
+            rows_ahead, rows_behind = rows_behind, rows_ahead
+
+        revids = []
+        for index, count, step in ((bottom_index, rows_ahead, self.indexBelow),
+                                   (top_index, rows_behind, self.indexAbove)):
+            for i in range(count):
+                index = step(index)
+                if not index.isValid():
+                    break
+                revid = index.data(RevIdRole)
+                if revid is not None and revid not in cached_summaries:
+                    revids.append(revid)
 
-        self.load_revisions_call_count += 1
-        current_call_count = self.load_revisions_call_count
-
-        def before_batch_load(repo, revids):
-            if current_call_count < self.load_revisions_call_count:
-                return True
-
-            repo_is_local = isinstance(repo.controldir.transport, LocalTransport)
-            if not repo_is_local:
-                # Disable this until we have thobber that does not irratate
-                # users when we show and hide quickly.
-                # if not self.load_revisions_throbber_shown \
-                #            and hasattr(self, "throbber"):
-                #    self.throbber.show()
-                #    self.load_revisions_throbber_shown = True
-                # Allow for more scrolling to happen.
-                self.delay(500)
-
-            return False
-
-        try:
-            load_revisions(revids, model.get_repo(), revisions_loaded=model.on_revisions_loaded, before_batch_load=before_batch_load)
-        finally:
-            self.load_revisions_call_count -= 1
-            if self.load_revisions_call_count == 0:
-                # This is the last running method
-                if self.load_revisions_throbber_shown:
-                    self.load_revisions_throbber_shown = False
-                    self.throbber.hide()
-
-    def delay(self, timeout):
-
-        def null():
-            pass
-
-        QtCore.QTimer.singleShot(timeout, null)
-        QtCore.QCoreApplication.processEvents(QtCore.QEventLoop.WaitForMoreEvents)
+        request = self.prefetch_request
+        if request is not None:
+            if request.is_active() and set(revids) <= set(request.revids):
+                return
+            request.cancel()
+        self.prefetch_request = None
+        if revids:
+            # Nothing is passed back: they only need to be in the cache
+            # when they are scrolled to.
+            self.prefetch_request = get_revision_loader().submit(
+                revids, self.model().get_repo(), priority=0, summaries=True)
 
 
 has_vista_style = hasattr(QtGui, "QWindowsVistaStyle")
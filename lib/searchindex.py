@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+#
+# QBzr - Qt frontend to Bazaar commands
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""Persistent full text index of the message, authors and bugs of the
+revisions in a repository, so that qlog can search them without loading the
+revisions."""
+
+import fnmatch
+import hashlib
+import os
+import re
+import sqlite3
+
+from breezy import bedding, osutils, trace
+
+from breezy.plugins.qbrz.lib.util import get_apparent_author, get_qbrz_config
+
+FIELDS = {
+    "message": 1,
+    "author": 2,
+    "bug": 3,
+    }
+"""Fields that are indexed, and their ids in the index."""
+
+_token_re = re.compile(r"\w+", re.UNICODE)
+_word_re = re.compile(r"\w+\Z", re.UNICODE)
+
+
+def tokenize(text):
+    """Return the set of lower case words in text."""
+    return set(_token_re.findall(text.lower()))
+
+
+def compile_pattern(s):
+    """Compile a search pattern of qlog. It is a shell pattern that matches
+    text that has it anywhere in it, ignoring case."""
+    return re.compile(fnmatch.translate(s + '*'), re.IGNORECASE)
+
+
+def get_field_texts(rev):
+    """Return a dict of field id to the text of a revision that is
+    indexed."""
+    return {
+        FIELDS["message"]: rev.message or "",
+        FIELDS["author"]: get_apparent_author(rev),
+        FIELDS["bug"]: rev.properties.get('bugs', ''),
+        }
+
+
+class SearchQuery(object):
+    """A search for the revisions that have a pattern in a field, which
+    matches the same as compile_pattern.
+
+    The index can only answer it if the pattern is a single word, with no
+    wildcards, as then what it matches is always part of one word of the
+    text. See can_search.
+    """
+
+    def __init__(self, s):
+        self.word = s.lower()
+        self.regex = compile_pattern(s)
+
+    @staticmethod
+    def can_search(s):
+        """Return True if the index can answer a search for s."""
+        return _word_re.match(s) is not None
+
+    def matches_text(self, text):
+        return self.regex.search(text) is not None
+
+
+class SearchIndex(object):
+    """Inverted index of words to revisions for one repository, kept in a
+    sqlite database.
+
+    Revisions are added as they are loaded. indexed holds the revids that
+    have been added, so that the caller knows which revisions still need to
+    be loaded and added before the index can answer for them.
+
+    If the database can't be used, the index disables itself.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.disabled = False
+        self._conn = None
+        self._indexed = None
+        self._doc_revids = None
+        self._vocab = None
+
+    def _connect(self):
+        if self._conn is None and not self.disabled:
+            try:
+                dirname = os.path.dirname(self.filename)
+                if not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                conn = sqlite3.connect(self.filename, timeout=1)
+                conn.executescript("""
+                    CREATE TABLE IF NOT EXISTS docs
+                        (doc INTEGER PRIMARY KEY, revid BLOB UNIQUE NOT NULL);
+                    CREATE TABLE IF NOT EXISTS vocab
+                        (term INTEGER PRIMARY KEY, field INTEGER NOT NULL,
+                         token TEXT NOT NULL, UNIQUE (field, token));
+                    CREATE TABLE IF NOT EXISTS postings
+                        (term INTEGER, doc INTEGER, PRIMARY KEY (term, doc))
+                        WITHOUT ROWID;
+                    """)
+                self._conn = conn
+            except (sqlite3.Error, OSError) as e:
+                self._error(e)
+        return self._conn
+
+    def _error(self, e):
+        trace.mutter("qbrz: disabling search index %s: %s", self.filename, e)
+        self.disabled = True
+        self.close()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        self._indexed = self._doc_revids = self._vocab = None
+
+    def _load_docs(self):
+        if self._doc_revids is None:
+            conn = self._connect()
+            if conn is None:
+                return False
+            try:
+                self._doc_revids = dict(
+                    (doc, bytes(revid)) for doc, revid in
+                    conn.execute("SELECT doc, revid FROM docs"))
+            except sqlite3.Error as e:
+                self._error(e)
+                return False
+            self._indexed = set(self._doc_revids.values())
+        return True
+
+    @property
+    def indexed(self):
+        """Set of the revids that are in the index."""
+        if not self._load_docs():
+            return frozenset()
+        return self._indexed
+
+    def add_revisions(self, revisions):
+        """Add revisions that are not already in the index."""
+        if not self._load_docs():
+            return
+        revisions = [rev for rev in revisions
+                     if isinstance(rev.revision_id, bytes) and
+                     rev.revision_id not in self._indexed]
+        if not revisions:
+            return
+        conn = self._conn
+        try:
+            if self._vocab is None:
+                self._vocab = dict(
+                    ((field, token), term) for term, field, token in
+                    conn.execute("SELECT term, field, token FROM vocab"))
+            vocab = self._vocab
+            with conn:
+                postings = []
+                for rev in revisions:
+                    cursor = conn.execute(
+                        "INSERT OR IGNORE INTO docs (revid) VALUES (?)",
+                        (rev.revision_id,))
+                    if cursor.rowcount == 0:
+                        # Another process has indexed it.
+                        continue
+                    doc = cursor.lastrowid
+                    self._doc_revids[doc] = rev.revision_id
+                    for field, text in get_field_texts(rev).items():
+                        for token in tokenize(text):
+                            key = (field, token)
+                            term = vocab.get(key)
+                            if term is None:
+                                conn.execute(
+                                    "INSERT OR IGNORE INTO vocab (field, token) "
+                                    "VALUES (?, ?)", key)
+                                term = conn.execute(
+                                    "SELECT term FROM vocab WHERE field = ? "
+                                    "AND token = ?", key).fetchone()[0]
+                                vocab[key] = term
+                            postings.append((term, doc))
+                conn.executemany(
+                    "INSERT OR IGNORE INTO postings (term, doc) VALUES (?, ?)",
+                    postings)
+        except sqlite3.Error as e:
+            self._error(e)
+            return
+        self._indexed.update(rev.revision_id for rev in revisions)
+
+    def search(self, field, query):
+        """Return the set of revids that match query in field.
+
+        :param field: name of a field in FIELDS.
+        :param query: SearchQuery, that the index can search.
+        """
+        if not self._load_docs():
+            return set()
+        field = FIELDS[field]
+        conn = self._conn
+        docs = set()
+        try:
+            # All the words that have the query's word in them.
+            terms = [term for (term,) in conn.execute(
+                "SELECT term FROM vocab WHERE field = ? AND instr(token, ?)",
+                (field, query.word))]
+            for offset in range(0, len(terms), 500):
+                batch = terms[offset:offset + 500]
+                docs.update(doc for (doc,) in conn.execute(
+                    "SELECT doc FROM postings WHERE term IN (%s)"
+                    % ",".join("?" * len(batch)), batch))
+        except sqlite3.Error as e:
+            self._error(e)
+            return set()
+        doc_revids = self._doc_revids
+        return set(doc_revids[doc] for doc in docs if doc in doc_revids)
+
+
+_search_indexes = {}
+
+def get_search_index(repo):
+    """Get the SearchIndex of a repository, or None if indexing is disabled
+    by the search_index option of qbrz.conf."""
+    if get_qbrz_config().get_option_as_bool('search_index') is False:
+        return None
+    base = repo.base
+    index = _search_indexes.get(base)
+    if index is None:
+        name = hashlib.sha1(base.encode("utf-8")).hexdigest()
+        index = _search_indexes[base] = SearchIndex(osutils.pathjoin(
+            bedding.cache_dir(), 'qbrz', 'search', name + '.sqlite'))
+    if index.disabled:
+        return None
+    return index
@@ -45,11 +45,16 @@ def load_tests(loader, basic_tests, pattern):
         # 'test_diffview',  # - broken by API changes
         'test_extra_isignored',
         'test_extra_isversioned',
+        'test_fileindex',
+        'test_filelistcache',
         'test_i18n',
+        'test_lazycachedrevloader',
         'test_log',
         'test_loggraphviz',
         'test_logmodel',
+        'test_logquery',
         'test_revisionmessagebrowser',
+        'test_searchindex',
         #  RJLRJL ignore spellcheck for now
         'test_spellcheck',
         'test_subprocess',
@@ -88,6 +93,11 @@ class QTestCase(tests.TestCaseWithTransport):
                 raise eclass(evalue).with_traceback(tb)
             self.addCleanup(_reraise_on_cleanup)
         self.overrideAttr(sys, "excepthook", excepthook_tests)
+        # The revision loader is shared by all the windows, so stop its
+        # worker threads once the windows of the test have been closed.
+        from breezy.plugins.qbrz.lib.lazycachedrevloader import (
+            get_revision_loader)
+        self.addCleanup(lambda: get_revision_loader().stop())
 
     def waitUntil(self, break_condition, timeout, timeout_msg=None):
         erapsed = 0
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+#
+# QBzr - Qt frontend to Bazaar commands
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""
+Benchmarks for loggraphviz, on synthetic histories that are generated in
+memory.
+
+This is not part of the test suite, as it takes a long time to run. Run it
+with::
+
+  python -m breezy.plugins.qbrz.lib.tests.benchmark_loggraphviz \\
+      --sizes 1000,10000,100000,500000 --output results.json
+
+For each history shape and size, the time, memory and number of objects of
+each phase of GraphVizLoader.load and of compute_viz are reported as JSON, so
+that results can be compared between releases.
+"""
+
+if __name__ == '__main__':
+    import breezy
+    breezy.initialize()
+    import breezy.plugin
+    breezy.plugin.load_plugins()
+
+import gc
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from breezy.graph import DictParentsProvider
+from breezy.transport.local import LocalTransport
+
+from breezy.plugins.qbrz.lib import loggraphviz
+
+
+def revid(prefix, i):
+    return b"%s-%d" % (prefix, i)
+
+
+def linear_history(size):
+    """A trunk with no merges."""
+    parent_map = {}
+    parent = None
+    for i in range(size):
+        rev = revid(b"trunk", i)
+        parent_map[rev] = (parent,) if parent else ()
+        parent = rev
+    return parent_map, [parent]
+
+
+def feature_branch_history(size, branch_length=3):
+    """A trunk where every revision merges a short feature branch."""
+    parent_map = {}
+    parent = None
+    i = 0
+    while i < size:
+        branch_parent = parent
+        for j in range(min(branch_length, size - i - 1)):
+            rev = revid(b"feature", i)
+            parent_map[rev] = (branch_parent,) if branch_parent else ()
+            branch_parent = rev
+            i += 1
+        rev = revid(b"trunk", i)
+        parents = (parent,) if parent else ()
+        if branch_parent != parent:
+            parents += (branch_parent,)
+        parent_map[rev] = parents
+        parent = rev
+        i += 1
+    return parent_map, [parent]
+
+
+def octopus_history(size, branch_count=6, branch_length=2):
+    """A trunk where every revision merges several short branches at once."""
+    parent_map = {}
+    parent = None
+    i = 0
+    while i < size:
+        parents = [parent] if parent else []
+        for b in range(branch_count):
+            branch_parent = parent
+            for j in range(branch_length):
+                if i >= size - 1:
+                    break
+                rev = revid(b"octopus", i)
+                parent_map[rev] = (branch_parent,) if branch_parent else ()
+                branch_parent = rev
+                i += 1
+            if branch_parent is not None and branch_parent not in parents:
+                parents.append(branch_parent)
+        rev = revid(b"trunk", i)
+        parent_map[rev] = tuple(parents)
+        parent = rev
+        i += 1
+    return parent_map, [parent]
+
+
+def many_heads_history(size, head_count=50, branch_length=5):
+    """A feature branch history, with head_count unmerged branches that
+    start from random points on the trunk."""
+    parent_map, heads = feature_branch_history(size - head_count * branch_length)
+    trunk = [rev for rev in parent_map if rev.startswith(b"trunk-")]
+    r = random.Random(0)
+    heads = list(heads)
+    i = len(parent_map)
+    for h in range(head_count):
+        parent = r.choice(trunk)
+        for j in range(branch_length):
+            rev = revid(b"head", i)
+            parent_map[rev] = (parent,)
+            parent = rev
+            i += 1
+        heads.append(parent)
+    return parent_map, heads
+
+
+histories = {
+    "linear": linear_history,
+    "feature-branches": feature_branch_history,
+    "octopus": octopus_history,
+    "many-heads": many_heads_history,
+}
+
+
+class FakeRevision(object):
+
+    def __init__(self, revision_id, timestamp):
+        self.revision_id = revision_id
+        self.timestamp = timestamp
+
+
+class FakeControlDir(object):
+
+    def __init__(self):
+        # Local, so that GraphVizLoader does not look for a repository in
+        # the current directory.
+        self.transport = LocalTransport("file:///")
+
+
+class FakeRepository(object):
+    """Repository that gets its graph from a dict of parents."""
+
+    def __init__(self, parent_map):
+        self.base = "memory:///repo/"
+        self.controldir = FakeControlDir()
+        self.parent_map = parent_map
+
+    def lock_read(self):
+        return self
+
+    def unlock(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def _make_parents_provider(self):
+        return DictParentsProvider(self.parent_map)
+
+    def get_revisions(self, revids):
+        # The order of the heads is what matters for the timestamp.
+        return [FakeRevision(revid, len(revid)) for revid in revids]
+
+
+class FakeTags(object):
+
+    def get_reverse_tag_dict(self):
+        return {}
+
+
+class FakeBranch(object):
+
+    def __init__(self, repository, name, last_revision):
+        self.base = "memory:///%s/" % name
+        self.repository = repository
+        self.tags = FakeTags()
+        self._last_revision = last_revision
+
+    def lock_read(self):
+        return self
+
+    def unlock(self):
+        pass
+
+    def last_revision(self):
+        return self._last_revision
+
+    def last_revision_info(self):
+        parent_map = self.repository.parent_map
+        revno = 0
+        revid = self._last_revision
+        while revid:
+            revno += 1
+            parents = parent_map[revid]
+            revid = parents[0] if parents else None
+        return revno, self._last_revision
+
+
+load_phases = (
+    "load_graph_parents",
+    "process_graph_parents",
+    "compute_head_info",
+    "compute_branch_lines",
+    "compute_merge_info",
+    "load_tags",
+    )
+
+
+class PhaseRecorder(object):
+    """Records the time, and optionally the memory, of each phase."""
+
+    def __init__(self, measure_memory):
+        self.measure_memory = measure_memory
+        self.results = []
+        self.peaks = []
+        """Peak memory so far of each phase that is running. Phases may be
+        nested, and tracemalloc only has one peak."""
+
+    def run(self, phase, func, *args, **kwargs):
+        if self.measure_memory:
+            gc.collect()
+            objects_before = len(gc.get_objects())
+            if self.peaks:
+                self.peaks[-1] = max(self.peaks[-1],
+                                     tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+            self.peaks.append(memory_before)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            result = {"phase": phase,
+                      "seconds": time.perf_counter() - start}
+            if self.measure_memory:
+                memory_after, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, self.peaks.pop())
+                if self.peaks:
+                    self.peaks[-1] = max(self.peaks[-1], peak)
+                result["peak_bytes"] = peak - memory_before
+                result["retained_bytes"] = memory_after - memory_before
+                result["objects"] = len(gc.get_objects()) - objects_before
+            self.results.append(result)
+
+    def wrap(self, phase, func):
+        def wrapped(*args, **kwargs):
+            return self.run(phase, func, *args, **kwargs)
+        return wrapped
+
+
+def make_loader(parent_map, heads):
+    repo = FakeRepository(parent_map)
+    branches = [loggraphviz.BranchInfo("head-%d" % i, None,
+                                       FakeBranch(repo, "head-%d" % i, head))
+                for i, head in enumerate(heads)]
+    return loggraphviz.GraphVizLoader(branches, branches[0], False)
+
+
+def run_benchmark(history, size, measure_memory=False):
+    """Load and layout a generated history.
+
+    :return: list of dicts, one for each phase.
+    """
+    parent_map, heads = histories[history](size)
+    gv = make_loader(parent_map, heads)
+    recorder = PhaseRecorder(measure_memory)
+    if measure_memory:
+        tracemalloc.start()
+    try:
+        for phase in load_phases:
+            setattr(gv, phase, recorder.wrap(phase, getattr(gv, phase)))
+        recorder.run("load", gv.load)
+
+        state = loggraphviz.GraphVizFilterState(gv)
+        recorder.run("compute_viz", gv.compute_viz, state)
+        state.expand_all_branch_lines()
+        computed = recorder.run("compute_viz_expanded", gv.compute_viz, state)
+        recorder.run("compute_lines", computed.compute_lines,
+                     0, min(50, len(computed.filtered_revs)) - 1)
+    finally:
+        if measure_memory:
+            tracemalloc.stop()
+
+    for result in recorder.results:
+        result["history"] = history
+        result["size"] = size
+        result["revisions"] = len(gv.revisions)
+    return recorder.results
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Benchmark loggraphviz on synthetic histories.")
+    parser.add_argument(
+        "--sizes", default="1000,10000,100000",
+        help="Comma separated list of history sizes (default: %(default)s).")
+    parser.add_argument(
+        "--histories", default=",".join(sorted(histories)),
+        help="Comma separated list of history shapes (default: %(default)s).")
+    parser.add_argument(
+        "--no-memory", action="store_true",
+        help="Don't measure memory and objects. tracemalloc makes the "
+             "phases a lot slower, so memory is measured in a second run.")
+    parser.add_argument("--output", help="Write the results to this file.")
+    args = parser.parse_args(argv)
+
+    results = []
+    for history in args.histories.split(","):
+        for size in [int(size) for size in args.sizes.split(",")]:
+            timings = run_benchmark(history, size)
+            if not args.no_memory:
+                memory = run_benchmark(history, size, measure_memory=True)
+                for timing, result in zip(timings, memory):
+                    for key in ("peak_bytes", "retained_bytes", "objects"):
+                        timing[key] = result[key]
+            for result in timings:
+                sys.stderr.write(
+                    "%(history)s %(size)d %(phase)s: %(seconds).3fs\n" % result)
+            results.extend(timings)
+
+    from breezy.plugins.qbrz import version_info
+    report = {
+        "qbrz_version": ".".join([str(i) for i in version_info[:3]]),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+        }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        sys.stdout.write("\n")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+#
+# QBzr - Qt frontend to Bazaar commands
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import os
+
+from breezy.tests import TestCaseWithTransport
+
+from breezy.plugins.qbrz.lib import loggraphviz
+from breezy.plugins.qbrz.lib.fileindex import (
+    FileChangesIndex, load_rollup_rows)
+
+
+class IndexedGraphVizLoader(loggraphviz.GraphVizLoader):
+
+    index = None
+
+    def get_file_changes_index(self, repo):
+        return self.index
+
+
+class ProcessPoolGraphVizLoader(IndexedGraphVizLoader):
+
+    pool = None
+
+    def get_file_id_process_pool(self):
+        return self.pool
+
+
+class RecordingPool(object):
+    """Pool of processes that records the functions submitted to it."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.functions = set()
+
+    def submit(self, function, *args):
+        self.functions.add(function)
+        return self.pool.submit(function, *args)
+
+
+class TestFileChangesIndex(TestCaseWithTransport):
+
+    def make_tree(self):
+        wt = self.make_branch_and_tree('.')
+        self.build_tree(['dir/', 'dir/sub/', 'dir/sub/a', 'b'])
+        wt.add(['dir', 'dir/sub', 'dir/sub/a', 'b'],
+               ids=[b'dir-id', b'sub-id', b'a-id', b'b-id'])
+        wt.commit('add', rev_id=b'rev-1')
+        self.build_tree_contents([('dir/sub/a', b'changed')])
+        wt.commit('change a', rev_id=b'rev-2')
+        self.build_tree_contents([('b', b'changed')])
+        wt.commit('change b', rev_id=b'rev-3')
+        wt.rename_one('dir/sub/a', 'a')
+        wt.commit('move a out', rev_id=b'rev-4')
+        return wt
+
+    def test_index(self):
+        repo = self.make_tree().branch.repository
+        index = FileChangesIndex('index.sqlite')
+        with repo.lock_read():
+            self.assertTrue(index.add_revisions(
+                repo, [b'rev-1', b'rev-2', b'rev-3', b'rev-4']))
+            self.assertEqual({(b'a-id', b'rev-1'), (b'a-id', b'rev-2'),
+                              (b'a-id', b'rev-4')},
+                             index.get_text_keys([b'a-id']))
+            self.assertEqual({(b'dir-id', b'rev-1')},
+                             index.get_text_keys([b'dir-id']))
+            self.assertTrue(index.add_rollups(
+                repo, [b'rev-1', b'rev-2', b'rev-3', b'rev-4']))
+        # a is not in dir once it has been moved out.
+        self.assertEqual({(b'dir-id', b'rev-1'), (b'sub-id', b'rev-1'),
+                          (b'a-id', b'rev-1'), (b'a-id', b'rev-2')},
+                         index.get_text_keys([b'dir-id'], rolled_up=True))
+        index.close()
+
+        index = FileChangesIndex('index.sqlite')
+        self.assertEqual({b'rev-1', b'rev-2', b'rev-3', b'rev-4'},
+                         index.indexed)
+        self.assertEqual(index.indexed, index.rolled_up)
+
+    def get_visible_revids(self, wt, file_ids, index,
+                           gv_class=IndexedGraphVizLoader):
+        bi = loggraphviz.BranchInfo('', wt, wt.branch)
+        gv = gv_class([bi], bi, False)
+        gv.index = index
+        gv.load()
+        state = loggraphviz.GraphVizFilterState(gv)
+        file_id_filter = loggraphviz.FileIdFilter(
+            gv, state.filter_changed, file_ids)
+        # A chunk for each revision, so that there is more than one.
+        file_id_filter.inventory_chunk_size = 1
+        state.filters.append(file_id_filter)
+        file_id_filter.load()
+        return ([c_rev.rev.revid for c_rev in gv.compute_viz(state).filtered_revs],
+                file_id_filter.text_parent_maps[wt.branch.repository.base][1])
+
+    def test_file_id_filter(self):
+        wt = self.make_tree()
+        for file_ids in ([b'a-id'], [b'b-id'], [b'dir-id'], [b'sub-id', b'b-id']):
+            index = FileChangesIndex('index.sqlite')
+            self.assertEqual(self.get_visible_revids(wt, file_ids, None),
+                             self.get_visible_revids(wt, file_ids, index))
+            # Now answered from the index.
+            self.assertEqual(self.get_visible_revids(wt, file_ids, None),
+                             self.get_visible_revids(wt, file_ids, index))
+            self.assertFalse(index.disabled)
+            self.assertEqual(4, len(index.indexed))
+            index.close()
+
+
+    def make_process_pool(self):
+        # The processes import qbrz from where this process did, as the
+        # tests have their own plugin path.
+        plugin_dir = os.path.dirname(os.path.dirname(
+            os.path.abspath(loggraphviz.__file__)))
+        self.overrideEnv('BRZ_PLUGINS_AT', 'qbrz@' + plugin_dir)
+        pool = loggraphviz.make_process_pool(2)
+        self.addCleanup(pool.shutdown)
+        pool = RecordingPool(pool)
+        self.overrideAttr(ProcessPoolGraphVizLoader, 'pool', pool)
+        return pool
+
+    def test_file_id_filter_process_pool(self):
+        pool = self.make_process_pool()
+        wt = self.make_tree()
+        for file_ids in ([b'dir-id'], [b'sub-id', b'b-id']):
+            self.assertEqual(
+                self.get_visible_revids(wt, file_ids, None),
+                self.get_visible_revids(wt, file_ids, None,
+                                        ProcessPoolGraphVizLoader))
+        self.assertEqual({loggraphviz.load_chunk_text_parent_map},
+                         pool.functions)
+
+    def test_rollups_process_pool(self):
+        pool = self.make_process_pool()
+        wt = self.make_tree()
+        index = FileChangesIndex('index.sqlite')
+        self.assertEqual(
+            self.get_visible_revids(wt, [b'dir-id'], None),
+            self.get_visible_revids(wt, [b'dir-id'], index,
+                                    ProcessPoolGraphVizLoader))
+        self.assertEqual({load_rollup_rows}, pool.functions)
+        self.assertFalse(index.disabled)
+        self.assertEqual(index.indexed, index.rolled_up)
+        # a is not in dir once it has been moved out.
+        self.assertEqual({(b'dir-id', b'rev-1'), (b'sub-id', b'rev-1'),
+                          (b'a-id', b'rev-1'), (b'a-id', b'rev-2')},
+                         index.get_text_keys([b'dir-id'], rolled_up=True))
+        index.close()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#
+# QBzr - Qt frontend to Bazaar commands
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+from breezy.revision import CURRENT_REVISION, NULL_REVISION
+from breezy.tests import TestCase, TestCaseWithTransport
+
+from breezy.plugins.qbrz.lib.filelistcache import (
+    FileListCaches,
+    LRUCache,
+    get_file_list_caches,
+    iter_revision_deltas,
+    )
+
+
+class TestLRUCache(TestCase):
+
+    def make_cache(self, max_count, max_size=1000):
+        return LRUCache(max_count, max_size, len)
+
+    def test_evicts_least_recently_used(self):
+        cache = self.make_cache(2)
+        cache["a"] = "1"
+        cache["b"] = "2"
+        cache["a"]
+        cache["c"] = "3"
+        self.assertEqual(["a", "c"], cache.keys())
+        self.assertEqual(1, cache.evictions)
+
+    def test_evicts_to_max_size(self):
+        cache = self.make_cache(10, max_size=10)
+        cache["a"] = "x" * 4
+        cache["b"] = "x" * 4
+        cache["c"] = "x" * 4
+        self.assertEqual(["b", "c"], cache.keys())
+        self.assertEqual(8, cache.stats()["size"])
+        # An item that does not fit on its own is still kept.
+        cache["d"] = "x" * 20
+        self.assertEqual(["d"], cache.keys())
+
+    def test_resize(self):
+        cache = self.make_cache(10, max_size=10)
+        value = ["x"]
+        cache["a"] = "xxxx"
+        cache["b"] = value
+        value.extend("x" * 8)
+        self.assertEqual(5, cache.stats()["size"])
+        cache.resize("b")
+        self.assertEqual(["b"], cache.keys())
+        self.assertEqual(9, cache.stats()["size"])
+
+    def test_invalidate(self):
+        cache = self.make_cache(10)
+        for key in ("a1", "a2", "b1"):
+            cache[key] = "x"
+        self.assertEqual(2, cache.invalidate(lambda key: key[0] == "a"))
+        self.assertEqual(["b1"], cache.keys())
+        self.assertEqual(1, cache.stats()["size"])
+
+
+class TestFileListCaches(TestCaseWithTransport):
+
+    def test_invalidate(self):
+        caches = FileListCaches(tree_size=10000000, delta_size=10000000)
+        wt_revid = CURRENT_REVISION + b"/tree"
+        caches.trees[b"rev-1"] = object()
+        caches.trees[b"rev-2"] = object()
+        caches.deltas[(b"rev-2", b"rev-1")] = None
+        caches.deltas[(wt_revid, b"rev-2")] = None
+
+        caches.invalidate_working_trees()
+        self.assertEqual([(b"rev-2", b"rev-1")], caches.deltas.keys())
+
+        caches.deltas[(wt_revid, b"rev-2")] = None
+        caches.invalidate_revids([b"rev-1"])
+        self.assertEqual([b"rev-2"], caches.trees.keys())
+        self.assertEqual([(wt_revid, b"rev-2")], caches.deltas.keys())
+
+    def test_shared_by_repository(self):
+        repo = self.make_repository('repo')
+        other_repo = self.make_repository('other')
+        self.assertTrue(get_file_list_caches(repo) is
+                        get_file_list_caches(repo.controldir.open_repository()))
+        self.assertFalse(get_file_list_caches(repo) is
+                         get_file_list_caches(other_repo))
+
+
+class TestRevisionDeltas(TestCaseWithTransport):
+
+    def test_iter_revision_deltas(self):
+        wt = self.make_branch_and_tree('.')
+        self.build_tree(['a', 'b'])
+        wt.add(['a'])
+        wt.commit('add a', rev_id=b'rev-1')
+        wt.add(['b'])
+        wt.rename_one('a', 'c')
+        wt.commit('add b', rev_id=b'rev-2')
+        repo = wt.branch.repository
+        with repo.lock_read():
+            revisions = repo.get_revisions([b'rev-2', b'rev-1'])
+            deltas = list(iter_revision_deltas(repo, revisions))
+            self.assertEqual([(b'rev-2', b'rev-1'), (b'rev-1', NULL_REVISION)],
+                             [key for key, delta in deltas])
+            for key, delta in deltas:
+                self.assertEqual(
+                    repo.revision_tree(key[0]).changes_from(
+                        repo.revision_tree(key[1])),
+                    delta)
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+#
+# QBzr - Qt frontend to Bazaar commands
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import gc
+
+from breezy.revision import Revision
+from breezy.tests import TestCase, TestCaseInTempDir
+
+from breezy.plugins.qbrz.lib import tests as qtests
+from breezy.plugins.qbrz.lib.lazycachedrevloader import (
+    BatchSizer,
+    RevisionCache,
+    RevisionLoader,
+    RevisionStore,
+    RevisionSummary,
+    cached_revisions,
+    cached_summaries,
+    estimate_revision_size,
+    )
+
+
+def make_revision(revid):
+    return Revision(revid, committer="joe@example.com", message="message",
+                    timestamp=0, timezone=0, parent_ids=[], properties={},
+                    inventory_sha1=None)
+
+
+class Owner(object):
+    pass
+
+
+class TestRevisionCache(TestCase):
+
+    def make_cache(self, count):
+        """Make a cache that fits count revisions."""
+        size = estimate_revision_size(make_revision(b"rev-0"))
+        return RevisionCache(max_size=size * count)
+
+    def test_evicts_least_recently_used(self):
+        cache = self.make_cache(2)
+        cache[b"rev-1"] = make_revision(b"rev-1")
+        cache[b"rev-2"] = make_revision(b"rev-2")
+        cache[b"rev-1"]
+        cache[b"rev-3"] = make_revision(b"rev-3")
+
+        self.assertTrue(b"rev-1" in cache)
+        self.assertFalse(b"rev-2" in cache)
+        self.assertTrue(b"rev-3" in cache)
+        self.assertEqual(1, cache.evictions)
+        self.assertEqual(2, cache.stats()["revisions"])
+
+    def test_pinned_not_evicted(self):
+        cache = self.make_cache(2)
+        owner = Owner()
+        cache[b"rev-1"] = make_revision(b"rev-1")
+        cache.pin(owner, [b"rev-1"])
+        cache[b"rev-2"] = make_revision(b"rev-2")
+        cache[b"rev-3"] = make_revision(b"rev-3")
+
+        self.assertTrue(b"rev-1" in cache)
+        self.assertFalse(b"rev-2" in cache)
+
+        # The pin goes away with the owner.
+        del owner
+        gc.collect()
+        cache[b"rev-4"] = make_revision(b"rev-4")
+        cache[b"rev-5"] = make_revision(b"rev-5")
+        self.assertFalse(b"rev-1" in cache)
+
+    def test_all_pinned(self):
+        cache = self.make_cache(1)
+        owner = Owner()
+        cache.pin(owner, [b"rev-1", b"rev-2"])
+        cache[b"rev-1"] = make_revision(b"rev-1")
+        cache[b"rev-2"] = make_revision(b"rev-2")
+
+        self.assertEqual(2, len(cache))
+        cache.unpin(owner)
+        cache[b"rev-3"] = make_revision(b"rev-3")
+        self.assertEqual(1, len(cache))
+        self.assertTrue(b"rev-3" in cache)
+
+
+class TestRevisionSummary(TestCase):
+
+    def test_summary(self):
+        rev = Revision(b"rev-1", committer="Joe <joe@example.com>",
+                       message="summary\n\nbody", timestamp=0, timezone=0,
+                       parent_ids=[], inventory_sha1=None,
+                       properties={"authors": "Jane <jane@example.com>",
+                                   "bugs": "https://launchpad.net/bugs/1234 fixed\n"
+                                           "https://example.com/other fixed"})
+        summary = RevisionSummary(rev)
+        self.assertEqual(b"rev-1", summary.revid)
+        self.assertEqual("summary", summary.summary)
+        self.assertEqual("Jane <jane@example.com>", summary.author)
+        self.assertEqual("Jane", summary.author_name)
+        self.assertEqual(("1234",), summary.bug_ids)
+        self.assertFalse(hasattr(summary, "__dict__"))
+
+
+class TestBatchSizer(TestCase):
+
+    def test_grows_on_high_latency(self):
+        sizer = BatchSizer(5)
+        # Each batch is a 0.2 second round trip, plus 1ms a revision.
+        for i in range(10):
+            sizer.record(sizer.size, 0.2 + 0.001 * sizer.size)
+        self.assertEqual(50, sizer.size)
+
+    def test_grows_at_most_double(self):
+        sizer = BatchSizer(30)
+        sizer.record(30, 0.001)
+        self.assertEqual(60, sizer.size)
+
+    def test_shrinks_when_slow(self):
+        sizer = BatchSizer(100)
+        sizer.record(100, 1.0)
+        self.assertEqual(25, sizer.size)
+        sizer.record(25, 100)
+        self.assertEqual(1, sizer.size)
+
+    def test_partial_batch_does_not_grow(self):
+        sizer = BatchSizer(30)
+        sizer.record(3, 0.001)
+        self.assertEqual(30, sizer.size)
+        sizer.record(3, 1.0)
+        self.assertEqual(1, sizer.size)
+
+
+class TestRevisionStore(TestCaseInTempDir):
+
+    def test_round_trip(self):
+        rev = Revision(b"rev-1", committer="joe@example.com",
+                       message="m\u00e9ssage\n", timestamp=1234567890.5,
+                       timezone=3600, parent_ids=[b"rev-0", b"rev-m"],
+                       properties={"authors": "a@example.com"},
+                       inventory_sha1=b"0" * 40)
+        store = RevisionStore("cache/revisions.sqlite")
+        store.add_revisions([rev])
+        store.close()
+
+        store = RevisionStore("cache/revisions.sqlite")
+        revs = store.get_revisions([b"rev-1", b"rev-2"])
+        self.assertEqual([b"rev-1"], list(revs))
+        self.assertEqual(rev, revs[b"rev-1"])
+        self.assertEqual(3600, revs[b"rev-1"].timezone)
+        store.close()
+
+    def test_unusable_file_disables(self):
+        self.build_tree_contents([("revisions.sqlite", b"not a database" * 100)])
+        store = RevisionStore("revisions.sqlite")
+        self.assertEqual({}, store.get_revisions([b"rev-1"]))
+        self.assertTrue(store.disabled)
+
+
+class TestRevisionLoader(qtests.QTestCase):
+
+    def make_revisions(self, count):
+        wt = self.make_branch_and_tree("branch")
+        revids = [wt.commit("rev %d" % i) for i in range(count)]
+        for revid in revids:
+            if revid in cached_revisions:
+                del cached_revisions[revid]
+        return wt.branch.repository, revids
+
+    def test_submit(self):
+        repo, revids = self.make_revisions(5)
+        loaded = {}
+        calls = []
+
+        def revisions_loaded(revisions, last_call):
+            loaded.update(revisions)
+            calls.append(last_call)
+
+        loader = RevisionLoader()
+        self.addCleanup(loader.stop)
+        request = loader.submit(revids, repo, revisions_loaded,
+                                local_batch_size=2)
+        request.wait()
+        self.assertEqual(sorted(revids), sorted(loaded))
+        self.assertEqual("rev 4", loaded[revids[4]].message)
+        self.assertEqual(repo, loaded[revids[4]].repository)
+        self.assertEqual([False, False, False, True], calls)
+        self.assertTrue(revids[0] in cached_revisions)
+
+        # Everything is cached now.
+        calls = []
+        request = loader.submit(revids, repo, revisions_loaded)
+        self.assertFalse(request.is_active())
+        self.assertEqual([], calls)
+
+    def test_submit_summaries(self):
+        repo, revids = self.make_revisions(3)
+        for revid in revids:
+            if revid in cached_summaries:
+                del cached_summaries[revid]
+        loaded = {}
+        loader = RevisionLoader()
+        self.addCleanup(loader.stop)
+        request = loader.submit(
+            revids, repo, lambda revisions, last_call: loaded.update(revisions),
+            summaries=True)
+        request.wait()
+        self.assertEqual("rev 2", loaded[revids[2]].summary)
+        self.assertTrue(isinstance(cached_summaries[revids[2]], RevisionSummary))
+        self.assertFalse(revids[2] in cached_revisions)
+
+    def test_cancel(self):
+        repo, revids = self.make_revisions(3)
+        calls = []
+        loader = RevisionLoader()
+        self.addCleanup(loader.stop)
+        request = loader.submit(
+            revids, repo, lambda revisions, last_call: calls.append(last_call),
+            local_batch_size=1)
+        request.cancel()
+        self.waitUntil(lambda: request.finished, 5000)
+        self.assertEqual([], calls)
@@ -23,7 +23,11 @@ from breezy.transport import memory
 from PyQt5 import QtCore
 
 from breezy.plugins.qbrz.lib import tests as qtests
+from breezy.plugins.qbrz.lib.filelistcache import get_file_list_caches
+from breezy.plugins.qbrz.lib.lazycachedrevloader import (
+    cached_revisions, cached_summaries)
 from breezy.plugins.qbrz.lib.log import LogWindow
+from breezy.plugins.qbrz.lib.searchindex import get_search_index
 
 
 class TestLogSmokeTests(qtests.QTestCase):
@@ -51,6 +55,332 @@ class TestLogSmokeTests(qtests.QTestCase):
         QtCore.QCoreApplication.processEvents()
 
 
+class TestLogPrefetch(qtests.QTestCase):
+
+    def test_prefetch_pages_ahead(self):
+        wt = self.make_branch_and_tree('.')
+        revids = [wt.commit('commit %d' % i) for i in range(200)]
+        revids.reverse()
+        for revid in revids:
+            if revid in cached_summaries:
+                del cached_summaries[revid]
+
+        win = LogWindow(['.'], None)
+        self.addCleanup(win.close)
+        win.resize(600, 400)
+        win.show()
+        log_list = win.log_list
+        self.waitUntil(lambda: log_list.load_revisions_request is not None, 5000)
+        log_list.load_revisions_request.wait()
+        if log_list.prefetch_request is not None:
+            log_list.prefetch_request.wait()
+
+        visible = len(log_list.load_revisions_request.revids)
+        self.assertTrue(revids[visible * 2] in cached_summaries)
+        self.assertFalse(revids[-1] in cached_summaries)
+
+
+class TestLogLimit(qtests.QTestCase):
+
+    def test_load_more_when_not_scrollable(self):
+        wt = self.make_branch_and_tree('.')
+        for i in range(10):
+            wt.commit('commit %d' % i)
+
+        win = LogWindow(['.'], None, limit=2)
+        self.addCleanup(win.close)
+        win.resize(600, 600)
+        win.show()
+        graph_viz = lambda: win.log_list.log_model.graph_viz
+        # All the rows fit in the view, so more are loaded without
+        # scrolling, until the whole history is loaded.
+        self.waitUntil(lambda: graph_viz().revisions and
+                       graph_viz().truncated_revid is None, 5000)
+        self.assertEqual(10, len(graph_viz().revisions))
+
+
+class TestLogSearch(qtests.QTestCase):
+
+    def test_message_search_uses_index(self):
+        wt = self.make_branch_and_tree('.')
+        wt.commit('Fix the crash', rev_id=b'rev-1')
+        wt.commit('Add a button', rev_id=b'rev-2')
+        wt.commit('Fixed another crasher', rev_id=b'rev-3')
+
+        win = LogWindow(['.'], None)
+        self.addCleanup(win.close)
+        win.show()
+        log_list = win.log_list
+        self.waitUntil(lambda: log_list.log_model.graph_viz.revisions, 5000)
+
+        def visible_revids():
+            return [c_rev.rev.revid for c_rev in
+                    log_list.log_model.computed.filtered_revs]
+
+        search_filter = log_list.log_model.prop_search_filter
+        log_list.set_search("fix", "message")
+        self.assertNotEqual(None, search_filter.query)
+        search_filter.index_request.wait()
+        self.assertEqual([b'rev-3', b'rev-1'], visible_revids())
+
+        index = get_search_index(wt.branch.repository)
+        self.assertEqual({b'rev-1', b'rev-2', b'rev-3'}, index.indexed)
+        # Now the index answers straight away.
+        log_list.set_search("crash butt", "message")
+        self.assertEqual([], visible_revids())
+        log_list.set_search("crasher", "message")
+        self.assertEqual([b'rev-3'], visible_revids())
+        log_list.set_search(None, None)
+        self.assertEqual([b'rev-3', b'rev-2', b'rev-1'], visible_revids())
+
+    def check_search_narrows(self, log_list):
+        search_filter = log_list.log_model.prop_search_filter
+        calls = []
+        filter_changed_callback = search_filter.filter_changed_callback
+
+        def record_filter_changed(revs, last_call):
+            calls.append(None if revs is None
+                         else sorted(rev.revid for rev in revs))
+            filter_changed_callback(revs, last_call)
+
+        search_filter.filter_changed_callback = record_filter_changed
+
+        def visible_revids():
+            return [c_rev.rev.revid for c_rev in
+                    log_list.log_model.computed.filtered_revs]
+
+        log_list.set_search("fix", "message")
+        self.waitUntil(lambda: search_filter.matched_revids is not None, 5000)
+        self.assertEqual([b'rev-3', b'rev-1'], visible_revids())
+        del calls[:]
+        # Only the revisions that matched "fix", and no longer match, are
+        # filtered again.
+        log_list.set_search("fixed", "message")
+        self.assertEqual([[b'rev-1']], calls)
+        self.assertEqual([b'rev-3'], visible_revids())
+        # Going back to "fix" uses the result from before.
+        del calls[:]
+        log_list.set_search("fix", "message")
+        self.assertEqual([[b'rev-1']], calls)
+        self.assertEqual([b'rev-3', b'rev-1'], visible_revids())
+        self.assertEqual([("message", "fixed"), ("message", "fix")],
+                         list(search_filter.results))
+
+    def make_search_log_list(self):
+        wt = self.make_branch_and_tree('.')
+        wt.commit('Fix the crash', rev_id=b'rev-1')
+        wt.commit('Add a button', rev_id=b'rev-2')
+        wt.commit('Fixed another crasher', rev_id=b'rev-3')
+
+        win = LogWindow(['.'], None)
+        self.addCleanup(win.close)
+        win.show()
+        log_list = win.log_list
+        self.waitUntil(lambda: log_list.log_model.graph_viz.revisions, 5000)
+        return log_list
+
+    def test_search_narrows_with_index(self):
+        self.check_search_narrows(self.make_search_log_list())
+
+    def test_search_narrows_without_index(self):
+        log_list = self.make_search_log_list()
+        self.overrideAttr(log_list.log_model.prop_search_filter,
+                          "get_search_indexes", lambda: None)
+        self.check_search_narrows(log_list)
+
+    def test_search_index_matches_like_pattern(self):
+        log_list = self.make_search_log_list()
+        search_filter = log_list.log_model.prop_search_filter
+
+        def search(s):
+            log_list.set_search(s, "message")
+            if search_filter.index_request is not None:
+                search_filter.index_request.wait()
+            self.waitUntil(lambda: search_filter.matched_revids is not None,
+                           5000)
+            return [c_rev.rev.revid for c_rev in
+                    log_list.log_model.computed.filtered_revs]
+
+        # Part of a word matches, with the index or without it.
+        self.assertEqual([b'rev-3', b'rev-1'], search("rash"))
+        self.assertNotEqual(None, search_filter.query)
+        # The index can't answer a pattern that may match more than one word.
+        self.assertEqual([b'rev-1'], search("the cr"))
+        self.assertEqual(None, search_filter.query)
+        log_list.set_search(None, None)
+        self.overrideAttr(search_filter, "get_search_indexes", lambda: None)
+        self.assertEqual([b'rev-3', b'rev-1'], search("rash"))
+
+    def test_search_with_small_revision_cache(self):
+        log_list = self.make_search_log_list()
+        search_filter = log_list.log_model.prop_search_filter
+        self.overrideAttr(search_filter, "get_search_indexes", lambda: None)
+        # The revisions are evicted as soon as they are loaded.
+        self.overrideAttr(cached_revisions, "max_size", 1)
+        for revid in (b'rev-1', b'rev-2', b'rev-3'):
+            if revid in cached_revisions:
+                del cached_revisions[revid]
+
+        log_list.set_search("fix", "message")
+        self.waitUntil(lambda: search_filter.matched_revids is not None, 5000)
+        self.assertFalse(b'rev-1' in cached_revisions)
+        self.assertEqual(frozenset([b'rev-1', b'rev-3']),
+                         search_filter.matched_revids)
+        self.assertEqual([b'rev-3', b'rev-1'], [
+            c_rev.rev.revid for c_rev in
+            log_list.log_model.computed.filtered_revs])
+
+    def test_search_narrows_with_small_revision_cache(self):
+        log_list = self.make_search_log_list()
+        search_filter = log_list.log_model.prop_search_filter
+        self.overrideAttr(search_filter, "get_search_indexes", lambda: None)
+        self.overrideAttr(cached_revisions, "max_size", 1)
+        for revid in (b'rev-1', b'rev-2', b'rev-3'):
+            if revid in cached_revisions:
+                del cached_revisions[revid]
+
+        log_list.set_search("fix", "message")
+        self.waitUntil(lambda: search_filter.matched_revids is not None, 5000)
+        # The revisions that matched "fix" have been evicted, so they are
+        # loaded again, but not the one that did not.
+        log_list.set_search("fixed", "message")
+        self.assertEqual([b'rev-3', b'rev-1'],
+                         search_filter.load_request.revids)
+        self.waitUntil(lambda: search_filter.matched_revids is not None, 5000)
+        self.assertEqual(frozenset([b'rev-3']), search_filter.matched_revids)
+        self.assertEqual([b'rev-3'], [
+            c_rev.rev.revid for c_rev in
+            log_list.log_model.computed.filtered_revs])
+
+    def test_query(self):
+        log_list = self.make_search_log_list()
+        search_filter = log_list.log_model.prop_search_filter
+        log_list.set_search("fix -message:another author:*", "query")
+        self.waitUntil(lambda: search_filter.matched_revids is not None, 5000)
+        self.assertEqual([b'rev-1'], [c_rev.rev.revid for c_rev in
+                                      log_list.log_model.computed.filtered_revs])
+
+
+    def test_query_with_small_revision_cache(self):
+        log_list = self.make_search_log_list()
+        search_filter = log_list.log_model.prop_search_filter
+        self.overrideAttr(search_filter, "get_search_indexes", lambda: None)
+        self.overrideAttr(cached_revisions, "max_size", 1)
+        for revid in (b'rev-1', b'rev-2', b'rev-3'):
+            if revid in cached_revisions:
+                del cached_revisions[revid]
+
+        log_list.set_search("fix -message:another author:*", "query")
+        self.waitUntil(lambda: search_filter.matched_revids is not None, 5000)
+        self.assertFalse(b'rev-1' in cached_revisions)
+        self.assertEqual(frozenset([b'rev-1']), search_filter.matched_revids)
+        self.assertEqual([b'rev-1'], [c_rev.rev.revid for c_rev in
+                                      log_list.log_model.computed.filtered_revs])
+
+
+class TestLogContentSearch(qtests.QTestCase):
+
+    def test_content_search(self):
+        wt = self.make_branch_and_tree('.')
+        self.build_tree_contents([('a', b'one\n')])
+        wt.add('a', ids=b'a-id')
+        wt.commit('add', rev_id=b'rev-1')
+        self.build_tree_contents([('a', b'one\nfoo\n')])
+        wt.commit('add foo', rev_id=b'rev-2')
+        self.build_tree_contents([('a', b'two\nfoo\n')])
+        wt.commit('change other', rev_id=b'rev-3')
+        self.build_tree_contents([('a', b'two\n'), ('b', b'foo\n')])
+        wt.add('b')
+        wt.commit('remove foo', rev_id=b'rev-4')
+
+        win = LogWindow(['a'], None)
+        self.addCleanup(win.close)
+        win.show()
+        log_list = win.log_list
+        log_model = log_list.log_model
+        self.waitUntil(lambda: getattr(log_model, 'file_id_filter', None)
+                       is not None and log_model.file_id_filter.loaded, 5000)
+        self.assertNotEqual(-1, win.searchType.findData(win.FilterContentRole))
+
+        search_filter = log_model.content_search_filter
+        log_list.set_content_search("foo")
+        self.waitUntil(lambda: search_filter.worker is None, 5000)
+        self.assertEqual([b'rev-4', b'rev-2'],
+                         [c_rev.rev.revid for c_rev in
+                          log_model.computed.filtered_revs])
+        log_list.set_content_search(None)
+        self.assertEqual([b'rev-4', b'rev-3', b'rev-2', b'rev-1'],
+                         [c_rev.rev.revid for c_rev in
+                          log_model.computed.filtered_revs])
+
+
+class TestLogFileList(qtests.QTestCase):
+
+    def test_deltas_shared(self):
+        wt = self.make_branch_and_tree('.')
+        self.build_tree(['a', 'b'])
+        wt.add(['a'])
+        revid_1 = wt.commit('add a')
+        wt.add(['b'])
+        revid_2 = wt.commit('add b')
+        caches = get_file_list_caches(wt.branch.repository)
+        caches.clear()
+
+        files = []
+        for i in range(2):
+            win = LogWindow(['.'], None)
+            self.addCleanup(win.close)
+            win.file_list_container.prefetch_rows = 0
+            win.show()
+            log_list = win.log_list
+            self.waitUntil(lambda: log_list.log_model.graph_viz.revid_rev, 5000)
+            log_list.select_revid(revid_2)
+            file_list = win.file_list_container.file_list
+            self.waitUntil(lambda: file_list.count(), 5000)
+            files.append([file_list.item(row).text()
+                          for row in range(file_list.count())])
+            self.assertEqual([(revid_2, revid_1)], caches.deltas.keys())
+        self.assertEqual([['b'], ['b']], files)
+        # The second log used the delta of the first.
+        self.assertEqual(1, caches.deltas.hits)
+        # It was loaded without keeping the trees.
+        self.assertEqual([], caches.trees.keys())
+
+    def test_prefetch_adjacent_deltas(self):
+        wt = self.make_branch_and_tree('.')
+        revids = [wt.commit('empty')]
+        for name in ('a', 'b', 'c', 'd'):
+            self.build_tree([name])
+            wt.add([name])
+            revids.append(wt.commit('add ' + name))
+        caches = get_file_list_caches(wt.branch.repository)
+        caches.clear()
+
+        win = LogWindow(['.'], None)
+        self.addCleanup(win.close)
+        win.show()
+        log_list = win.log_list
+        container = win.file_list_container
+        container.prefetch_rows = 1
+        self.waitUntil(lambda: log_list.log_model.graph_viz.revid_rev, 5000)
+        log_list.select_revid(revids[2])
+        self.waitUntil(lambda: container.file_list.count(), 5000)
+        self.waitUntil(lambda: container.delta_prefetcher is None or
+                       not container.delta_prefetcher.is_alive(), 5000)
+        QtCore.QCoreApplication.processEvents()
+        self.assertEqual(
+            set([(revids[3], revids[2]), (revids[2], revids[1]),
+                 (revids[1], revids[0])]),
+            set(caches.deltas.keys()))
+
+        # The prefetched delta is shown.
+        log_list.select_revid(revids[3])
+        self.waitUntil(lambda: container.current_revids ==
+                       (revids[3], revids[2]), 5000)
+        self.assertEqual(['c'], [container.file_list.item(row).text()
+                                 for row in range(container.file_list.count())])
+
+
 class TestLogGetBranchesAndFileIds(qtests.QTestCase):
 
     def test_with_branch(self):
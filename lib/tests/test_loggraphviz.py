@@ -19,6 +19,8 @@
 # RJLRJL a lot of the changes for breezy were changing strings to bytes
 
 from breezy.tests import TestCase, TestCaseWithTransport
+import os
+import time
 from io import StringIO
 
 from breezy.plugins.qbrz.lib import loggraphviz
@@ -329,6 +331,221 @@ class TestLogGraphVizWithBranches(TestCaseWithTransport, TestLogGraphVizMixin):
              (b'rev-a', 0, None, [])               ],# ○
             computed)
 
+    def make_tree_with_merge_and_ghost(self, path):
+        tree = self.make_branch_and_tree(path)
+        tree.commit('a')
+        other = tree.controldir.sprout('other').open_workingtree()
+        other.commit('b')
+        tree.merge_from_branch(other.branch)
+        tree.add_parent_tree_id(b'rev-ghost')
+        tree.commit('c')
+        return tree
+
+    def load_with_merge_sort_cache(self, bi, cache):
+        gv = loggraphviz.GraphVizLoader([bi], bi, False)
+        gv.merge_sort_cache = cache
+        gv.load()
+        return gv
+
+    def test_merge_sort_cache(self):
+        tree = self.make_tree_with_merge_and_ghost('tree')
+        bi = loggraphviz.BranchInfo(None, tree, tree.branch)
+        cache = loggraphviz.MergeSortCache('cache')
+
+        gv = self.load_with_merge_sort_cache(bi, cache)
+        self.assertEqual(1, len(os.listdir('cache')))
+
+        def process_graph_parents(head_revids, graph_parents_iter):
+            self.fail('process_graph_parents should not be called.')
+
+        cached_gv = loggraphviz.GraphVizLoader([bi], bi, False)
+        cached_gv.merge_sort_cache = cache
+        cached_gv.process_graph_parents = process_graph_parents
+        cached_gv.load()
+
+        rev_data = lambda gv: [
+            (rev.revid, rev.revno_sequence, rev.merge_depth, rev.end_of_merge,
+             tuple(gv.known_graph.get_parent_keys(rev.revid)))
+            for rev in gv.revisions]
+        self.assertEqual(rev_data(gv), rev_data(cached_gv))
+        self.assertEqual(gv.ghosts, cached_gv.ghosts)
+        self.assertEqual({b'rev-ghost'}, cached_gv.ghosts)
+
+        state = loggraphviz.GraphVizFilterState(gv)
+        state.expand_all_branch_lines()
+        cached_state = loggraphviz.GraphVizFilterState(cached_gv)
+        cached_state.expand_all_branch_lines()
+        self.assertEqual(
+            self.computed_to_list(gv.compute_viz(state)),
+            self.computed_to_list(cached_gv.compute_viz(cached_state)))
+
+    def test_merge_sort_cache_miss_on_new_head(self):
+        tree = self.make_tree_with_merge_and_ghost('tree')
+        bi = loggraphviz.BranchInfo(None, tree, tree.branch)
+        cache = loggraphviz.MergeSortCache('cache')
+        self.load_with_merge_sort_cache(bi, cache)
+
+        rev_d = tree.commit('d')
+        gv = self.load_with_merge_sort_cache(bi, cache)
+        self.assertEqual(rev_d, gv.revisions[0].revid)
+        self.assertEqual(1, len(os.listdir('cache')))
+
+    def test_merge_sort_cache_miss_on_fetched_ghost(self):
+        tree = self.make_tree_with_merge_and_ghost('tree')
+        bi = loggraphviz.BranchInfo(None, tree, tree.branch)
+        cache = loggraphviz.MergeSortCache('cache')
+        self.load_with_merge_sort_cache(bi, cache)
+
+        # The heads are the same, but the ghost is now in the repository.
+        ghost_tree = self.make_branch_and_tree('ghost')
+        ghost_tree.commit('ghost', rev_id=b'rev-ghost')
+        tree.branch.repository.fetch(ghost_tree.branch.repository,
+                                     revision_id=b'rev-ghost')
+        gv = self.load_with_merge_sort_cache(bi, cache)
+        self.assertEqual(set(), gv.ghosts)
+        self.assertTrue(b'rev-ghost' in gv.revid_rev)
+
+    def assertSameGraph(self, expected_gv, gv):
+        rev_data = lambda gv: [
+            (rev.index, rev.revid, rev.revno_str, rev.merge_depth,
+             rev.merged_by, rev.merges, rev.branch.branch_id)
+            for rev in gv.revisions]
+        self.assertEqual(rev_data(expected_gv), rev_data(gv))
+        self.assertEqual(
+            sorted(expected_gv.revid_rev.keys()), sorted(gv.revid_rev.keys()))
+        self.assertEqual(
+            sorted(expected_gv.revno_rev.keys()), sorted(gv.revno_rev.keys()))
+        self.assertEqual(expected_gv.branch_ids, gv.branch_ids)
+        self.assertEqual(
+            [[rev.revid for rev in expected_gv.branch_lines[branch_id].revs]
+             for branch_id in expected_gv.branch_ids],
+            [[rev.revid for rev in gv.branch_lines[branch_id].revs]
+             for branch_id in gv.branch_ids])
+
+        expected_state = loggraphviz.GraphVizFilterState(expected_gv)
+        expected_state.expand_all_branch_lines()
+        state = loggraphviz.GraphVizFilterState(gv)
+        state.expand_all_branch_lines()
+        self.assertEqual(
+            self.computed_to_list(expected_gv.compute_viz(expected_state)),
+            self.computed_to_list(gv.compute_viz(state)))
+
+    def test_update(self):
+        tree = self.make_branch_and_tree('tree')
+        tree.commit('a')
+        other = tree.controldir.sprout('other').open_workingtree()
+        other.commit('b')
+        tree.merge_from_branch(other.branch)
+        tree.commit('c')
+
+        bi = loggraphviz.BranchInfo(None, None, tree.branch)
+        gv = loggraphviz.GraphVizLoader([bi], bi, False)
+        gv.load()
+
+        # Continue the merged branch line, and start a new one.
+        other.commit('d')
+        new = tree.controldir.sprout('new').open_workingtree()
+        new.commit('e')
+        tree.merge_from_branch(other.branch)
+        tree.commit('f')
+        tree.merge_from_branch(new.branch)
+        tree.commit('g')
+
+        self.assertTrue(gv.update())
+        self.assertEqual(tree.last_revision(), gv.revisions[0].revid)
+
+        expected_gv = loggraphviz.GraphVizLoader([bi], bi, False)
+        expected_gv.load()
+        self.assertSameGraph(expected_gv, gv)
+
+    def test_update_old_revisions_sort_differently(self):
+        tree = self.make_branch_and_tree('tree')
+        tree.commit('a')
+        other = tree.controldir.sprout('other').open_workingtree()
+        other.commit('b')
+        tree.merge_from_branch(other.branch)
+        tree.commit('c')
+
+        bi = loggraphviz.BranchInfo(None, None, tree.branch)
+        gv = loggraphviz.GraphVizLoader([bi], bi, False)
+        gv.load()
+        # Only the first of the existing rows still matches the new merge
+        # sort.
+        merged_rev = gv.revid_rev[other.last_revision()]
+        gv.store.merge_depths[merged_rev.index] = 0
+
+        tree.commit('d')
+        self.assertFalse(gv.update())
+
+    def test_update_not_in_left_hand_ancestry(self):
+        tree = self.make_branch_and_tree('tree')
+        tree.commit('a')
+        rev_b = tree.commit('b')
+
+        bi = loggraphviz.BranchInfo(None, None, tree.branch)
+        gv = loggraphviz.GraphVizLoader([bi], bi, False)
+        gv.load()
+
+        tree.branch.generate_revision_history(tree.branch.get_rev_id(1))
+        self.assertFalse(gv.update())
+        self.assertEqual([rev_b], list(gv.revid_head_info.keys()))
+
+    def test_load_limit(self):
+        tree = self.make_branch_and_tree('tree')
+        tree.commit('a')
+        old = tree.controldir.sprout('old').open_workingtree()
+        old.commit('b')
+        tree.commit('c')
+        new = tree.controldir.sprout('new').open_workingtree()
+        new.commit('d')
+        tree.merge_from_branch(old.branch)
+        tree.commit('e')
+        tree.merge_from_branch(new.branch)
+        tree.commit('f')
+
+        bi = loggraphviz.BranchInfo(None, None, tree.branch)
+        full_gv = loggraphviz.GraphVizLoader([bi], bi, False)
+        full_gv.load()
+        self.assertEqual(['4', '2.1.1', '3', '1.1.1', '2', '1'],
+                         [rev.revno_str for rev in full_gv.revisions])
+
+        gv = loggraphviz.GraphVizLoader([bi], bi, False)
+        gv.limit = 2
+        gv.load()
+        self.assertEqual(tree.branch.get_rev_id(2), gv.truncated_revid)
+        # The base of the branch that was merged in 3 was not loaded, so its
+        # revno is not known.
+        self.assertEqual(['4', '2.1.1', '3', '0.1.2'],
+                         [rev.revno_str for rev in gv.revisions])
+        self.assertEqual(
+            [full_gv.revisions[i].revid for i in range(4)],
+            [rev.revid for rev in gv.revisions])
+
+        state = loggraphviz.GraphVizFilterState(gv)
+        state.expand_all_branch_lines()
+        computed = gv.compute_viz(state)
+        self.assertEqual(4, len(computed.filtered_revs))
+
+        gv = loggraphviz.GraphVizLoader([bi], bi, False)
+        gv.limit = 4
+        gv.load()
+        self.assertEqual(None, gv.truncated_revid)
+        self.assertEqual(len(full_gv.revisions), len(gv.revisions))
+
+    def test_load_since_after_tip(self):
+        tree = self.make_branch_and_tree('tree')
+        tree.commit('a')
+        rev_b = tree.commit('b')
+
+        bi = loggraphviz.BranchInfo(None, None, tree.branch)
+        gv = loggraphviz.GraphVizLoader([bi], bi, False)
+        gv.since = time.time() + 86400
+        gv.load()
+        # Only the tip is shown.
+        self.assertEqual(tree.branch.get_rev_id(1), gv.truncated_revid)
+        self.assertEqual([(rev_b, '2')],
+                         [(rev.revid, rev.revno_str) for rev in gv.revisions])
+
     def test_get_revid_branch_info(self):
         builder = self.make_branch_builder('trunk')
         builder.start_series()
@@ -382,6 +599,78 @@ class TestLogGraphVizWithBranches(TestCaseWithTransport, TestLogGraphVizMixin):
 
 class TestLogGraphVizLayouts(TestCase, TestLogGraphVizMixin):
 
+    def test_revision_data(self):
+        gv = BasicGraphVizLoader((b'rev-d',), {
+         b'rev-a': (NULL_REVISION, ),
+         b'rev-b': (b'rev-a', ),
+         b'rev-c': (b'rev-a', ),
+         b'rev-d': (b'rev-b', b'rev-c'),
+        })
+        gv.load()
+
+        self.assertEqual(
+            [(b'rev-d', 0, (3,), '3', 0, False, None, [1], ()),
+             (b'rev-c', 1, (1, 1, 1), '1.1.1', 1, True, 0, (), (1, 1)),
+             (b'rev-b', 2, (2,), '2', 0, False, None, (), ()),
+             (b'rev-a', 3, (1,), '1', 0, True, None, (), ())],
+            [(rev.revid, rev.index, rev.revno_sequence, rev.revno_str,
+              rev.merge_depth, rev.end_of_merge, rev.merged_by, rev.merges,
+              rev.branch_id)
+             for rev in gv.revisions])
+        self.assertEqual(2, gv.revid_rev[b'rev-c'].color)
+        self.assertIs(gv.revid_rev[b'rev-c'], gv.revno_rev[(1, 1, 1)])
+        self.assertIs(gv.branch_lines[(1, 1)], gv.revid_rev[b'rev-c'].branch)
+        self.assertEqual(3, gv.max_mainline_revno)
+
+    def test_ancestry_index(self):
+        gv = BasicGraphVizLoader(('rev-f', 'rev-g'), {
+         'rev-a': (NULL_REVISION, ),
+         'rev-b': ('rev-a', ),
+         'rev-c': ('rev-a', ),
+         'rev-d': ('rev-b', 'rev-c'),
+         'rev-e': ('rev-c', ),
+         'rev-f': ('rev-d', 'rev-e'),
+         'rev-g': ('rev-b', ),
+        })
+        gv.load()
+        index = gv.ancestry_index
+
+        ancestors = {
+            'rev-a': 'a',
+            'rev-b': 'ab',
+            'rev-c': 'ac',
+            'rev-d': 'abcd',
+            'rev-e': 'ace',
+            'rev-f': 'abcdef',
+            'rev-g': 'abg',
+        }
+        for revid, revid_ancestors in ancestors.items():
+            for ancestor_revid in ancestors:
+                self.assertEqual(
+                    ancestor_revid[-1] in revid_ancestors,
+                    index.is_ancestor(ancestor_revid, revid),
+                    (ancestor_revid, revid))
+
+        self.assertEqual(['rev-f', 'rev-e', 'rev-d', 'rev-c'],
+                         index.unique_ancestors('rev-f', ['rev-g']))
+        self.assertEqual(['rev-g'], index.unique_ancestors('rev-g', ['rev-f']))
+        self.assertEqual([], index.unique_ancestors('rev-c', ['rev-e']))
+        self.assertEqual(['rev-g', 'rev-b', 'rev-a'],
+                         index.unique_ancestors('rev-g', []))
+        self.assertFalse('rev-x' in index)
+
+        masks = dict(zip(index.revids,
+                         index.head_masks(['rev-f', 'rev-g'])))
+        self.assertEqual({
+            'rev-a': 3,
+            'rev-b': 3,
+            'rev-c': 1,
+            'rev-d': 1,
+            'rev-e': 1,
+            'rev-f': 1,
+            'rev-g': 2,
+        }, masks)
+
     def test_basic_branch_line(self):
         gv = BasicGraphVizLoader(('rev-d',), {
          'rev-a': (NULL_REVISION, ),
@@ -509,6 +798,38 @@ class TestLogGraphVizLayouts(TestCase, TestLogGraphVizMixin):
              ('rev-a', 0, None, [])                                                                  ],# ○
             computed)
 
+    def test_lines_computed_in_blocks(self):
+        gv = BasicGraphVizLoader(('rev-e',), {
+         'rev-a': (NULL_REVISION, ),
+         'rev-b': ('rev-a', ),
+         'rev-c': ('rev-a', ),
+         'rev-d': ('rev-a', ),
+         'rev-e': ('rev-a', 'rev-b', 'rev-c', 'rev-d'),
+        })
+        gv.load()
+
+        state = loggraphviz.GraphVizFilterState(gv)
+        state.expand_all_branch_lines()
+        computed = gv.compute_viz(state)
+        expected = [sorted(c_rev.lines) for c_rev in computed.filtered_revs]
+
+        computed = gv.compute_viz(state)
+        computed.block_size = 2
+        computed.look_ahead_blocks = 0
+        computed.set_lines(computed.lines)
+        self.assertEqual([None] * 5,
+                         [c_rev._lines for c_rev in computed.filtered_revs])
+
+        # Only the block of the requested row gets computed.
+        self.assertEqual(expected[3], sorted(computed.filtered_revs[3].lines))
+        self.assertEqual(
+            [None, None, expected[2], expected[3], None],
+            [c_rev._lines and sorted(c_rev._lines)
+             for c_rev in computed.filtered_revs])
+
+        self.assertEqual(
+            expected, [sorted(c_rev.lines) for c_rev in computed.filtered_revs])
+
     def test_lots_of_merges_between_branch_lines(self):
         gv = BasicGraphVizLoader(('rev-g',), {
          'rev-a': (NULL_REVISION, ),
@@ -953,6 +1274,81 @@ class TestLogGraphProviderState(TestCase):
         # that is not filtered.
         self.assertFilteredRevisions('ecb', state)
 
+    def test_filter_changed_revs(self):
+        gv = BasicGraphVizLoader(('e',), {
+         'a': (NULL_REVISION, ),
+         'b': ('a', ),
+         'c': ('a', 'b'),
+         'd': ('c', ),
+         'e': ('d', ),
+        })
+        gv.load()
+
+        changes = []
+        state = loggraphviz.GraphVizFilterState(
+            gv, lambda: changes.append(True))
+        state.expand_all_branch_lines()
+        filterer = BasicFilterer(set(('d', 'c', 'b', 'a')))
+        state.filters.append(filterer)
+        self.assertFilteredRevisions('e', state)
+
+        # Nothing changes for revisions that are still filtered.
+        state.filter_changed([gv.revid_rev['a']])
+        self.assertEqual([], changes)
+
+        # c shows once the revision that it merges is shown.
+        filterer.filtered_revids.remove('b')
+        state.filter_changed([gv.revid_rev['b']])
+        self.assertEqual([True], changes)
+        self.assertFilteredRevisions('ecb', state)
+
+
+class TestTextCountChanges(TestCaseWithTransport):
+
+    def test_iter_text_count_changes(self):
+        wt = self.make_branch_and_tree('.')
+        self.build_tree_contents([('a', b'one\n')])
+        wt.add('a', ids=b'a-id')
+        wt.commit('add', rev_id=b'rev-1')
+        self.build_tree_contents([('a', b'one\nfoo\nfoo\n')])
+        wt.commit('add foo', rev_id=b'rev-2')
+        self.build_tree_contents([('a', b'two\nfoo\nfoo\n')])
+        wt.commit('change other', rev_id=b'rev-3')
+        self.build_tree_contents([('a', b'two\nfoo\n')])
+        wt.commit('remove a foo', rev_id=b'rev-4')
+
+        repo = wt.branch.repository
+        keys = [(b'a-id', revid)
+                for revid in (b'rev-4', b'rev-3', b'rev-2', b'rev-1')]
+        with repo.lock_read():
+            parent_map = repo.get_file_graph().get_parent_map(keys)
+            results = list(loggraphviz.iter_text_count_changes(
+                repo, keys, parent_map, b'foo', batch_size=3))
+        self.assertEqual([(3, [(b'a-id', b'rev-4'), (b'a-id', b'rev-2')]),
+                          (1, [])],
+                         results)
+
+
+
+class TestBenchmark(TestCase):
+
+    def test_run_benchmark(self):
+        from breezy.plugins.qbrz.lib.tests import benchmark_loggraphviz
+        for history in sorted(benchmark_loggraphviz.histories):
+            results = benchmark_loggraphviz.run_benchmark(
+                history, 300, measure_memory=True)
+            self.assertEqual(
+                ['load_graph_parents', 'process_graph_parents',
+                 'compute_head_info', 'compute_branch_lines',
+                 'compute_merge_info', 'load_tags', 'load', 'compute_viz',
+                 'compute_viz_expanded', 'compute_lines'],
+                [result['phase'] for result in results])
+            for result in results:
+                self.assertEqual(300, result['revisions'], history)
+                self.assertTrue(result['peak_bytes'] >= 0)
+            load = results[6]
+            self.assertTrue(load['retained_bytes'] > 0)
+            self.assertTrue(load['peak_bytes'] >= load['retained_bytes'])
 
 
 class BasicGraphVizLoader(loggraphviz.GraphVizLoader):
@@ -1150,3 +1546,30 @@ class TestGroupOverlapping(TestCase):
              (['n1'], 1, 8, None),
              (['n2'], 1, 8, None)],
             groups)
+
+    def test_column_occupancy(self):
+        occupancy = loggraphviz.ColumnOccupancy()
+        self.assertEqual(0, occupancy.add_column())
+        self.assertEqual(1, occupancy.add_column())
+        self.assertEqual(2, len(occupancy))
+
+        occupancy.add(0, 2, 4)
+        occupancy.add(0, 4, 6)
+        occupancy.add(0, 10, 10)
+        occupancy.add(0, 3, 5)
+        occupancy.add(0, 15, 12)
+
+        ranges = [(2, 4), (4, 6), (10, 10), (3, 5), (15, 12)]
+        for start in range(0, 17):
+            for end in range(start - 2, 17):
+                self.assertEqual(
+                    not any(loggraphviz.range_overlaps(start, end, s, e)
+                            for s, e in ranges),
+                    occupancy.is_free(0, start, end), (start, end))
+                self.assertTrue(occupancy.is_free(1, start, end))
+
+        # Ranges that only touch are not merged.
+        occupancy.add(1, 2, 4)
+        occupancy.add(1, 4, 6)
+        self.assertTrue(occupancy.is_free(1, 4, 4))
+        self.assertFalse(occupancy.is_free(1, 3, 3))
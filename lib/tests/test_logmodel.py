@@ -20,7 +20,10 @@ from breezy.tests import TestCase, TestCaseWithTransport
 from PyQt5 import QtCore
 
 from breezy.plugins.qbrz.lib import tests as qtests
-from breezy.plugins.qbrz.lib.logmodel import (LogModel, GraphVizLoader)
+from breezy.plugins.qbrz.lib.lazycachedrevloader import cached_revisions
+from breezy.plugins.qbrz.lib.logmodel import (
+    COL_AUTHOR, LogModel, GraphVizLoader, WithWorkingTreeGraphVizLoader,
+    WorkingTreeRevision)
 from breezy.plugins.qbrz.lib.loggraphviz import BranchInfo
 from breezy.plugins.qbrz.lib.util import ThrobberWidget
 
@@ -64,3 +67,34 @@ class TestModel(qtests.QTestCase):
     def test_merges(self):
         wt = self._prepare_tree_with_merges()
         self._test(wt)
+
+    def test_working_tree_revision_not_evicted(self):
+        wt = self.make_branch_and_tree('.')
+        wt.commit('rev-1', rev_id=b'rev-1')
+        self.build_tree(['a'])
+        wt.add('a')
+        throbber = ThrobberWidget(None)
+        log_model = LogModel(lambda: None, throbber)
+        bi = BranchInfo('', wt, wt.branch)
+        log_model.load((bi,), bi, None, False, WithWorkingTreeGraphVizLoader)
+        [wt_revid] = log_model.graph_viz.working_trees.keys()
+        self.assertIsInstance(cached_revisions[wt_revid], WorkingTreeRevision)
+
+        # The working tree revision can't be loaded again, so it stays in
+        # the cache, however small it is.
+        self.overrideAttr(cached_revisions, 'max_size', 1)
+        cached_revisions[b'rev-1'] = wt.branch.repository.get_revision(
+            b'rev-1')
+        self.assertIsInstance(cached_revisions[wt_revid], WorkingTreeRevision)
+
+    def test_author_column_shows_first_author(self):
+        wt = self.make_branch_and_tree('.')
+        revid = wt.commit('rev-1', authors=['Jane <jane@example.com>',
+                                            'Joe <joe@example.com>'])
+        throbber = ThrobberWidget(None)
+        log_model = LogModel(lambda: None, throbber)
+        bi = BranchInfo('', wt, wt.branch)
+        log_model.load((bi,), bi, None, False, GraphVizLoader)
+        cached_revisions[revid] = wt.branch.repository.get_revision(revid)
+        index = log_model.index(0, COL_AUTHOR, QtCore.QModelIndex())
+        self.assertEqual('Jane', log_model.data(index, QtCore.Qt.DisplayRole))
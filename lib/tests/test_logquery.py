@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#
+# QBzr - Qt frontend to Bazaar commands
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+from time import mktime
+
+from breezy.revision import Revision
+from breezy.tests import TestCase
+
+from breezy.plugins.qbrz.lib.lazycachedrevloader import cached_revisions
+from breezy.plugins.qbrz.lib.logquery import (
+    DateTerm,
+    Query,
+    RevisionColumns,
+    TagTerm,
+    is_query,
+    parse_date,
+    )
+
+
+class Rev(object):
+
+    def __init__(self, index, revid):
+        self.index = index
+        self.revid = revid
+
+
+class GraphViz(object):
+
+    def __init__(self, revids, tags):
+        self.revisions = [Rev(index, revid)
+                          for index, revid in enumerate(revids)]
+        self.revid_rev = dict((rev.revid, rev) for rev in self.revisions)
+        self.tags = tags
+
+
+class TestParse(TestCase):
+
+    def test_is_query(self):
+        self.assertTrue(is_query("author:alice"))
+        self.assertTrue(is_query("fix -tag:rc*"))
+        self.assertFalse(is_query("fix: the crash"))
+        self.assertFalse(is_query("fix crash"))
+
+    def test_terms(self):
+        query = Query('author:alice message:"fix the*" crash '
+                      'date:2024-01..2024-06 -tag:rc* bug:')
+        self.assertEqual(
+            [("author", "alice", False), ("message", "fix the*", False),
+             ("message", "crash", False), ("date", "2024-01..2024-06", False),
+             ("tag", "rc*", True)],
+            [(type(term).__name__[:-4].lower(), term.value, term.negate)
+             for term in query.terms])
+
+    def test_dates(self):
+        term = DateTerm("2024-01..2024-06", False)
+        self.assertEqual(mktime((2024, 1, 1, 0, 0, 0, 0, 0, -1)), term.start)
+        self.assertEqual(mktime((2024, 7, 1, 0, 0, 0, 0, 0, -1)), term.end)
+        term = DateTerm("2023-12-31", False)
+        self.assertEqual(mktime((2024, 1, 1, 0, 0, 0, 0, 0, -1)), term.end)
+        term = DateTerm("..2023", False)
+        self.assertEqual(None, term.start)
+        self.assertEqual(mktime((2024, 1, 1, 0, 0, 0, 0, 0, -1)), term.end)
+        self.assertEqual(None, parse_date("2024-13"))
+        self.assertEqual(None, parse_date("yesterday"))
+        # Terms without a date are left out while they are being typed.
+        self.assertEqual([], Query("date:20").terms)
+
+
+class TestQuery(TestCase):
+
+    def setUp(self):
+        super(TestQuery, self).setUp()
+        revs = [
+            (b"rev-1", "Fix the crash", "Alice <alice@example.com>",
+             (2024, 2, 10), ""),
+            (b"rev-2", "Add a button", "Bob <bob@example.com>",
+             (2024, 3, 1), "https://launchpad.net/bugs/1234 fixed"),
+            (b"rev-3", "Fix the button", "Alice <alice@example.com>",
+             (2024, 8, 1), ""),
+            (b"rev-4", "Fix the build", "Alice <alice@example.com>",
+             (2024, 4, 1), ""),
+            ]
+        for revid, message, committer, day, bugs in revs:
+            properties = {}
+            if bugs:
+                properties["bugs"] = bugs
+            cached_revisions[revid] = Revision(
+                revid, committer=committer, message=message,
+                timestamp=mktime(day + (12, 0, 0, 0, 0, -1)), timezone=0,
+                parent_ids=[], properties=properties, inventory_sha1=None)
+            self.addCleanup(cached_revisions.__delitem__, revid)
+        self.revids = [rev[0] for rev in revs] + [b"not-loaded"]
+
+    def make_columns(self):
+        graph_viz = GraphViz(self.revids,
+                             {b"rev-4": ["rc1"], b"rev-3": ["1.0"]})
+        return RevisionColumns(graph_viz)
+
+    def visible_revids(self, s):
+        columns = self.make_columns()
+        query = Query(s)
+        query.prepare(columns)
+        visible = query.get_visible(columns)
+        revids = [revid for revid, v in zip(columns.revids, visible) if v]
+        # Checking the rows one at a time gives the same.
+        self.assertEqual(revids, [revid for row, revid in enumerate(columns.revids)
+                                  if query.matches(columns, row)])
+        return revids
+
+    def test_columns(self):
+        columns = self.make_columns()
+        self.assertEqual(bytearray([1, 1, 1, 1, 0]), columns.loaded)
+        self.assertEqual(["Alice <alice@example.com>", "Bob <bob@example.com>"],
+                         columns.authors)
+        self.assertEqual([0, 1, 0, 0, -1], list(columns.author_ids))
+
+    def test_terms(self):
+        self.assertEqual([b"rev-1", b"rev-4"],
+                         self.visible_revids("author:alice date:2024-01..2024-06"))
+        self.assertEqual([b"rev-1", b"rev-3"],
+                         self.visible_revids('message:"fix the*" -tag:rc*'))
+        self.assertEqual([b"rev-2"], self.visible_revids("bug:1234 button"))
+        self.assertEqual([b"rev-3"], self.visible_revids("date:2024-08-01"))
+        self.assertEqual([b"rev-3", b"rev-4"], self.visible_revids("tag:*"))
+
+    def test_cheapest_first(self):
+        query = Query("fix bug:1 -author:bob date:2024 author:al tag:rc*")
+        query.prepare(self.make_columns())
+        self.assertEqual(
+            ["rc*", "al", "2024", "bob", "1", "fix"],
+            [term.value for term in query.terms])
+        self.assertTrue(isinstance(query.terms[0], TagTerm))
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# QBzr - Qt frontend to Bazaar commands
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+from breezy.revision import Revision
+from breezy.tests import TestCase, TestCaseInTempDir
+
+from breezy.plugins.qbrz.lib.searchindex import SearchIndex, SearchQuery
+
+
+def make_revision(revid, message, committer="Joe <joe@example.com>",
+                  bugs=None):
+    properties = {}
+    if bugs:
+        properties["bugs"] = bugs
+    return Revision(revid, committer=committer, message=message,
+                    timestamp=0, timezone=0, parent_ids=[],
+                    properties=properties, inventory_sha1=None)
+
+
+class TestSearchQuery(TestCase):
+
+    def test_substring(self):
+        query = SearchQuery("Rash")
+        self.assertTrue(query.matches_text("fixed a crasher"))
+        self.assertFalse(query.matches_text("fix a bug"))
+
+    def test_can_search(self):
+        self.assertTrue(SearchQuery.can_search("crash"))
+        self.assertTrue(SearchQuery.can_search("1234"))
+        # What these match may not be part of one word.
+        self.assertFalse(SearchQuery.can_search("fix crash"))
+        self.assertFalse(SearchQuery.can_search("fix*crash"))
+        self.assertFalse(SearchQuery.can_search("c?ash"))
+        self.assertFalse(SearchQuery.can_search(""))
+
+
+class TestSearchIndex(TestCaseInTempDir):
+
+    def make_index(self):
+        index = SearchIndex("search/index.sqlite")
+        index.add_revisions([
+            make_revision(b"rev-1", "Fix the crash on startup"),
+            make_revision(b"rev-2", "Add a button",
+                          committer="Jane <jane@example.com>"),
+            make_revision(b"rev-3", "Fixed another crasher",
+                          bugs="https://launchpad.net/bugs/1234 fixed"),
+            ])
+        return index
+
+    def test_search(self):
+        index = self.make_index()
+        self.assertEqual({b"rev-1", b"rev-3"},
+                         index.search("message", SearchQuery("fix")))
+        # Words that are part of a word match, like in the searches that
+        # check the revisions themselves.
+        self.assertEqual({b"rev-1", b"rev-3"},
+                         index.search("message", SearchQuery("RASH")))
+        self.assertEqual({b"rev-1"},
+                         index.search("message", SearchQuery("tartu")))
+        self.assertEqual(set(), index.search("message", SearchQuery("jane")))
+        self.assertEqual({b"rev-2"}, index.search("author", SearchQuery("jane")))
+        self.assertEqual({b"rev-3"}, index.search("bug", SearchQuery("1234")))
+
+    def test_persistent(self):
+        self.make_index().close()
+        index = SearchIndex("search/index.sqlite")
+        self.assertEqual({b"rev-1", b"rev-2", b"rev-3"}, index.indexed)
+        self.assertEqual({b"rev-2"},
+                         index.search("message", SearchQuery("butt")))
+        # Adding them again does nothing.
+        index.add_revisions([make_revision(b"rev-2", "Something else")])
+        self.assertEqual(set(),
+                         index.search("message", SearchQuery("something")))
@@ -41,14 +41,13 @@ from breezy.plugins.qbrz.lib.i18n import gettext
 
 from breezy.plugins.qbrz.lib.revtreeview import (RevisionTreeView, RevNoItemDelegate)
 from breezy.plugins.qbrz.lib.uifactory import ui_current_widget
-from breezy.plugins.qbrz.lib.lazycachedrevloader import cached_revisions
+from breezy.plugins.qbrz.lib.lazycachedrevloader import get_revision_summary
 from breezy.plugins.qbrz.lib.trace import report_exception, SUB_LOAD_METHOD
 
 from breezy.bzr.conflicts import TextConflict
 from breezy.transport import NoSuchFile
 
 import posixpath  # to use '/' path sep in path.join().
-from time import (strftime, localtime)
 
 from breezy.workingtree import WorkingTree
 from breezy.revisiontree import RevisionTree
@@ -60,8 +59,6 @@ from breezy.plugins.qbrz.lib.annotate import AnnotateWindow
 from breezy.plugins.qbrz.lib.log import LogWindow
 from breezy.plugins.qbrz.lib.util import (
     get_set_encoding,
-    get_summary,
-    get_apparent_author_name,
     )
 from breezy.plugins.qbrz.lib.subprocess import SimpleSubProcessDialog
 from breezy.plugins.qbrz.lib.diff import (
@@ -1111,17 +1108,17 @@ class TreeModel(QtCore.QAbstractItemModel):
                     return ""
 
         if role == QtCore.Qt.DisplayRole:
-            if revid in cached_revisions:
-                rev = cached_revisions[revid]
+            summary = get_revision_summary(revid)
+            if summary is not None:
 
                 if column == self.AUTHOR:
-                    return get_apparent_author_name(rev)
+                    return summary.author_name
 
                 if column == self.MESSAGE:
-                    return get_summary(rev)
+                    return summary.summary or gettext('(no message)')
 
                 if column == self.DATE:
-                    return strftime("%Y-%m-%d %H:%M", localtime(rev.timestamp))
+                    return summary.date
 
         if role == self.PATH:
             return item_data.path